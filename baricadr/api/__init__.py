@@ -1,14 +1,14 @@
+import json
 import os
 
 from baricadr.db_models import BaricadrTask
 from baricadr.extensions import db
-from baricadr.utils import get_celery_worker_status
 
 from celery.result import AsyncResult
 
 from email_validator import EmailNotValidError, validate_email
 
-from flask import (Blueprint, current_app, jsonify, make_response, request)
+from flask import (Blueprint, Response, current_app, jsonify, make_response, request, stream_with_context)
 
 
 api = Blueprint('api', __name__, url_prefix='/')
@@ -85,9 +85,21 @@ def list():
 
     asked_path = os.path.abspath(request.json['path'])
     repo = current_app.repos.get_repo(asked_path)
-    files = repo.remote_list(asked_path, missing=missing, max_depth=max_depth, from_root=from_root, full=full)
+    files = repo.iter_remote_list(asked_path, missing=missing, max_depth=max_depth, from_root=from_root, full=full)
 
-    return jsonify(files)
+    # Get the first file before answering, to still be able to send an error if the listing fails right away
+    first = next(files, None)
+    if first is None:
+        return jsonify([])
+
+    def generate():
+        yield '[' + json.dumps(first)
+        for file in files:
+            yield ',' + json.dumps(file)
+        yield ']'
+
+    # Stream the listing, to never load it completely in memory
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 @api.route('/tree', methods=['POST'])
@@ -122,8 +134,7 @@ def __pull_or_freeze(action, request):
     # Normalize path
     asked_path = os.path.abspath(request.json['path'])
 
-    celery_status = get_celery_worker_status(current_app.celery)
-    if celery_status['availability'] is None:
+    if not current_app.workers.available():
         current_app.logger.error("Received '%s' action on path '%s', but no Celery worker available to process the request. Aborting." % (action, asked_path))
         return jsonify({'error': 'No Celery worker available to process the request'}), 400
 
@@ -141,22 +152,12 @@ def __pull_or_freeze(action, request):
     if 'dry_run' in request.json:
         dry_run = str(request.json['dry_run']).lower() in ["true", "1", "yes"]
 
-    # Check if we're already touching the path
-    touching_task_id = current_app.repos.is_already_touching(asked_path)
-    if touching_task_id:
-        current_app.logger.info("Already touching this path '%s' in task '%s', no new task." % (asked_path, touching_task_id))
-        task_id = touching_task_id
-    else:
-        locking_task_id = current_app.repos.is_locked_by_subdir(asked_path)
-
-        task = current_app.celery.send_task(action, (asked_path, email, locking_task_id, dry_run))
-        task_id = task.task_id
+    # No new task if we're already touching the path. Tasks waiting for others are only sent to Celery when they are completed
+    task_id, created = current_app.task_dispatcher.submit_unless_touching(action, asked_path, email=email, dry_run=dry_run)
+    if created:
         current_app.logger.info("Created %s task %s" % (action, task_id))
-
-        # Save a reference to this task in db
-        pt = BaricadrTask(path=asked_path, type=action, task_id=task_id)
-        db.session.add(pt)
-        db.session.commit()
+    else:
+        current_app.logger.info("Already touching this path '%s' in task '%s', no new task." % (asked_path, task_id))
 
     return jsonify({'task': task_id})
 
@@ -200,7 +201,8 @@ def task_show(task_id):
             'created': db_task.created,
             'started': db_task.started,
             'finished': db_task.finished,
-            'error': db_task.error
+            'error': db_task.error,
+            'progress': json.loads(db_task.progress) if db_task.progress else None
         }
         code = 200
     else:
@@ -254,7 +256,9 @@ def task_remove(task_id):
             AsyncResult(task_id).revoke(terminate=True)
 
         db.session.delete(db_task)
+        current_app.path_locks.release(task_id)
         db.session.commit()
+        current_app.task_dispatcher.completed(task_id)
         status['info'] = "Task %s removed." % (task_id)
         code = 200
 
@@ -269,8 +273,7 @@ def task_remove(task_id):
 def zombie():
     current_app.logger.info("API call: Killing zombies")
 
-    celery_status = get_celery_worker_status(current_app.celery)
-    if celery_status['availability'] is None:
+    if not current_app.workers.available():
         current_app.logger.error("Received 'zombie' action, but no Celery worker available to process the request. Aborting.")
         return jsonify({'error': 'No Celery worker available to process the request'}), 400
 
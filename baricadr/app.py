@@ -1,7 +1,6 @@
+import datetime
 import os
 
-from baricadr.utils import get_celery_worker_status
-
 from celery import Celery
 
 from flask import Flask, g, render_template
@@ -10,10 +9,18 @@ from flask_apscheduler import APScheduler
 
 from .api import api
 # Import model classes for flaks migrate
-from .db_models import BaricadrTask  # noqa: F401
+from .db_models import BaricadrTask, FileAccess, LocalInventoryDir, LocalInventoryEntry, PathLock, RemoteCatalog, RemoteCatalogDir, RemoteCatalogEntry  # noqa: F401
 from .extensions import (celery, db, mail, migrate)
 from .model import backends
+from .model.cache import ListingCache
+from .model.dispatcher import TaskDispatcher
+from .model.leases import TaskLeases
+from .model.locks import PathLocks
+from .model.rclone import RcloneDaemonPool
 from .model.repos import Repos
+from .model.s3 import S3ClientPool
+from .model.sftp import SftpPool
+from .model.workers import WorkerRegistry
 
 
 __all__ = ('create_app', 'create_celery', )
@@ -27,7 +34,7 @@ CONFIG_KEYS = (
     'BARICADR_REPOS_CONF',
     'MAIL_SENDER',
     'MAIL_ADMIN',
-    'CLEANUP_ZOMBIES_INTERVAL',
+    'REAPER_INTERVAL',
     'CLEANUP_INTERVAL',
     'CLEANUP_AGE',
     'TASK_LOG_DIR',
@@ -49,6 +56,15 @@ CONFIG_KEYS = (
     'MAIL_SENDER',
     'MAIL_SUPPRESS_SEND',
     'LOG_FOLDER',
+    'RCLONE_DAEMONS',
+    'REDIS_URL',
+    'LISTING_CACHE_MAX_ENTRIES',
+    'LISTING_CACHE_MAX_FILES',
+    'ACCESS_TRACKER_FLUSH_INTERVAL',
+    'LOCK_TIMEOUT',
+    'LOCK_QUEUED_TIMEOUT',
+    'TASK_QUEUED_TIMEOUT',
+    'WORKER_HEARTBEAT_INTERVAL',
 )
 
 
@@ -85,8 +101,7 @@ def create_app(config=None, app_name='baricadr', blueprints=None, run_mode=None,
         app.config = _merge_conf_with_env_vars(app.config)
 
         # Clean some config values / use default when missing
-        if 'CLEANUP_ZOMBIES_INTERVAL' in app.config:
-            app.config['CLEANUP_ZOMBIES_INTERVAL'] = _get_int_value(app.config.get('CLEANUP_ZOMBIES_INTERVAL'), 3600)
+        app.config['REAPER_INTERVAL'] = _get_int_value(app.config.get('REAPER_INTERVAL'), 10)
 
         if 'CLEANUP_INTERVAL' in app.config:
             app.config['CLEANUP_INTERVAL'] = _get_int_value(app.config.get('CLEANUP_INTERVAL'), 21600)
@@ -99,13 +114,53 @@ def create_app(config=None, app_name='baricadr', blueprints=None, run_mode=None,
         if 'BARICADR_REPOS_CONF' not in app.config:
             app.config['BARICADR_REPOS_CONF'] = '/etc/baricadr/repos.yml'
 
+        app.config['RCLONE_DAEMONS'] = _get_bool_value(app.config.get('RCLONE_DAEMONS'), False)
+
         if app.is_worker:
             os.makedirs(app.config['TASK_LOG_DIR'], exist_ok=True)
 
+        # Delay (in seconds) between each save of the accesses recorded by the access tracker
+        app.config['ACCESS_TRACKER_FLUSH_INTERVAL'] = _get_int_value(app.config.get('ACCESS_TRACKER_FLUSH_INTERVAL'), 60)
+
+        # Locks of running tasks expire after LOCK_TIMEOUT seconds without being renewed, locks of queued tasks (renewed by the reaper) after LOCK_QUEUED_TIMEOUT seconds
+        app.config['LOCK_TIMEOUT'] = _get_int_value(app.config.get('LOCK_TIMEOUT'), 60)
+        app.config['LOCK_QUEUED_TIMEOUT'] = _get_int_value(app.config.get('LOCK_QUEUED_TIMEOUT'), 600)
+        app.path_locks = PathLocks(app.config['LOCK_TIMEOUT'], app.config['LOCK_QUEUED_TIMEOUT'])
+        # Leases of running tasks, renewed with their locks. Tasks not received by a worker after TASK_QUEUED_TIMEOUT seconds are sent again
+        app.config['TASK_QUEUED_TIMEOUT'] = _get_int_value(app.config.get('TASK_QUEUED_TIMEOUT'), 3600)
+        app.task_leases = TaskLeases(app.config['LOCK_TIMEOUT'], queued_timeout=app.config['TASK_QUEUED_TIMEOUT'])
+
+        # Sends tasks to Celery, holding back the ones waiting for other tasks
+        app.task_dispatcher = TaskDispatcher()
+
+        app.config['LISTING_CACHE_MAX_ENTRIES'] = _get_int_value(app.config.get('LISTING_CACHE_MAX_ENTRIES'), 1000)
+        app.config['LISTING_CACHE_MAX_FILES'] = _get_int_value(app.config.get('LISTING_CACHE_MAX_FILES'), 100000)
+
+        # Cache of remote listings, used by repos with a list_cache_ttl
+        app.listing_cache = ListingCache(app.config['REDIS_URL'], app.config['LISTING_CACHE_MAX_ENTRIES'], app.config['LISTING_CACHE_MAX_FILES'])
+
+        # Live workers and their tasks, published by the workers heartbeats every WORKER_HEARTBEAT_INTERVAL seconds
+        app.config['WORKER_HEARTBEAT_INTERVAL'] = _get_int_value(app.config.get('WORKER_HEARTBEAT_INTERVAL'), 5)
+        app.workers = WorkerRegistry(app.config['REDIS_URL'], app.config['WORKER_HEARTBEAT_INTERVAL'])
+
+        # Pool of long-lived rclone daemons, shared by all the repos using the same remote
+        app.rclone_daemons = None
+        if app.config['RCLONE_DAEMONS']:
+            app.rclone_daemons = RcloneDaemonPool()
+
+        # SFTP sessions of the sftp_native backend (only connected on first use)
+        app.sftp_pool = SftpPool()
+
+        # S3 clients of the s3_native backend, with their connection pools
+        app.s3_pool = S3ClientPool()
+
         # Load the list of baricadr repositories
         app.backends = backends.Backends()
         app.repos = Repos(app.config['BARICADR_REPOS_CONF'], app.backends)
 
+        if app.rclone_daemons:
+            start_rclone_daemons(app)
+
         if blueprints is None:
             blueprints = BLUEPRINTS
 
@@ -123,12 +178,17 @@ def create_app(config=None, app_name='baricadr', blueprints=None, run_mode=None,
             scheduler = APScheduler()
             scheduler.init_app(app)
             scheduler.start()
-            if app.config.get("CLEANUP_ZOMBIES_INTERVAL"):
-                scheduler.add_job(func=cleanup_zombies, args=[app], trigger='interval', seconds=app.config.get("CLEANUP_ZOMBIES_INTERVAL"), id="cleanup_zombies_job")
+            if app.config.get("REAPER_INTERVAL"):
+                # Run by the web app itself: works even when no worker is left
+                scheduler.add_job(func=reap_tasks, args=[app], trigger='interval', seconds=app.config.get("REAPER_INTERVAL"), id="reaper_job")
             if app.config.get("CLEANUP_INTERVAL"):
                 scheduler.add_job(func=cleanup, args=[app], trigger='interval', seconds=app.config.get("CLEANUP_INTERVAL"), id="cleanup_job")
             # Setup freeze job for compatible repos
             setup_freeze_tasks(app, scheduler)
+            # Setup catalog indexing job for repos with a catalog
+            setup_catalog_tasks(app, scheduler)
+            # Setup local inventory scan job for repos with an inventory
+            setup_inventory_tasks(app, scheduler)
 
     return app
 
@@ -241,40 +301,106 @@ def setup_freeze_tasks(app, scheduler):
     with app.app_context():
 
         for path, repo in app.repos.repos.items():
-            if not repo.freezable or not repo.auto_freeze:
+            if not repo.freezable:
+                continue
+
+            if repo.auto_freeze:
+                app.logger.debug("Creating scheduler job for path : %s with auto_freeze_interval : %s" % (path, repo.auto_freeze_interval))
+                scheduler.add_job(func=freeze_repo, args=[app, path], trigger='interval', days=repo.auto_freeze_interval, id="auto_freeze_%s" % (path), name="Auto freeze job for path %s" % (path))
+
+            if repo.high_watermark is not None:
+                app.logger.debug("Creating scheduler job for path : %s with watermark_interval : %s" % (path, repo.watermark_interval))
+                scheduler.add_job(func=check_watermark, args=[app, path], trigger='interval', minutes=repo.watermark_interval, id="watermark_%s" % (path), name="Disk usage watermark job for path %s" % (path))
+
+
+def setup_catalog_tasks(app, scheduler):
+    with app.app_context():
+
+        for path, repo in app.repos.repos.items():
+            if repo.catalog is None:
                 continue
 
-            app.logger.debug("Creating scheduler job for path : %s with auto_freeze_interval : %s" % (path, repo.auto_freeze_interval))
-            scheduler.add_job(func=freeze_repo, args=[app, path], trigger='interval', days=repo.auto_freeze_interval, id="auto_freeze_%s" % (path), name="Auto freeze job for path %s" % (path))
+            app.logger.debug("Creating scheduler job for path : %s with catalog_interval : %s" % (path, repo.catalog.interval))
+            # First indexing right now
+            scheduler.add_job(func=index_catalog, args=[app, path], trigger='interval', hours=repo.catalog.interval, next_run_time=datetime.datetime.now(), id="index_catalog_%s" % (path), name="Catalog indexing job for path %s" % (path))
 
+            if repo.catalog.refresh_interval:
+                app.logger.debug("Creating scheduler job for path : %s with catalog_refresh_interval : %s" % (path, repo.catalog.refresh_interval))
+                scheduler.add_job(func=refresh_catalog, args=[app, path], trigger='interval', minutes=repo.catalog.refresh_interval, id="refresh_catalog_%s" % (path), name="Catalog refresh job for path %s" % (path))
+
+
+def setup_inventory_tasks(app, scheduler):
+    with app.app_context():
+
+        for path, repo in app.repos.repos.items():
+            if repo.inventory is None:
+                continue
 
-def freeze_repo(app, repo_path):
+            app.logger.debug("Creating scheduler job for path : %s with local_inventory_interval : %s" % (path, repo.inventory.interval))
+            # First scan right now
+            scheduler.add_job(func=rescan_inventory, args=[app, path], trigger='interval', minutes=repo.inventory.interval, next_run_time=datetime.datetime.now(), id="rescan_inventory_%s" % (path), name="Local inventory scan job for path %s" % (path))
 
-    celery_status = get_celery_worker_status(app.celery)
-    if celery_status['availability'] is None:
+
+def start_rclone_daemons(app):
+    with app.app_context():
+
+        for path, repo in app.repos.repos.items():
+            if not isinstance(repo.backend, backends.RcloneBackend):
+                continue
+
+            try:
+                repo.backend.get_daemon().call('rc/noop')
+            except (RuntimeError, OSError) as err:
+                # Not fatal, the daemon will be started again on first use
+                app.logger.warning("Could not start rclone daemon for repo '%s': %s" % (path, err))
+
+
+def freeze_repo(app, repo_path, evict=False):
+
+    if not app.workers.available():
         app.logger.error("Trying to schedule an auto freeze task on repo '%s', but no Celery worker available to process the request. Aborting.", repo_path)
         return
 
     admin_email = app.config.get('MAIL_ADMIN', None)
-    admin_email.split(',')
+    recipients = [a.strip() for a in admin_email.split(',')] if admin_email else None
 
-    touching_task_id = app.repos.is_already_touching(repo_path)
-    if not touching_task_id:
-        locking_task_id = app.repos.is_locked_by_subdir(repo_path)
-        task = app.celery.send_task('freeze', (repo_path, admin_email, locking_task_id))
-        task_id = task.task_id
+    app.task_dispatcher.submit_unless_touching('freeze', repo_path, email=recipients, evict=evict)
 
-        pt = BaricadrTask(path=repo_path, type='freeze', task_id=task_id)
-        db.session.add(pt)
-        db.session.commit()
+
+def check_watermark(app, repo_path):
+
+    repo = app.repos.get_repo(repo_path)
+    if not repo.above_high_watermark():
+        return
+
+    app.logger.info("Disk usage of repo '%s' is above the high watermark, scheduling an eviction freeze task" % repo_path)
+    freeze_repo(app, repo_path, evict=True)
+
+
+def index_catalog(app, repo_path):
+    app.celery.send_task('index_catalog', (repo_path,))
+
+
+def refresh_catalog(app, repo_path):
+    app.celery.send_task('refresh_catalog', (repo_path,))
+
+
+def rescan_inventory(app, repo_path):
+    app.celery.send_task('rescan_inventory', (repo_path,))
 
 
 def cleanup(app):
     app.celery.send_task('cleanup_tasks', (app.config['CLEANUP_AGE'],))
 
 
-def cleanup_zombies(app):
-    app.celery.send_task('cleanup_zombie_tasks')
+def reap_tasks(app):
+    with app.app_context():
+        requeued, failed = app.task_leases.reap()
+        if requeued or failed:
+            app.logger.info("Reaped tasks which lost their worker: %s requeued, %s failed" % (requeued, failed))
+
+        app.path_locks.renew_queued()
+        db.session.commit()
 
 
 def _get_int_value(config_val, default):
@@ -287,6 +413,14 @@ def _get_int_value(config_val, default):
     return config_val
 
 
+def _get_bool_value(config_val, default):
+    if config_val is None:
+        return default
+    if isinstance(config_val, bool):
+        return config_val
+    return str(config_val).lower() in ["true", "1", "yes"]
+
+
 def _merge_conf_with_env_vars(config):
 
     for key in CONFIG_KEYS:
@@ -24,6 +24,16 @@ class BaseConfig(object):
 
     LOG_FOLDER = "/var/log/baricadr/"
 
+    # Redis database used for the remote listing cache
+    REDIS_URL = 'redis://redis:6379/1'
+    # Maximum number of listings in the cache (least recently used ones are evicted first)
+    LISTING_CACHE_MAX_ENTRIES = 1000
+    # Listings with more files than this are never cached
+    LISTING_CACHE_MAX_FILES = 100000
+
+    # Run remote operations through long-lived 'rclone rcd' processes instead of one rclone process per operation
+    RCLONE_DAEMONS = False
+
 
 class DevelopmentConfig(BaseConfig):
     DEBUG = True
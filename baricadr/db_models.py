@@ -15,9 +15,154 @@ class BaricadrTask(db.Model):
     started = db.Column(db.DateTime())
     finished = db.Column(db.DateTime())
     error = db.Column(db.Text())
+    progress = db.Column(db.Text())  # Json
+    # For tasks waiting for other tasks before being sent to Celery
+    wait_for = db.Column(db.Text())  # Json
+    args = db.Column(db.Text())  # Json
+    # Renewed by the worker while the task runs
+    lease_expires = db.Column(db.DateTime(), index=True)
+    # Number of times the task was requeued after losing its worker
+    requeues = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return '<BaricadrTask {} {} {} {}>'.format(self.type, self.path, self.task_id, self.status)
 
     def logfile_path(self, app, task_id):
         return "{}/{}_{}.log".format(app.config['TASK_LOG_DIR'], self.created.strftime("%Y-%m-%d_%H-%M-%S"), task_id)
+
+
+class RemoteCatalog(db.Model):
+    """
+    State of the catalog of remote files of a repository
+    """
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), index=True, unique=True, nullable=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    indexed = db.Column(db.DateTime())
+    indexing_started = db.Column(db.DateTime())
+    refreshed = db.Column(db.DateTime())
+
+    def __repr__(self):
+        return '<RemoteCatalog {} {} {}>'.format(self.repo, self.generation, self.indexed)
+
+
+class RemoteCatalogDir(db.Model):
+    """
+    A remote directory, as seen when the catalog was last indexed or refreshed
+    """
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), nullable=False)
+    generation = db.Column(db.Integer, nullable=False)
+    # Relative to the repo root ('' for the root). C collation to get a bytewise ordering, needed for path prefix range queries
+    path = db.Column(db.Text(collation='C'), nullable=False)
+    # ModTime when the directory was listed, None to list it again on next refresh
+    mod_time = db.Column(db.String(64))
+
+    __table_args__ = (
+        db.Index('ix_remote_catalog_dir_repo_generation_path', 'repo', 'generation', 'path', unique=True),
+    )
+
+    def __repr__(self):
+        return '<RemoteCatalogDir {} {} {}>'.format(self.repo, self.generation, self.path)
+
+
+class RemoteCatalogEntry(db.Model):
+    """
+    A remote file, as seen when the catalog was last indexed or refreshed
+    """
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), nullable=False)
+    generation = db.Column(db.Integer, nullable=False)
+    # Relative to the repo root. C collation to get a bytewise ordering, needed for path prefix range queries
+    path = db.Column(db.Text(collation='C'), nullable=False)
+    dir = db.Column(db.Text(collation='C'), nullable=False)
+    depth = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.BigInteger)
+    mod_time = db.Column(db.String(64))
+    mime_type = db.Column(db.String(255))
+    hashes = db.Column(db.Text())
+
+    __table_args__ = (
+        db.Index('ix_remote_catalog_entry_repo_generation_path', 'repo', 'generation', 'path'),
+        db.Index('ix_remote_catalog_entry_repo_generation_dir', 'repo', 'generation', 'dir'),
+    )
+
+    def __repr__(self):
+        return '<RemoteCatalogEntry {} {} {}>'.format(self.repo, self.generation, self.path)
+
+
+class FileAccess(db.Model):
+    """
+    Last access to a local file, as seen by the access tracker
+    """
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), nullable=False)
+    # Relative to the repo root
+    path = db.Column(db.Text(), nullable=False)
+    accessed = db.Column(db.DateTime(), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_file_access_repo_path', 'repo', 'path', unique=True),
+    )
+
+    def __repr__(self):
+        return '<FileAccess {} {} {}>'.format(self.repo, self.path, self.accessed)
+
+
+class LocalInventoryDir(db.Model):
+    """
+    A local directory, as seen when the local inventory was last scanned
+    """
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), nullable=False)
+    # Relative to the repo root ('' for the root). C collation to get a bytewise ordering, needed for path prefix range queries
+    path = db.Column(db.Text(collation='C'), nullable=False)
+    # Modification time (in nanoseconds) when the directory was listed, -1 to list it again on next scan
+    mtime = db.Column(db.BigInteger, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_local_inventory_dir_repo_path', 'repo', 'path', unique=True),
+    )
+
+    def __repr__(self):
+        return '<LocalInventoryDir {} {}>'.format(self.repo, self.path)
+
+
+class LocalInventoryEntry(db.Model):
+    """
+    A local file, as seen when its directory was last listed
+    """
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    repo = db.Column(db.Text(), nullable=False)
+    # Relative to the repo root
+    path = db.Column(db.Text(collation='C'), nullable=False)
+    dir = db.Column(db.Text(collation='C'), nullable=False)
+    depth = db.Column(db.Integer, nullable=False)
+    inode = db.Column(db.BigInteger)
+    size = db.Column(db.BigInteger)
+    # In nanoseconds
+    mtime = db.Column(db.BigInteger)
+    atime = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        db.Index('ix_local_inventory_entry_repo_path', 'repo', 'path', unique=True),
+        db.Index('ix_local_inventory_entry_repo_dir', 'repo', 'dir'),
+    )
+
+    def __repr__(self):
+        return '<LocalInventoryEntry {} {}>'.format(self.repo, self.path)
+
+
+class PathLock(db.Model):
+    """
+    Lock on a path, held by a pull/freeze task
+    """
+    id = db.Column(db.Integer, primary_key=True, nullable=False)
+    # Absolute path. C collation to get a bytewise ordering, needed for path prefix range queries
+    path = db.Column(db.Text(collation='C'), index=True, nullable=False)
+    task_id = db.Column(db.String(255), index=True, nullable=False)
+    # Renewed while the task runs
+    expires = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self):
+        return '<PathLock {} {} {}>'.format(self.path, self.task_id, self.expires)
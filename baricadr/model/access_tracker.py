@@ -0,0 +1,262 @@
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+from baricadr.db_models import FileAccess
+from baricadr.extensions import db
+
+from sqlalchemy.dialects.postgresql import insert
+
+IN_ACCESS = 0x00000001
+IN_OPEN = 0x00000020
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify():
+    """
+    Minimal wrapper around the inotify API of the Linux kernel
+    """
+
+    def __init__(self):
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: %s" % os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """
+        :rtype: int
+        :return: the watch descriptor
+        """
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch on %s: %s" % (path, os.strerror(err)))
+
+        return wd
+
+    def read_events(self, timeout):
+        """
+        Wait for events
+
+        :rtype: list
+        :return: tuples (watch descriptor, mask, name) (name is empty for events on the watched directory itself)
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+
+        os.close(self.fd)
+
+
+class AccessTracker():
+    """
+    Record the last access time of the files of repositories, as seen by inotify (for mounts with relatime/noatime)
+
+    Accesses are kept in memory, and flushed regularly to the database (one row per file).
+    Only accesses from the host running the tracker are seen (not from other NFS clients).
+    """
+
+    WATCH_MASK = IN_ACCESS | IN_OPEN | IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+
+    def __init__(self, app, flush_interval=60):
+
+        self.app = app
+        self.flush_interval = flush_interval
+        self.inotify = None
+        self.watches = {}  # watch descriptor => (repo local path, dir relative to repo root)
+        self.pending = {}  # (repo local path, file relative to repo root) => access time
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start tracking all the repos with access_tracking enabled, in a background thread
+        """
+
+        repos = [path for path, repo in self.app.repos.repos.items() if repo.freezable and repo.access_tracking]
+        if not repos:
+            return
+
+        self.inotify = Inotify()
+        for repo_path in repos:
+            self.app.logger.info("Tracking accesses to files of repo %s" % repo_path)
+            self.watch_tree(repo_path, '')
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name='access_tracker')
+        self.thread.start()
+
+    def stop(self):
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def watch_tree(self, repo_path, rel_dir):
+        """
+        Watch a directory and all its subdirectories
+        """
+
+        to_watch = [rel_dir]
+        while to_watch:
+            current = to_watch.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(repo_path, current), self.WATCH_MASK)
+            except OSError as err:
+                if err.errno == errno.ENOSPC:
+                    self.app.logger.error("Could not watch %s, increase fs.inotify.max_user_watches" % os.path.join(repo_path, current))
+                    return
+                # Removed meanwhile
+                continue
+
+            self.watches[wd] = (repo_path, current)
+
+            try:
+                with os.scandir(os.path.join(repo_path, current)) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            to_watch.append(os.path.join(current, dir_entry.name))
+            except OSError:
+                continue
+
+    def run(self):
+
+        last_flush = time.time()
+        while not self.stopping.is_set():
+            self.handle_events(self.inotify.read_events(1))
+
+            if time.time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.time()
+
+        self.flush()
+        self.inotify.close()
+
+    def handle_events(self, events):
+
+        now = datetime.datetime.utcnow()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.app.logger.warning("Access tracker event queue overflowed, some file accesses were missed")
+                continue
+
+            if mask & IN_IGNORED or wd not in self.watches:
+                # The directory was removed
+                self.watches.pop(wd, None)
+                continue
+
+            if not name:
+                continue
+
+            repo_path, rel_dir = self.watches[wd]
+            rel_path = os.path.join(rel_dir, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(repo_path, rel_path)
+                continue
+
+            if mask & (IN_ACCESS | IN_OPEN):
+                self.pending[(repo_path, rel_path)] = now
+
+    def flush(self):
+        """
+        Save the pending accesses in the database (keeping them for the next flush if the database can't be reached)
+        """
+
+        if not self.pending:
+            return
+
+        pending = self.pending
+        self.pending = {}
+
+        by_repo = {}
+        for (repo_path, rel_path), accessed in pending.items():
+            by_repo.setdefault(repo_path, {})[rel_path] = accessed
+
+        chunks = []
+        for repo_path, accesses in by_repo.items():
+            paths = list(accesses.keys())
+            for i in range(0, len(paths), 5000):
+                chunks.append([{'repo': repo_path, 'path': path, 'accessed': accesses[path]} for path in paths[i:i + 5000]])
+
+        saved = 0
+        with self.app.app_context():
+            for num, rows in enumerate(chunks):
+                try:
+                    # Concurrent trackers (or a late flush) never move an access time backwards
+                    stmt = insert(FileAccess.__table__)
+                    stmt = stmt.on_conflict_do_update(index_elements=['repo', 'path'], set_={'accessed': db.func.greatest(FileAccess.__table__.c.accessed, stmt.excluded.accessed)})
+                    db.session.execute(stmt, rows)
+                    db.session.commit()
+                except Exception as err:
+                    db.session.rollback()
+                    self.app.logger.error("Could not save file accesses, retrying with the next flush: %s" % err)
+                    for unsaved in chunks[num:]:
+                        for row in unsaved:
+                            key = (row['repo'], row['path'])
+                            self.pending[key] = max(self.pending.get(key, row['accessed']), row['accessed'])
+                    break
+                saved += len(rows)
+
+            db.session.remove()
+
+        self.app.logger.debug("Saved %s file accesses" % saved)
+
+
+def get_access_times(repo_path, rel_paths):
+    """
+    Get the last access times recorded by the tracker for some files
+
+    :type rel_paths: list
+    :param rel_paths: Paths relative to the repo root
+
+    :rtype: dict
+    :return: path relative to the repo root => last access time (epoch, in nanoseconds), for tracked files only
+    """
+
+    times = {}
+    for i in range(0, len(rel_paths), 5000):
+        chunk = rel_paths[i:i + 5000]
+        for path, accessed in db.session.query(FileAccess.path, FileAccess.accessed).filter(FileAccess.repo == repo_path, FileAccess.path.in_(chunk)):
+            times[path] = int(accessed.replace(tzinfo=datetime.timezone.utc).timestamp()) * 10 ** 9
+
+    return times
@@ -1,18 +1,39 @@
-import fnmatch
+import asyncio
+import concurrent.futures
+import datetime
 import json
+import mimetypes
 import os
-import re
+import shlex
+import stat
 import tempfile
-from subprocess import PIPE, Popen
+import threading
+import time
+import uuid
+from contextlib import closing
+from itertools import chain, islice
+from subprocess import DEVNULL, PIPE, Popen
+
+from baricadr.model import localfs, s3
+
+import dateutil.parser
 
 from flask import current_app
 
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
 
 class Backends():
     def __init__(self):
         self.backends = {
             'sftp': SftpBackend,
             's3': S3Backend,
+            'sftp_native': NativeSftpBackend,
+            's3_native': NativeS3Backend,
+            'local': LocalBackend,
         }
 
     def get_by_name(self, name, conf):
@@ -24,11 +45,18 @@ class Backends():
 
 
 class Backend():
+
+    # Delay (in seconds) between each progress report during transfers
+    STATS_INTERVAL = 2
+
+    # Whether directory modification times change when entries are added, removed or renamed in them (not on S3)
+    DIR_MTIMES = False
+
     def __init__(self, conf):
 
         self.name = None
 
-    def pull(self, repo, path, dry_run=False):
+    def pull(self, repo, path, dry_run=False, progress=None):
         """
         Download a file from remote into local repository
 
@@ -38,28 +66,207 @@ class Backend():
         :type path: str
         :param path: path to pull, without local or remote prefix
 
+        :type progress: callable
+        :param progress: called regularly during the transfer with a dict (bytes, total_bytes, files, total_files, speed, eta)
+
         :rtype: ?
         :return: ?
         """
         raise NotImplementedError()
 
-    def remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False):
+    def iter_remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False, refresh=False):
         """
-        List content in a distant path
+        Iterate over the files in a distant path, one at a time, without loading the whole listing in memory
+
+        :type refresh: bool
+        :param refresh: Do not use the listing cache (but update it with the new listing)
+
+        :rtype: generator
+        :return: dicts with at least a 'Path' key (and all the informations from rclone lsjson if full is True)
+        """
+
+        rel_path = repo.relative_path(path)
+
+        local_files = None
+        if missing:
+            if os.path.isfile(path):
+                # A single file which is already there, nothing is missing
+                return
+            local_files = repo.local_file_set(path, max_depth)
+
+        entries = self.iter_raw_list(repo, path, max_depth, refresh)
+
+        # When listing a single file, its name is given relative to its parent dir (like rclone does).
+        # Look one entry ahead to know if we are in this case.
+        first = next(entries, None)
+        if first is None:
+            return
+        second = next(entries, None)
+
+        path_rel_prefix = rel_path
+        if second is None and not first['IsDir']:
+            path_rel_prefix = os.path.dirname(rel_path)
+
+        for entry in chain([first] if second is None else [first, second], entries):
+            if entry['IsDir']:
+                continue
+
+            file_path = entry['Path']
+            if file_path.endswith('.rclonelink'):
+                file_path = file_path[:-11]
+
+            if local_files is not None:
+                # Excluded files are never pulled: they are not missing (and their directories may not even be walked locally)
+                if file_path in local_files or repo.filter.is_excluded(os.path.join(path_rel_prefix, file_path)):
+                    continue
+
+            if from_root:
+                file_path = os.path.join(path_rel_prefix, file_path)
+
+            if full:
+                entry['Path'] = file_path
+                yield entry
+            else:
+                yield {'Path': file_path}
+
+    def iter_raw_list(self, repo, path, max_depth=1, refresh=False):
+        """
+        Iterate over the files and directories in a distant path, in the format of 'rclone lsjson -R'
+
+        :rtype: generator
+        :return: dicts with at least 'Path', 'Name', 'Size', 'MimeType', 'ModTime' and 'IsDir' keys
         """
         raise NotImplementedError()
 
-    def remote_tree(self, repo, path, max_depth=1, from_root=False):
+    def remote_stat(self, rel_path):
         """
-        List content in a distant path, with missing files tagged with a '*'
+        Get informations on a single distant file or directory, without listing its content
+
+        :type rel_path: str
+        :param rel_path: path relative to the repo root
+
+        :rtype: dict
+        :return: a dict like in iter_raw_list(), or None if the path does not exist
         """
         raise NotImplementedError()
 
+    def remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False, refresh=False):
+        """
+        List content in a distant path
+        """
+
+        remote_list = list(self.iter_remote_list(repo, path, missing, max_depth, from_root, full, refresh))
+
+        if missing:
+            remote_list = sorted(remote_list, key=lambda k: k['Path'])
+
+        return remote_list
+
+    def remote_tree(self, repo, path, max_depth=1):
+        """
+        List content in a distant path, with missing files tagged with a '*'
+        """
+
+        remote_list = []
+        for entry in self.iter_remote_list(repo, path, max_depth=max_depth):
+            full_file_path = os.path.join(path, entry['Path'])
+            remote_list.append({'Path': entry['Path'], 'missing': not os.path.exists(full_file_path)})
+
+        return remote_list
+
+    def remote_path_number(self, repo, path, limit=None, refresh=False):
+        """
+        Count the files in a distant path (to check if it is a single file or not)
+
+        :type limit: int
+        :param limit: stop listing once this number of files is reached
+
+        :rtype: int
+        :return: number of files (at most limit)
+        """
+
+        with closing(self.iter_remote_list(repo, path, max_depth=0, refresh=refresh)) as remote_files:
+            return sum(1 for entry in islice(remote_files, limit))
+
+    def cache_id(self):
+        """
+        Identify the remote (and credentials) in the listing cache, None if listings should not be cached
+        """
+        return None
+
+    def invalidate_cached(self, repo, path):
+        """
+        Remove the cached listings of a path and of its ancestors, after it changed
+        """
+
+        cache = getattr(current_app, 'listing_cache', None)
+        if not cache or not repo.list_cache_ttl or not self.cache_id():
+            return
+
+        cache.invalidate(self.cache_id(), self.remote_prefix + repo.relative_path(path))
+
+    def iter_cached(self, repo, remote_path, max_depth, entries, refresh=False):
+        """
+        Get a raw remote listing from the listing cache if possible, or store it in the cache while iterating over it
+
+        :type remote_path: str
+        :param remote_path: Full remote path being listed
+
+        :type entries: callable
+        :param entries: returns a generator of the real remote listing
+
+        :type refresh: bool
+        :param refresh: Do not read from the cache, only store the new listing in it
+        """
+
+        cache = getattr(current_app, 'listing_cache', None)
+        if not cache or not repo.list_cache_ttl or not self.cache_id():
+            yield from entries()
+            return
+
+        if not refresh:
+            cached = cache.get(self.cache_id(), remote_path, max_depth, repo.list_cache_ttl)
+            if cached is not None:
+                current_app.logger.info("Got listing of %s (max_depth=%s) from cache" % (remote_path, max_depth))
+                yield from cached
+                return
+
+        # Written to Redis by chunks while iterating, never held in memory
+        writer = cache.writer(self.cache_id(), remote_path, max_depth, repo.list_cache_ttl)
+        try:
+            for entry in entries():
+                # Consumers may modify the entries
+                if writer is not None and not writer.add(entry):
+                    # Too big to be cached
+                    writer = None
+                yield entry
+
+            if writer is not None:
+                writer.commit()
+                writer = None
+        finally:
+            # The consumer stopped iterating before the end of the listing (or it failed)
+            if writer is not None:
+                writer.abort()
+
 
 class RcloneBackend(Backend):
+
+    # Options of the transfer block of repos.yml => rclone flag
+    TRANSFER_FLAGS = {
+        'transfers': '--transfers',
+        'checkers': '--checkers',
+        'multi_thread_streams': '--multi-thread-streams',
+        'multi_thread_cutoff': '--multi-thread-cutoff',
+        'buffer_size': '--buffer-size',
+        'bwlimit': '--bwlimit',
+    }
+
     def __init__(self, conf):
         Backend.__init__(self, conf)
 
+        self.transfer = conf.get('transfer', {})
+
     def obscurify_password(self, clear_pass):
         """
         Generate obscure password to connect to distant server
@@ -77,266 +284,418 @@ class RcloneBackend(Backend):
 
         return obscure_password
 
-    def remote_path_number(self, repo, path):
+    def rclone_config(self):
         """
-        Check if distant path is a single file or not
+        Content of the rclone config file describing the remote
         """
+        raise NotImplementedError()
 
-        remote_list = self.remote_list(repo, path, max_depth=0)
-        return len(remote_list)
+    def backend_specific_options(self):
+        """
+        Options to add to each rclone command line
+        """
+        return ""
 
-    def do_remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False, backend_specific_options=""):
+    def transfer_options(self):
         """
-        List content in a distant path
+        Options to add to each rclone command line, from the transfer block of the repo config
         """
-        tempRcloneConfig = self.temp_rclone_config()
 
-        rel_path = repo.relative_path(path)
+        options = []
+        for key, flag in self.TRANSFER_FLAGS.items():
+            if key in self.transfer:
+                options.append("%s '%s'" % (flag, self.transfer[key]))
 
-        src = "%s:%s%s" % (self.name, self.remote_prefix, rel_path)
+        if self.transfer.get('fast_list'):
+            options.append('--fast-list')
 
-        max_depth_command = ""
+        return " ".join(options)
+
+    def daemon_key(self):
+        """
+        Identify the remote (and credentials and transfer options) a daemon can be shared for
+        """
+        return self.rclone_config() + self.transfer_options()
+
+    def get_daemon(self):
+        """
+        Get the rclone daemon serving this remote, or None if daemons are disabled
+        """
+        if not getattr(current_app, 'rclone_daemons', None):
+            return None
+
+        return current_app.rclone_daemons.get(self.daemon_key(), self.rclone_config(), lambda: "%s %s" % (self.backend_specific_options(), self.transfer_options()))
+
+    def temp_rclone_config(self):
+        tempRcloneConfig = tempfile.NamedTemporaryFile('w+t')
+        tempRcloneConfig.write(self.rclone_config())
+        tempRcloneConfig.seek(0)
+
+        return tempRcloneConfig
+
+    def pull(self, repo, path, dry_run=False, progress=None):
+
+        return self.do_pull(repo, path, dry_run, progress=progress)
+
+    def iter_lsjson(self, repo, path, max_depth=1, backend_specific_options=None, refresh=False):
+        """
+        Run 'rclone lsjson' on a distant path (or the equivalent call on the rclone daemon),
+        parsing its output while it is produced
+
+        :rtype: generator
+        :return: raw dicts from rclone, one per file or directory
+        """
+
+        rel_path = repo.relative_path(path)
 
         try:
             max_depth = int(max_depth)
         except ValueError:
             max_depth = 1
+
+        return self.iter_cached(repo, self.remote_prefix + rel_path, max_depth, lambda: self._iter_lsjson(rel_path, max_depth, backend_specific_options), refresh)
+
+    def _iter_lsjson(self, rel_path, max_depth, backend_specific_options):
+
+        daemon = self.get_daemon()
+        if daemon:
+            yield from self.daemon_lsjson(daemon, rel_path, max_depth)
+            return
+
+        if backend_specific_options is None:
+            backend_specific_options = self.backend_specific_options()
+
+        tempRcloneConfig = self.temp_rclone_config()
+
+        src = "%s:%s%s" % (self.name, self.remote_prefix, rel_path)
+
+        max_depth_command = ""
         # If not 0 (0 is for listing all)
         if max_depth:
             max_depth_command = "--max-depth " + str(max_depth)
 
-        cmd = "rclone lsjson -R --config '%s' '%s' %s %s" % (tempRcloneConfig.name, src, backend_specific_options, max_depth_command)
+        cmd = "rclone lsjson -R --config '%s' '%s' %s %s %s" % (tempRcloneConfig.name, src, backend_specific_options, self.transfer_options(), max_depth_command)
         current_app.logger.info(cmd)
-        p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        output, err = p.communicate()
-        retcode = p.returncode
-        try:
-            json_output = json.loads(output.decode('utf-8'))
-        except json.decoder.JSONDecodeError:
-            current_app.logger.warning('Failed to parse json output from rclone lsjson: %s' % output.decode('utf-8'))
 
-        if retcode != 0:
-            current_app.logger.warning(output)
-            current_app.logger.warning(err)
-            raise RuntimeError("Rclone cmd was terminated by signal " + str(retcode) + ": can't run rclone lsjon (stderr: " + str(err) + ")")
-
-        ls_log = str(json_output)
-        ls_log = (ls_log[:15000] + '...') if len(ls_log) > 15000 else ls_log
-        current_app.logger.info('Raw output from rclone lsjson: %s' % ls_log)
+        # stderr goes to a file to make sure rclone never blocks on it while we read stdout
+        err_file = tempfile.TemporaryFile()
+        p = Popen(shlex.split(cmd), stdin=PIPE, stdout=PIPE, stderr=err_file)
+        num = 0
+        try:
+            # rclone lsjson writes one entry per line, between '[' and ']' lines
+            for line in p.stdout:
+                line = line.strip().rstrip(b',')
+                if line in (b'', b'[', b']'):
+                    continue
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except json.decoder.JSONDecodeError:
+                    current_app.logger.warning('Failed to parse json output from rclone lsjson: %s' % line.decode('utf-8'))
+                    continue
+                num += 1
+                yield entry
+
+            retcode = p.wait()
+            if retcode != 0:
+                err_file.seek(0)
+                err = err_file.read()
+                current_app.logger.warning(err)
+                raise RuntimeError("Rclone cmd was terminated by signal " + str(retcode) + ": can't run rclone lsjon (stderr: " + str(err) + ")")
+
+            current_app.logger.info('Got %s entries from rclone lsjson' % num)
+        finally:
+            # The consumer may stop iterating before the end of the listing
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+            p.stdout.close()
+            err_file.close()
+            tempRcloneConfig.close()
+
+    def daemon_lsjson(self, daemon, rel_path, max_depth):
+        """
+        List a distant path using the rclone daemon, mimicking the output of 'rclone lsjson -R'
 
-        path_rel_prefix = rel_path
-        if len(json_output) == 1 and not json_output[0]['IsDir']:
-            path_rel_prefix = os.path.dirname(rel_path)
+        Directories are listed one at a time: a RC answer is loaded in memory, never the whole recursive listing.
 
-        remote_list = []
-        for entry in json_output:
-            if not entry['IsDir']:
-                if from_root:
-                    file_path = os.path.join(path_rel_prefix, entry['Path'])
-                else:
-                    file_path = entry['Path']
+        :rtype: generator
+        :return: raw dicts from rclone, one per file or directory
+        """
 
-                if file_path.endswith('.rclonelink'):
-                    file_path = file_path[:-11]
+        root = (self.remote_prefix + rel_path).rstrip('/')
 
-                if full:
-                    entry['Path'] = file_path
-                    remote_list.append(entry)
-                else:
-                    remote_list.append({'Path': file_path})
+        num = 0
+        # Directories to list, relative to root, with their depth
+        to_list = [('', 1)]
+        while to_list:
+            sub_dir, depth = to_list.pop()
+            remote = '/'.join(part for part in (root, sub_dir) if part)
+            params = {
+                'fs': '%s:' % self.name,
+                'remote': remote,
+            }
 
-        tempRcloneConfig.close()
-        if missing:
-            remote_list = self.missing_list(path, remote_list, max_depth, repo, full)
+            current_app.logger.debug("rclone daemon operations/list %s:%s" % (self.name, remote))
+            status, res = daemon.call('operations/list', params)
 
-        lsr_log = str(remote_list)
-        lsr_log = (lsr_log[:15000] + '...') if len(lsr_log) > 15000 else lsr_log
-        current_app.logger.info('Parsed remote listing from rclone: %s' % lsr_log)
+            if status == 404 and not sub_dir:
+                # Not a directory, maybe a single file (like 'rclone lsjson' does)
+                status, res = daemon.call('operations/stat', {'fs': '%s:' % self.name, 'remote': remote})
+                if status == 200 and res.get('item') and not res['item']['IsDir']:
+                    res['item']['Path'] = res['item']['Name']
+                    yield res['item']
+                    return
 
-        return remote_list
+            if status != 200:
+                raise RuntimeError("Rclone daemon could not list %s (error: %s)" % (os.path.join(rel_path, sub_dir), res.get('error')))
 
-    def missing_list(self, path, remote_list, max_depth, repo, full=False):
+            for entry in res['list']:
+                entry['Path'] = os.path.join(sub_dir, entry['Name']) if sub_dir else entry['Name']
+                num += 1
+                yield entry
+                # If not 0 (0 is for listing all)
+                if entry['IsDir'] and (not max_depth or depth < max_depth):
+                    to_list.append((entry['Path'], depth + 1))
 
-        remote_set = set([value['Path'] for value in remote_list])
+            # Only keep the names of the directories still to list
+            res = None
 
-        if os.path.isfile(path):
-            file_set = set([repo.relative_path(path)])
-            return list(remote_list - file_set)
+        current_app.logger.info('Got %s entries from rclone daemon' % num)
 
-        file_set = set()
-        for dir_, _, files in self.restricted_walk(path, max_depth):
-            for file_name in files:
-                rel_dir = os.path.relpath(dir_, path)
-                rel_file = os.path.join(rel_dir, file_name)
-                file_set.add(rel_file.lstrip("./"))
+    def iter_raw_list(self, repo, path, max_depth=1, refresh=False):
 
-        sorted_list = sorted(list(remote_set - file_set))
+        return self.iter_lsjson(repo, path, max_depth, refresh=refresh)
 
-        if full:
-            return [file_dict for file_dict in remote_list if file_dict['Path'] in sorted_list]
-        else:
-            return [{'Path': file_path} for file_path in sorted_list]
-
-    def restricted_walk(self, path, max_depth):
-        dirs, nondirs = [], []
-        for entry in os.scandir(path):
-            (dirs if entry.is_dir() else nondirs).append(entry.name)
-        yield path, dirs, nondirs
-        if not max_depth or max_depth > 1:
-            for name in dirs:
-                for x in self.restricted_walk(os.path.join(path, name), 0 if not max_depth else max_depth - 1):
-                    yield x
+    def remote_stat(self, rel_path, backend_specific_options=None):
+        """
+        Get informations on a single distant file or directory, without listing its content
 
-    def temp_rclone_config(self):
-        raise NotImplementedError()
+        :type rel_path: str
+        :param rel_path: path relative to the repo root
 
-    def do_remote_tree(self, repo, path, max_depth=1, backend_specific_options=""):
-        """
-        List content in a distant path, with missing files tagged with a '*'
+        :rtype: dict
+        :return: a raw dict from rclone (like in 'rclone lsjson' output), or None if the path does not exist
         """
-        tempRcloneConfig = self.temp_rclone_config()
 
-        rel_path = repo.relative_path(path)
+        if not rel_path.strip('/'):
+            # The root of the repo
+            return {'Path': '', 'Name': '', 'IsDir': True}
 
-        src = "%s:%s%s" % (self.name, self.remote_prefix, rel_path)
+        daemon = self.get_daemon()
+        if daemon:
+            status, res = daemon.call('operations/stat', {'fs': '%s:' % self.name, 'remote': (self.remote_prefix + rel_path).rstrip('/')})
+            if status != 200:
+                raise RuntimeError("Rclone daemon could not stat %s (error: %s)" % (rel_path, res.get('error')))
+            return res.get('item')
 
-        max_depth_command = ""
+        if backend_specific_options is None:
+            backend_specific_options = self.backend_specific_options()
 
-        try:
-            max_depth = int(max_depth)
-        except ValueError:
-            max_depth = 1
-        # If not 0 (0 is for listing all)
-        if max_depth:
-            max_depth_command = "--max-depth " + str(max_depth)
+        tempRcloneConfig = self.temp_rclone_config()
+
+        src = "%s:%s%s" % (self.name, self.remote_prefix, rel_path)
 
-        cmd = "rclone lsjson -R --config '%s' '%s' %s %s" % (tempRcloneConfig.name, src, backend_specific_options, max_depth_command)
+        cmd = "rclone lsjson --stat --config '%s' '%s' %s %s" % (tempRcloneConfig.name, src, backend_specific_options, self.transfer_options())
         current_app.logger.info(cmd)
-        p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        p = Popen(shlex.split(cmd), stdin=PIPE, stdout=PIPE, stderr=PIPE)
         output, err = p.communicate()
         retcode = p.returncode
-        try:
-            json_output = json.loads(output.decode('utf-8'))
-        except json.decoder.JSONDecodeError:
-            current_app.logger.warning('Failed to parse json output from rclone lsjson: %s' % output.decode('utf-8'))
+        tempRcloneConfig.close()
 
         if retcode != 0:
-            current_app.logger.warning(output)
+            # Exit codes 3 and 4: directory or file not found
+            if retcode in (3, 4) or b'not found' in err:
+                return None
             current_app.logger.warning(err)
-            raise RuntimeError("Rclone cmd was terminated by signal " + str(retcode) + ": can't run rclone lsjon (stderr: " + str(err) + ")")
-
-        ls_log = str(json_output)
-        ls_log = (ls_log[:15000] + '...') if len(ls_log) > 15000 else ls_log
-        current_app.logger.info('Raw output from rclone lsjson: %s' % ls_log)
-
-        remote_list = []
-        for entry in json_output:
-            if not entry['IsDir']:
-                file_path = entry['Path']
+            raise RuntimeError("Rclone cmd was terminated by signal " + str(retcode) + ": can't run rclone lsjson --stat (stderr: " + str(err) + ")")
 
-                if file_path.endswith('.rclonelink'):
-                    file_path = file_path[:-11]
-
-                full_file_path = os.path.join(path, file_path)
-
-                remote_list.append({'Path': file_path, 'missing': not os.path.exists(full_file_path)})
-
-        tempRcloneConfig.close()
-
-        lsr_log = str(remote_list)
-        lsr_log = (lsr_log[:15000] + '...') if len(lsr_log) > 15000 else lsr_log
-        current_app.logger.info('Parsed remote listing from rclone: %s' % lsr_log)
-
-        return remote_list
+        return json.loads(output.decode('utf-8'))
 
-    def parse_copy_output(self, stderr, dry_run):
+    def format_progress(self, stats):
         """
-        Do some dirty things: parse rclone copy stderr to guess which files were transferred
+        Extract the progress of a transfer from rclone stats
         """
-        copied = []
-        transferred = 0
 
-        # Look for copied files
-        if dry_run:
-            copied = re.findall(r'NOTICE: ([\w\-. /]+): Skipped copy as --dry-run is set', stderr.decode('utf-8'))
-        else:
-            copied = re.findall(r'INFO  : ([\w\-. /]+): (Multi-thread )?Copied', stderr.decode('utf-8'))
-            # Only keep the filename(s)
-            copied = [x[0] for x in copied]
-
-        # Look for transferred bytes
-        m = re.search(r'Transferred: .+/ ([0-9.]+) ([A-Z])?Bytes', stderr.decode('utf-8'))
-        if m:
-            transferred = float(m.group(1))
-            if m.group(2) is not None:
-                unit = m.group(2)
-                if unit == "K":
-                    transferred = transferred * 1024
-                elif unit == "M":
-                    transferred = transferred * 1024 * 1024
-                elif unit == "G":
-                    transferred = transferred * 1024 * 1024 * 1024
-                elif unit == "T":
-                    transferred = transferred * 1024 * 1024 * 1024 * 1024
-                elif unit == "P":
-                    transferred = transferred * 1024 * 1024 * 1024 * 1024 * 1024
-            transferred = int(transferred)
+        return {
+            'bytes': stats.get('bytes', 0),
+            'total_bytes': stats.get('totalBytes', 0),
+            'files': stats.get('transfers', 0),
+            'total_files': stats.get('totalTransfers', 0),
+            'speed': stats.get('speed', 0),
+            'eta': stats.get('eta'),
+        }
 
-        return (copied, transferred)
+    def do_pull(self, repo, path, dry_run=False, backend_specific_options=None, progress=None):
 
-    def do_pull(self, repo, path, dry_run=False, backend_specific_options=""):
-        tempRcloneConfig = self.temp_rclone_config()
+        if backend_specific_options is None:
+            backend_specific_options = self.backend_specific_options()
 
         rclone_cmd = 'copy'
-        rpath_num = self.remote_path_number(repo, path)
+        rel_path = repo.relative_path(path)
+
+        # A single probe is enough to know if we are pulling a file or a directory (never cached)
+        remote_stat = self.remote_stat(rel_path, backend_specific_options)
 
-        if rpath_num == 0:
-            # SFTP backend throws a RuntimeError when calling remote_list(), make sure we do the same for other backends
+        if remote_stat is None:
             raise RuntimeError("File/directory not found on remote repository: %s" % (path))
 
-        is_single = rpath_num == 1
+        is_single = not remote_stat['IsDir']
         if is_single:
             rclone_cmd = 'copyto'
 
-        rel_path = repo.relative_path(path)
+        daemon = self.get_daemon()
+        # The daemon can't tell which files would have been copied in dry-run mode, use the command line for this
+        if daemon and not dry_run:
+            return self.daemon_pull(daemon, path, rel_path, is_single, repo.filter, progress)
+
+        tempRcloneConfig = self.temp_rclone_config()
 
         src = "%s:%s%s" % (self.name, self.remote_prefix, rel_path)
         dest = "%s" % (path)
 
         ex_options = ''
-        if repo.exclude:
-            excludes = repo.exclude.split(',')
-            for ex in excludes:
-                if not is_single:
-                    ex_options += " --exclude '%s'" % ex.strip()
-                else:
-                    # rclone copyto does not accept --exclude option for single files
-                    if fnmatch.filter(rel_path, ex):
-                        current_app.logger.info("Single file %s is in exclude list, skipping rclone call, nothing to do" % (rel_path))
-                        return self.parse_copy_output("", dry_run)
+        filter_file = None
+        # A single file is always pulled when explicitly asked
+        if repo.filter and not is_single:
+            # Same rules as the ones used to walk local files
+            filter_file = repo.filter.rclone_filter_file(rel_path)
+            ex_options += " --filter-from '%s'" % filter_file.name
 
         if dry_run:
             ex_options += " --dry-run"
 
         # We use --ignore-existing to avoid deleting locally modified files (for example if a file was modified locally but the backup is not yet up-to-date)
-        cmd = "rclone %s --links --ignore-existing -vv --config '%s' '%s' '%s' %s %s" % (rclone_cmd, tempRcloneConfig.name, src, dest, backend_specific_options, ex_options)
+        # Json logs are parsed while rclone runs to follow the progress of the transfer
+        cmd = "rclone %s --links --ignore-existing -v --use-json-log --stats %ss --config '%s' '%s' '%s' %s %s %s" % (rclone_cmd, self.STATS_INTERVAL, tempRcloneConfig.name, src, dest, backend_specific_options, self.transfer_options(), ex_options)
         current_app.logger.info("Running command: %s" % cmd)
-        p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        output, err = p.communicate()
-        retcode = p.returncode
+
+        copied = []
+        transferred = 0
+        errors = []
+        p = Popen(shlex.split(cmd), stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+        try:
+            for line in p.stderr:
+                line = line.decode('utf-8', errors='replace').strip()
+                try:
+                    log = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    log = None
+                if not isinstance(log, dict):
+                    current_app.logger.info("rclone %s: %s" % (rclone_cmd, line))
+                    errors.append(line)
+                    continue
+
+                if 'stats' in log:
+                    transferred = int(log['stats'].get('bytes', 0))
+                    if progress:
+                        progress(self.format_progress(log['stats']))
+                    continue
+
+                current_app.logger.info("rclone %s: %s" % (rclone_cmd, line))
+                msg = log.get('msg', '')
+                if dry_run and msg.startswith('Skipped copy as --dry-run is set'):
+                    copied.append(log.get('object'))
+                elif not dry_run and 'Copied' in msg and log.get('object'):
+                    copied.append(log['object'])
+                elif log.get('level') == 'error':
+                    errors.append(msg)
+
+            retcode = p.wait()
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+            p.stderr.close()
+            tempRcloneConfig.close()
+            if filter_file is not None:
+                filter_file.close()
 
         current_app.logger.info("rclone %s exit code: %s" % (rclone_cmd, retcode))
-        current_app.logger.info("rclone %s stdout: %s" % (rclone_cmd, output))
-        current_app.logger.info("rclone %s stderr: %s" % (rclone_cmd, err))
 
         if retcode != 0:
-            raise RuntimeError("Rclone cmd was terminated by signal %s: can't copy %s (stderr: %s)" % (retcode, path, str(err)))
-        tempRcloneConfig.close()
+            raise RuntimeError("Rclone cmd was terminated by signal %s: can't copy %s (stderr: %s)" % (retcode, path, "\n".join(errors)))
 
-        return self.parse_copy_output(err, dry_run)
+        return (copied, transferred)
+
+    def daemon_pull(self, daemon, path, rel_path, is_single, path_filter, progress=None):
+        """
+        Copy files using the rclone daemon, and get the list of transferred files from its stats
+        """
+
+        group = "pull-%s" % uuid.uuid4()
+        remote = self.remote_prefix + rel_path
+
+        # We use IgnoreExisting to avoid deleting locally modified files (for example if a file was modified locally but the backup is not yet up-to-date)
+        # Run as an async job to follow the progress of the transfer
+        params = {
+            '_config': {'IgnoreExisting': True},
+            '_group': group,
+            '_async': True,
+        }
+        if is_single:
+            command = 'operations/copyfile'
+            params.update({
+                'srcFs': '%s:' % self.name,
+                'srcRemote': remote,
+                'dstFs': os.path.dirname(path),
+                'dstRemote': os.path.basename(path),
+            })
+        else:
+            command = 'sync/copy'
+            params.update({
+                'srcFs': '%s:%s' % (self.name, remote),
+                'dstFs': path,
+            })
+            if path_filter:
+                params['_filter'] = {'FilterRule': path_filter.rclone_rules(rel_path)}
+
+        current_app.logger.info("Running rclone daemon %s from %s:%s to %s" % (command, self.name, remote, path))
+        status, res = daemon.call(command, params)
+
+        if status != 200:
+            raise RuntimeError("Rclone daemon could not copy %s (error: %s)" % (path, res.get('error')))
+
+        # Poll quickly first, small files are copied in no time
+        job_id = res['jobid']
+        delay = 0.05
+        last_progress = 0
+        while True:
+            status, job = daemon.call('job/status', {'jobid': job_id})
+            if status != 200:
+                raise RuntimeError("Rclone daemon lost job %s copying %s (error: %s)" % (job_id, path, job.get('error')))
+
+            if job.get('finished'):
+                break
+
+            if progress and time.time() - last_progress >= self.STATS_INTERVAL:
+                status, stats = daemon.call('core/stats', {'group': group})
+                progress(self.format_progress(stats))
+                last_progress = time.time()
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+        current_app.logger.info("rclone daemon %s answer: %s" % (command, job))
+
+        status, transferred = daemon.call('core/transferred', {'group': group})
+        status, stats = daemon.call('core/stats', {'group': group})
+        daemon.call('core/stats-delete', {'group': group})
+
+        if not job.get('success'):
+            raise RuntimeError("Rclone daemon could not copy %s (error: %s)" % (path, job.get('error')))
+
+        if progress:
+            progress(self.format_progress(stats))
+
+        copied = [t['name'] for t in transferred.get('transferred', []) if not t.get('error')]
+
+        return (copied, int(stats.get('bytes', 0)))
 
 
 class SftpBackend(RcloneBackend):
+
+    DIR_MTIMES = True
+
     def __init__(self, conf):
         RcloneBackend.__init__(self, conf)
 
@@ -352,6 +711,7 @@ class SftpBackend(RcloneBackend):
         self.url = conf['url']
         self.user = conf['user']
         self.password = conf['password']
+        self.obscure_password = None
 
         self.name = 'sftp'
 
@@ -359,38 +719,27 @@ class SftpBackend(RcloneBackend):
         self.remote_host = url_split[0]
         self.remote_prefix = os.path.join(url_split[1], '')
 
-    def temp_rclone_config(self):
-        tempRcloneConfig = tempfile.NamedTemporaryFile('w+t')
-        tempRcloneConfig.write('[' + self.name + ']\n')
-        tempRcloneConfig.write('type = ' + self.name + '\n')
-        tempRcloneConfig.write('host = ' + self.remote_host + '\n')
-        tempRcloneConfig.seek(0)
+    def rclone_config(self):
+        config = '[' + self.name + ']\n'
+        config += 'type = ' + self.name + '\n'
+        config += 'host = ' + self.remote_host + '\n'
+        if 'sftp_concurrency' in self.transfer:
+            config += 'concurrency = ' + str(self.transfer['sftp_concurrency']) + '\n'
 
-        return tempRcloneConfig
+        return config
 
-    def remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False):
-        """
-        List content in a distant path
-        """
-        obscure_password = self.obscurify_password(self.password)
-        backend_specific_options = "--sftp-user '%s' --sftp-pass '%s'" % (self.user, obscure_password)
+    def backend_specific_options(self):
+        # Only run 'rclone obscure' once
+        if self.obscure_password is None:
+            self.obscure_password = self.obscurify_password(self.password)
 
-        return self.do_remote_list(repo, path, missing, max_depth, from_root, full, backend_specific_options)
+        return "--sftp-user '%s' --sftp-pass '%s'" % (self.user, self.obscure_password)
 
-    def remote_tree(self, repo, path, max_depth=1):
-        """
-        List content in a distant path, with missing files tagged with a '*'
-        """
-        obscure_password = self.obscurify_password(self.password)
-        backend_specific_options = "--sftp-user '%s' --sftp-pass '%s'" % (self.user, obscure_password)
+    def daemon_key(self):
+        return "%suser = %s\npass = %s\n" % (RcloneBackend.daemon_key(self), self.user, self.password)
 
-        return self.do_remote_tree(repo, path, max_depth, backend_specific_options)
-
-    def pull(self, repo, path, dry_run=False):
-        obscure_password = self.obscurify_password(self.password)
-        backend_specific_options = "--sftp-user '%s' --sftp-pass '%s'" % (self.user, obscure_password)
-
-        return self.do_pull(repo, path, dry_run, backend_specific_options)
+    def cache_id(self):
+        return "%s:%s@%s" % (self.name, self.user, self.remote_host)
 
 
 class S3Backend(RcloneBackend):
@@ -419,32 +768,756 @@ class S3Backend(RcloneBackend):
         self.access_key_id = conf['access_key_id']
         self.secret_access_key = conf['secret_access_key']
 
-    def temp_rclone_config(self):
-        tempRcloneConfig = tempfile.NamedTemporaryFile('w+t')
-        tempRcloneConfig.write('[' + self.name + ']\n')
-        tempRcloneConfig.write('type = ' + self.name + '\n')
-        tempRcloneConfig.write('provider = ' + self.provider + '\n')
-        tempRcloneConfig.write('endpoint = ' + self.endpoint + '\n')
-        tempRcloneConfig.write('env_auth = false\n')  # Forcing to put identifiers here
-        tempRcloneConfig.write('access_key_id = ' + self.access_key_id + '\n')
-        tempRcloneConfig.write('secret_access_key = ' + self.secret_access_key + '\n')
-        tempRcloneConfig.seek(0)
+    def rclone_config(self):
+        config = '[' + self.name + ']\n'
+        config += 'type = ' + self.name + '\n'
+        config += 'provider = ' + self.provider + '\n'
+        config += 'endpoint = ' + self.endpoint + '\n'
+        config += 'env_auth = false\n'  # Forcing to put identifiers here
+        config += 'access_key_id = ' + self.access_key_id + '\n'
+        config += 'secret_access_key = ' + self.secret_access_key + '\n'
+        if 's3_upload_concurrency' in self.transfer:
+            config += 'upload_concurrency = ' + str(self.transfer['s3_upload_concurrency']) + '\n'
 
-        return tempRcloneConfig
+        return config
+
+    def cache_id(self):
+        return "%s:%s@%s" % (self.name, self.access_key_id, self.endpoint)
+
+
+class TransferStats():
+    """
+    Progress of a transfer, updated from several threads or coroutines
+    """
+
+    def __init__(self, total_bytes, total_files):
+
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.bytes = 0
+        self.copied = []
+        self.errors = []
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add_bytes(self, num):
+
+        with self.lock:
+            self.bytes += num
+
+    def file_done(self, name):
 
-    def remote_list(self, repo, path, missing=False, max_depth=1, from_root=False, full=False):
+        with self.lock:
+            self.copied.append(name)
+
+    def error(self, message):
+
+        with self.lock:
+            self.errors.append(message)
+
+    def progress(self):
         """
-        List content in a distant path
+        Get the progress of the transfer, in the same format as RcloneBackend.format_progress()
         """
 
-        return self.do_remote_list(repo, path, missing, max_depth, from_root, full)
+        with self.lock:
+            elapsed = time.time() - self.start
+            speed = self.bytes / elapsed if elapsed > 0 else 0
+            return {
+                'bytes': self.bytes,
+                'total_bytes': self.total_bytes,
+                'files': len(self.copied),
+                'total_files': self.total_files,
+                'speed': speed,
+                'eta': int((self.total_bytes - self.bytes) / speed) if speed > 0 else None,
+            }
 
-    def remote_tree(self, repo, path, max_depth=1):
+
+class NativeBackend(Backend):
+    """
+    Base class for backends talking directly to the remote, without rclone
+    """
+
+    def __init__(self, conf):
+        Backend.__init__(self, conf)
+
+        self.transfer = conf.get('transfer', {})
+        self.transfers = self.transfer.get('transfers', 4)
+
+    def walk(self, rel_path, max_depth=1):
         """
-        List content in a distant path, with missing files tagged with a '*'
+        List a distant path, like 'rclone lsjson -R' would do (a single file is listed relative to its parent dir)
+
+        :type rel_path: str
+        :param rel_path: path relative to the repo root
+
+        :rtype: generator
+        :return: dicts like in iter_raw_list()
+        """
+        raise NotImplementedError()
+
+    def copy_files(self, files, stats):
+        """
+        Start copying files from the remote
+
+        :type files: list
+        :param files: tuples (remote path relative to repo root, raw entry, local path, name to report)
+
+        :type stats: TransferStats
+        :param stats: to update while copying
+
+        :rtype: concurrent.futures.Future
+        :return: a future finished when all the files are copied
+        """
+        raise NotImplementedError()
+
+    def iter_raw_list(self, repo, path, max_depth=1, refresh=False):
+
+        rel_path = repo.relative_path(path)
+
+        try:
+            max_depth = int(max_depth)
+        except ValueError:
+            max_depth = 1
+
+        return self.iter_cached(repo, self.remote_prefix + rel_path, max_depth, lambda: self.walk(rel_path, max_depth), refresh)
+
+    def pull(self, repo, path, dry_run=False, progress=None):
+
+        rel_path = repo.relative_path(path)
+
+        # Never trust the cache when pulling, the file may have been backed up recently
+        remote_stat = self.remote_stat(rel_path)
+
+        if remote_stat is None:
+            raise RuntimeError("File/directory not found on remote repository: %s" % (path))
+
+        # Like rclone copy/copyto with --ignore-existing and --links
+        to_copy = []
+        if not remote_stat['IsDir']:
+            if not os.path.lexists(path):
+                to_copy.append((rel_path, remote_stat, path, os.path.basename(path)))
+        else:
+            for entry in self.walk(rel_path, 0):
+                if entry['IsDir'] or repo.filter.is_excluded(os.path.join(rel_path, entry['Path'])):
+                    continue
+
+                local_name = entry['Path']
+                if local_name.endswith('.rclonelink'):
+                    local_name = local_name[:-11]
+                local_path = os.path.join(path, local_name)
+
+                if not os.path.lexists(local_path):
+                    to_copy.append((os.path.join(rel_path, entry['Path']), entry, local_path, local_name))
+
+        total_bytes = sum(entry['Size'] for remote, entry, local_path, name in to_copy if entry['Size'] > 0)
+
+        if dry_run:
+            for remote, entry, local_path, name in to_copy:
+                current_app.logger.info("Would copy %s to %s (dry-run mode)" % (remote, local_path))
+            return ([name for remote, entry, local_path, name in to_copy], total_bytes)
+
+        current_app.logger.info("Copying %s files (%s bytes) from %s:%s%s to %s" % (len(to_copy), total_bytes, self.name, self.remote_prefix, rel_path, path))
+
+        stats = TransferStats(total_bytes, len(to_copy))
+        future = self.copy_files(to_copy, stats)
+        while True:
+            try:
+                future.result(timeout=self.STATS_INTERVAL)
+                break
+            except concurrent.futures.TimeoutError:
+                if progress:
+                    progress(stats.progress())
+
+        if progress:
+            progress(stats.progress())
+
+        if stats.errors:
+            raise RuntimeError("Could not copy %s files from %s (errors: %s)" % (len(stats.errors), path, "; ".join(stats.errors[:10])))
+
+        return (stats.copied, stats.bytes)
+
+    def make_entry(self, rel_path, size, mtime, is_dir):
+        """
+        Build a raw listing entry, in the format of 'rclone lsjson'
+        """
+
+        name = os.path.basename(rel_path)
+        mime_type = 'inode/directory'
+        if not is_dir:
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+        return {
+            'Path': rel_path,
+            'Name': name,
+            'Size': -1 if is_dir else size,
+            'MimeType': mime_type,
+            'ModTime': datetime.datetime.fromtimestamp(mtime, tz=datetime.timezone.utc).isoformat(),
+            'IsDir': is_dir,
+        }
+
+    def entry_mtime(self, entry):
+
+        return dateutil.parser.isoparse(entry['ModTime']).timestamp()
+
+    def local_tmp_path(self, local_path):
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        return local_path + '.partial'
+
+    def finish_local_file(self, tmp_path, local_path, mtime):
+        """
+        Set the modification time of a downloaded file, and move it to its final place
+        """
+
+        os.utime(tmp_path, (mtime, mtime))
+        os.rename(tmp_path, local_path)
+
+    def make_local_link(self, target, local_path, mtime):
+        """
+        Create a symlink backed up by rclone --links (as a .rclonelink file)
+        """
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        os.symlink(target, local_path)
+        os.utime(local_path, (mtime, mtime), follow_symlinks=False)
+
+
+class NativeSftpBackend(NativeBackend):
+    """
+    SFTP backend using persistent asyncssh sessions instead of rclone
+    """
+
+    DIR_MTIMES = True
+
+    # Number of times a file is retried after the connection was lost while copying it
+    RECONNECT_RETRIES = 2
+
+    def __init__(self, conf):
+        NativeBackend.__init__(self, conf)
+
+        if asyncssh is None:
+            raise ValueError("The sftp_native backend requires the asyncssh python module")
+
+        if 'url' not in conf:
+            raise ValueError("Missing 'url' in backend config '%s'" % conf)
+
+        if 'user' not in conf:
+            raise ValueError("Missing 'user' in backend config '%s'" % conf)
+
+        if 'password' not in conf:
+            raise ValueError("Missing 'password' in backend config '%s'" % conf)
+
+        self.url = conf['url']
+        self.user = conf['user']
+        self.password = conf['password']
+
+        try:
+            self.port = int(conf.get('port', 22))
+        except ValueError:
+            raise ValueError("Invalid 'port' in backend config '%s'" % conf)
+
+        # Number of read requests sent at the same time for each file
+        self.max_requests = self.transfer.get('sftp_concurrency', 128)
+
+        self.name = 'sftp_native'
+
+        url_split = self.url.split(":")
+        self.remote_host = url_split[0]
+        self.remote_prefix = os.path.join(url_split[1], '')
+
+    def cache_id(self):
+        # Listings are the same as the ones from the rclone sftp backend
+        return "sftp:%s@%s" % (self.user, self.remote_host)
+
+    def remote_stat(self, rel_path):
+
+        if not rel_path.strip('/'):
+            # The root of the repo
+            return {'Path': '', 'Name': '', 'IsDir': True}
+
+        remote = (self.remote_prefix + rel_path).rstrip('/')
+
+        async def do_stat(clients):
+            try:
+                attrs = await clients[0].stat(remote)
+            except self.connection_errors():
+                # Reconnected by with_clients
+                raise
+            except asyncssh.SFTPError as err:
+                if err.code == asyncssh.FX_NO_SUCH_FILE:
+                    return None
+                raise RuntimeError("Could not stat %s on remote repository (error: %s)" % (rel_path, err))
+            return self.attrs_entry(os.path.basename(remote), attrs)
+
+        pool = current_app.sftp_pool
+        return pool.run(self.with_clients(pool, do_stat))
+
+    def walk(self, rel_path, max_depth=1):
+
+        remote_stat = self.remote_stat(rel_path)
+        if remote_stat is None:
+            raise RuntimeError("File/directory not found on remote repository: %s" % (rel_path))
+
+        if not remote_stat['IsDir']:
+            remote_stat['Path'] = remote_stat['Name']
+            yield remote_stat
+            return
+
+        pool = current_app.sftp_pool
+        clients = pool.run(pool.get_clients(self.remote_host, self.port, self.user, self.password))
+        remote = (self.remote_prefix + rel_path).rstrip('/') or '.'
+
+        num = 0
+        try:
+            for entry_path, attrs in pool.iter_walk(clients, remote, max_depth, current_app.logger):
+                num += 1
+                yield self.attrs_entry(entry_path, attrs)
+        except self.connection_errors():
+            # Entries come in no particular order: the listing can only be restarted if nothing was yielded yet
+            if num:
+                raise
+            pool.run(pool.forget(self.remote_host, self.port, self.user, self.password))
+            clients = pool.run(pool.get_clients(self.remote_host, self.port, self.user, self.password))
+            for entry_path, attrs in pool.iter_walk(clients, remote, max_depth, current_app.logger):
+                num += 1
+                yield self.attrs_entry(entry_path, attrs)
+
+        current_app.logger.info('Got %s entries from %s:%s' % (num, self.remote_host, remote))
+
+    def copy_files(self, files, stats):
+
+        pool = current_app.sftp_pool
+        # No app context in the loop thread
+        logger = current_app.logger
+
+        async def copy_all():
+            # Files are queued as the workers consume them
+            to_copy = asyncio.Queue(maxsize=self.transfers)
+            # Replaced by all the workers at once when the connection is lost
+            session = [await pool.get_clients(self.remote_host, self.port, self.user, self.password)]
+            reconnect_lock = asyncio.Lock()
+
+            async def reconnect(lost_clients):
+                async with reconnect_lock:
+                    # Only the first worker to notice reconnects
+                    if session[0] is lost_clients:
+                        await pool.forget(self.remote_host, self.port, self.user, self.password)
+                        session[0] = await pool.get_clients(self.remote_host, self.port, self.user, self.password)
+
+            async def copy(i, remote_rel_path, entry, local_path, name):
+                for attempt in range(self.RECONNECT_RETRIES + 1):
+                    clients = session[0]
+                    # Spread the transfers on all the channels
+                    client = clients[i % len(clients)]
+                    try:
+                        await self.copy_file(client, self.remote_prefix + remote_rel_path, entry, local_path, stats)
+                        stats.file_done(name)
+                        return
+                    except self.connection_errors() as err:
+                        if attempt == self.RECONNECT_RETRIES:
+                            stats.error("%s: %s" % (name, err))
+                            return
+                        logger.warning("Connection lost while copying %s, reconnecting: %s" % (name, err))
+                    except (asyncssh.SFTPError, OSError) as err:
+                        stats.error("%s: %s" % (name, err))
+                        return
+
+                    try:
+                        await reconnect(clients)
+                    except (asyncssh.Error, OSError) as err:
+                        stats.error("%s: could not reconnect: %s" % (name, err))
+                        return
+
+            async def worker(i):
+                while True:
+                    to_copy_file = await to_copy.get()
+                    if to_copy_file is None:
+                        return
+                    await copy(i, *to_copy_file)
+
+            workers = [asyncio.ensure_future(worker(i)) for i in range(self.transfers)]
+            try:
+                for to_copy_file in files:
+                    await to_copy.put(to_copy_file)
+                for worker_task in workers:
+                    await to_copy.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker_task in workers:
+                    worker_task.cancel()
+
+        return pool.submit(copy_all())
+
+    async def copy_file(self, client, remote, entry, local_path, stats):
+
+        mtime = self.entry_mtime(entry)
+
+        if remote.endswith('.rclonelink'):
+            async with client.open(remote, 'rb') as link_file:
+                target = await link_file.read()
+            self.make_local_link(target.decode('utf-8'), local_path, mtime)
+            stats.add_bytes(len(target))
+            return
+
+        tmp_path = self.local_tmp_path(local_path)
+        copied = [0]
+
+        def progress_handler(src, dst, done, total):
+            stats.add_bytes(done - copied[0])
+            copied[0] = done
+
+        try:
+            await client.get(remote, tmp_path, max_requests=self.max_requests, progress_handler=progress_handler)
+            self.finish_local_file(tmp_path, local_path, mtime)
+        except Exception:
+            # Counted again if the file is retried
+            stats.add_bytes(-copied[0])
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def connection_errors(self):
         """
-        return self.do_remote_tree(repo, path, max_depth)
+        Errors raised when the SSH connection of a session was lost (e.g. closed by the server while kept in the pool)
+        """
+
+        return (asyncssh.DisconnectError, asyncssh.ChannelOpenError, asyncssh.SFTPNoConnection, asyncssh.SFTPConnectionLost, ConnectionError)
+
+    async def with_clients(self, pool, func):
+        """
+        Run a coroutine function with the SFTP clients of the remote, reconnecting once if the connection was lost
+        """
+
+        clients = await pool.get_clients(self.remote_host, self.port, self.user, self.password)
+        try:
+            return await func(clients)
+        except self.connection_errors():
+            await pool.forget(self.remote_host, self.port, self.user, self.password)
+            clients = await pool.get_clients(self.remote_host, self.port, self.user, self.password)
+            return await func(clients)
+
+    def attrs_entry(self, rel_path, attrs):
+
+        is_dir = attrs.permissions is not None and stat.S_ISDIR(attrs.permissions)
+
+        return self.make_entry(rel_path, attrs.size, attrs.mtime or 0, is_dir)
+
+
+class NativeS3Backend(NativeBackend):
+    """
+    S3 backend using boto3 directly instead of rclone, downloading big objects with parallel ranged requests
+    """
+
+    def __init__(self, conf):
+        NativeBackend.__init__(self, conf)
+
+        if s3.boto3 is None:
+            raise ValueError("The s3_native backend requires the boto3 python module")
+
+        for key in ('endpoint', 'path', 'access_key_id', 'secret_access_key'):
+            if key not in conf:
+                raise ValueError("Missing '%s' in backend config '%s'" % (key, conf))
+
+        self.name = 's3_native'
+
+        self.endpoint = conf['endpoint']
+        self.region = conf.get('region')
+        self.remote_prefix = os.path.join(conf['path'], '')
+        self.access_key_id = conf['access_key_id']
+        self.secret_access_key = conf['secret_access_key']
+
+        self.bucket, self.key_prefix = self.remote_prefix.split('/', 1)
+
+        # Objects bigger than multi_thread_cutoff are downloaded with multi_thread_streams parallel ranged requests
+        self.streams = self.transfer.get('multi_thread_streams', 4)
+        self.multi_thread_cutoff = s3.parse_size(self.transfer.get('multi_thread_cutoff'), 256 * 1024 * 1024)
+        self.chunk_size = s3.parse_size(self.transfer.get('buffer_size'), 8 * 1024 * 1024)
+
+    def cache_id(self):
+        # Modification times come from S3 metadata with rclone, not from LastModified: don't share the cache with it
+        return "%s:%s@%s" % (self.name, self.access_key_id, self.endpoint)
+
+    def get_client(self):
+
+        return current_app.s3_pool.get(self.endpoint, self.access_key_id, self.secret_access_key, self.region)
+
+    def remote_stat(self, rel_path):
+
+        if not rel_path.strip('/'):
+            # The root of the repo
+            return {'Path': '', 'Name': '', 'IsDir': True}
+
+        key = (self.key_prefix + rel_path).rstrip('/')
+        client = self.get_client()
+
+        if not rel_path.endswith('/'):
+            try:
+                obj = client.head_object(Bucket=self.bucket, Key=key)
+                return self.make_entry(os.path.basename(key), obj['ContentLength'], obj['LastModified'].timestamp(), False)
+            except s3.botocore.exceptions.ClientError as err:
+                if err.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise RuntimeError("Could not stat %s on remote repository (error: %s)" % (rel_path, err))
+
+        # Maybe a directory
+        res = client.list_objects_v2(Bucket=self.bucket, Prefix=key + '/', MaxKeys=1)
+        if res.get('KeyCount', 0) == 0:
+            return None
+
+        # Prefixes have no modification time: the epoch, stable between listings (like in walk())
+        return self.make_entry(os.path.basename(key), -1, 0, True)
+
+    def walk(self, rel_path, max_depth=1):
+
+        remote_stat = self.remote_stat(rel_path)
+        if remote_stat is None:
+            raise RuntimeError("File/directory not found on remote repository: %s" % (rel_path))
+
+        if not remote_stat['IsDir']:
+            remote_stat['Path'] = remote_stat['Name']
+            yield remote_stat
+            return
+
+        prefix = os.path.join(self.key_prefix + rel_path.strip('/'), '') if rel_path.strip('/') else self.key_prefix
+
+        num = 0
+        for entry_path, obj in s3.iter_walk(self.get_client(), self.bucket, prefix, max_depth, concurrency=self.transfers * 2):
+            num += 1
+            if obj is None:
+                # Prefixes have no modification time
+                yield self.make_entry(entry_path, -1, 0, True)
+            else:
+                yield self.make_entry(entry_path, obj['Size'], obj['LastModified'].timestamp(), False)
+
+        current_app.logger.info('Got %s entries from %s/%s' % (num, self.bucket, prefix))
+
+    def copy_files(self, files, stats):
+
+        client = self.get_client()
+
+        def copy_all():
+            # Whole files and ranges are copied in separate pools: a file waiting for its ranges can't block them
+            with concurrent.futures.ThreadPoolExecutor(self.transfers) as file_executor, concurrent.futures.ThreadPoolExecutor(self.transfers * max(self.streams, 1)) as range_executor:
+                futures = []
+                for remote_rel_path, entry, local_path, name in files:
+                    futures.append(file_executor.submit(self.copy_file, client, range_executor, self.key_prefix + remote_rel_path, entry, local_path, name, stats))
+                concurrent.futures.wait(futures)
+
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(copy_all)
+        executor.shutdown(wait=False)
+
+        return future
+
+    def copy_file(self, client, range_executor, key, entry, local_path, name, stats):
+
+        try:
+            if key.endswith('.rclonelink'):
+                obj = client.get_object(Bucket=self.bucket, Key=key)
+                target = obj['Body'].read()
+                self.make_local_link(target.decode('utf-8'), local_path, self.object_mtime(obj, entry))
+                stats.add_bytes(len(target))
+            else:
+                self.download(client, range_executor, key, entry, local_path, stats)
+            stats.file_done(name)
+        except (s3.botocore.exceptions.BotoCoreError, s3.botocore.exceptions.ClientError, OSError) as err:
+            stats.error("%s: %s" % (name, err))
+
+    def download(self, client, range_executor, key, entry, local_path, stats):
+
+        size = entry['Size']
+        tmp_path = self.local_tmp_path(local_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                if size > 0:
+                    os.posix_fallocate(fd, 0, size)
+
+                if size <= self.multi_thread_cutoff or self.streams < 2:
+                    obj = self.get_range(client, key, 0, size, fd, stats)
+                else:
+                    # Concurrent ranged requests, each one writing at its own offset
+                    range_size = max(self.chunk_size, -(-size // self.streams))
+                    futures = [range_executor.submit(self.get_range, client, key, start, min(range_size, size - start), fd, stats) for start in range(0, size, range_size)]
+                    # All the ranges must be done with fd before it is closed, even if one of them failed
+                    concurrent.futures.wait(futures)
+                    # Raises the error of the first failed range, if any
+                    obj = [f.result() for f in futures][0]
+            finally:
+                os.close(fd)
+
+            self.finish_local_file(tmp_path, local_path, self.object_mtime(obj, entry))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def get_range(self, client, key, start, length, fd, stats):
+        """
+        Download a range of an object, writing it with pwrite as it arrives
+
+        :rtype: dict
+        :return: the answer of GetObject
+        """
+
+        kwargs = {'Bucket': self.bucket, 'Key': key}
+        if length > 0:
+            kwargs['Range'] = 'bytes=%s-%s' % (start, start + length - 1)
+
+        obj = client.get_object(**kwargs)
+        offset = start
+        for chunk in obj['Body'].iter_chunks(1024 * 1024):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            stats.add_bytes(len(chunk))
+
+        return obj
+
+    def object_mtime(self, obj, entry):
+        # rclone stores the original modification time in the metadata
+        if 'mtime' in obj.get('Metadata', {}):
+            try:
+                return float(obj['Metadata']['mtime'])
+            except ValueError:
+                pass
+
+        return self.entry_mtime(entry)
+
+
+class LocalBackend(NativeBackend):
+    """
+    Backend for remotes mounted on the local filesystem (NFS, Lustre, ...), copying with reflinks or copy_file_range when possible
+    """
+
+    DIR_MTIMES = True
+
+    def __init__(self, conf):
+        NativeBackend.__init__(self, conf)
+
+        if 'path' not in conf:
+            raise ValueError("Missing 'path' in backend config '%s'" % conf)
+
+        if not os.path.isabs(conf['path']):
+            raise ValueError("Backend path must be absolute in backend config '%s'" % conf)
+
+        self.name = 'local'
+        self.remote_prefix = os.path.join(conf['path'], '')
+
+    def cache_id(self):
+        # Listing a local mount is cheap
+        return None
+
+    def remote_stat(self, rel_path):
+
+        if not rel_path.strip('/'):
+            # The root of the repo
+            if not os.path.isdir(self.remote_prefix):
+                return None
+            return {'Path': '', 'Name': '', 'IsDir': True}
+
+        remote = (self.remote_prefix + rel_path).rstrip('/')
+        try:
+            st = os.stat(remote)
+        except FileNotFoundError:
+            return None
+        except OSError as err:
+            raise RuntimeError("Could not stat %s on remote repository (error: %s)" % (rel_path, err))
+
+        return self.stat_entry(os.path.basename(remote), st)
+
+    def walk(self, rel_path, max_depth=1):
+
+        remote_stat = self.remote_stat(rel_path)
+        if remote_stat is None:
+            raise RuntimeError("File/directory not found on remote repository: %s" % (rel_path))
+
+        if not remote_stat['IsDir']:
+            remote_stat['Path'] = remote_stat['Name']
+            yield remote_stat
+            return
+
+        remote = (self.remote_prefix + rel_path).rstrip('/') or '/'
+
+        num = 0
+        to_list = [('', 1)]
+        while to_list:
+            rel_dir, depth = to_list.pop()
+            subdirs = []
+            with os.scandir(os.path.join(remote, rel_dir)) as it:
+                for dir_entry in it:
+                    entry_path = os.path.join(rel_dir, dir_entry.name)
+                    try:
+                        # Follow symlinks, like the other backends
+                        st = dir_entry.stat()
+                    except FileNotFoundError:
+                        # Broken symlink, or removed while listing
+                        continue
+
+                    is_dir = stat.S_ISDIR(st.st_mode)
+                    if is_dir and (not max_depth or depth < max_depth):
+                        subdirs.append((entry_path, depth + 1))
+
+                    num += 1
+                    yield self.stat_entry(entry_path, st)
+
+            # Depth-first
+            to_list.extend(sorted(subdirs, reverse=True))
+
+        current_app.logger.info('Got %s entries from %s' % (num, remote))
+
+    def copy_files(self, files, stats):
+
+        # No app context in the copy threads
+        logger = current_app.logger
+
+        def copy_all():
+            with concurrent.futures.ThreadPoolExecutor(self.transfers) as executor:
+                futures = [executor.submit(self.copy_file, self.remote_prefix + remote_rel_path, local_path, name, stats, logger) for remote_rel_path, entry, local_path, name in files]
+                concurrent.futures.wait(futures)
+
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        future = executor.submit(copy_all)
+        executor.shutdown(wait=False)
+
+        return future
+
+    def copy_file(self, remote, local_path, name, stats, logger):
+
+        try:
+            if remote.endswith('.rclonelink'):
+                with open(remote, 'r') as link_file:
+                    target = link_file.read()
+                self.make_local_link(target, local_path, os.stat(remote).st_mtime)
+                stats.add_bytes(len(target))
+            else:
+                method = self.copy_regular_file(remote, local_path, stats)
+                logger.debug("Copied %s to %s (%s)" % (remote, local_path, method))
+            stats.file_done(name)
+        except OSError as err:
+            stats.error("%s: %s" % (name, err))
+
+    def copy_regular_file(self, remote, local_path, stats):
+        """
+        Copy a file with the fastest method available between the remote and the local filesystems
+
+        :rtype: str
+        :return: the copy method which was used (reflink, copy_file_range, sendfile or buffered)
+        """
+
+        tmp_path = self.local_tmp_path(local_path)
+        try:
+            with open(remote, 'rb') as src, open(tmp_path, 'wb') as dst:
+                st = os.fstat(src.fileno())
+                method = localfs.copy_fd(src.fileno(), dst.fileno(), st.st_size, stats.add_bytes)
+
+            self.finish_local_file(tmp_path, local_path, st.st_mtime)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return method
 
-    def pull(self, repo, path, dry_run=False):
+    def stat_entry(self, rel_path, st):
 
-        return self.do_pull(repo, path, dry_run)
+        return self.make_entry(rel_path, st.st_size, st.st_mtime, stat.S_ISDIR(st.st_mode))
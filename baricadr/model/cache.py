@@ -0,0 +1,244 @@
+import hashlib
+import json
+import time
+import uuid
+
+from flask import current_app
+
+import redis
+
+
+class ListingCache():
+    """
+    Cache of raw remote listings, stored in Redis to be shared between the web processes and the Celery workers
+
+    Each listing is a Redis list of json entries, written and read by chunks: a listing is never held completely in
+    memory. Its time and number of entries are stored in a separate key.
+    """
+
+    LRU_KEY = 'baricadr:listing-cache:lru'
+
+    # Number of entries written or read at once
+    CHUNK_SIZE = 1000
+
+    def __init__(self, redis_url, max_entries=1000, max_files=100000):
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.max_entries = max_entries
+        self.max_files = max_files
+
+    def _key(self, backend_id, remote_path, max_depth):
+        key = "%s|%s|%s" % (backend_id, remote_path.rstrip('/'), max_depth)
+        return 'baricadr:listing-cache:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _meta_key(self, key):
+        return '%s:meta' % key
+
+    def _path_key(self, backend_id, remote_path):
+        # Set of the keys of the listings of a path (one per max_depth)
+        key = "%s|%s" % (backend_id, remote_path.rstrip('/'))
+        return 'baricadr:listing-cache-path:%s' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, backend_id, remote_path, max_depth, max_age):
+        """
+        Get a listing from the cache
+
+        :type max_age: int
+        :param max_age: Ignore the cached listing if it is older than this (in seconds)
+
+        :rtype: generator
+        :return: the cached entries (read by chunks), or None if there is none
+        """
+
+        key = self._key(backend_id, remote_path, max_depth)
+        try:
+            meta = self.redis.get(self._meta_key(key))
+            if meta is None:
+                return None
+
+            meta = json.loads(meta.decode('utf-8'))
+            if time.time() - meta['time'] > max_age:
+                return None
+
+            self.redis.zadd(self.LRU_KEY, {key: time.time()})
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not read from listing cache: %s" % err)
+            return None
+
+        return self._iter_entries(key, meta['count'])
+
+    def _iter_entries(self, key, count):
+
+        for start in range(0, count, self.CHUNK_SIZE):
+            end = min(start + self.CHUNK_SIZE, count)
+            try:
+                chunk = self.redis.lrange(key, start, end - 1)
+            except redis.exceptions.RedisError as err:
+                raise RuntimeError("Could not read from listing cache: %s" % err)
+
+            # Evicted (or replaced by a shorter listing) while being read
+            if len(chunk) != end - start:
+                raise RuntimeError("Cached listing %s changed while being read" % key)
+
+            for entry in chunk:
+                yield json.loads(entry.decode('utf-8'))
+
+    def writer(self, backend_id, remote_path, max_depth, ttl):
+        """
+        Start writing a listing to the cache, replacing the cached one (if any) once it is complete
+
+        :type ttl: int
+        :param ttl: Time (in seconds) after which the listing expires
+
+        :rtype: ListingWriter
+        :return: add the entries to it, then commit it
+        """
+
+        return ListingWriter(self, self._key(backend_id, remote_path, max_depth), self._path_key(backend_id, remote_path), ttl)
+
+    def evict(self):
+        """
+        Evict the least recently used listings if the cache is full
+        """
+
+        overflow = self.redis.zcard(self.LRU_KEY) - self.max_entries
+        if overflow > 0:
+            evicted = self.redis.zrange(self.LRU_KEY, 0, overflow - 1)
+            pipe = self.redis.pipeline()
+            pipe.zrem(self.LRU_KEY, *evicted)
+            pipe.delete(*evicted)
+            pipe.delete(*[self._meta_key(key.decode('utf-8')) for key in evicted])
+            pipe.execute()
+
+    def invalidate(self, backend_id, remote_path):
+        """
+        Remove the cached listings (at any depth) of a path and of all its ancestors, which contain it
+
+        :type remote_path: str
+        :param remote_path: Full remote path which changed
+        """
+
+        paths = []
+        remote_path = remote_path.rstrip('/')
+        while remote_path:
+            paths.append(remote_path)
+            remote_path = remote_path.rsplit('/', 1)[0] if '/' in remote_path else ''
+        # The root of the remote
+        paths.append('')
+
+        try:
+            path_keys = [self._path_key(backend_id, path) for path in paths]
+            pipe = self.redis.pipeline()
+            for path_key in path_keys:
+                pipe.smembers(path_key)
+            keys = set(key for members in pipe.execute() for key in members)
+
+            pipe = self.redis.pipeline()
+            if keys:
+                pipe.zrem(self.LRU_KEY, *keys)
+                pipe.delete(*keys)
+                pipe.delete(*[self._meta_key(key.decode('utf-8')) for key in keys])
+            pipe.delete(*path_keys)
+            pipe.execute()
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not invalidate listing cache: %s" % err)
+
+
+class ListingWriter():
+    """
+    Listing written to the cache by chunks while it is produced, in a temporary key renamed once it is complete
+    """
+
+    def __init__(self, cache, key, path_key, ttl):
+
+        self.cache = cache
+        self.key = key
+        self.path_key = path_key
+        self.ttl = ttl
+        self.tmp_key = '%s:tmp:%s' % (key, uuid.uuid4().hex)
+        self.chunk = []
+        self.count = 0
+        self.aborted = False
+
+    def add(self, entry):
+        """
+        Add an entry to the listing
+
+        :rtype: bool
+        :return: False if the listing will not be cached (too big, or Redis error)
+        """
+
+        if self.aborted:
+            return False
+
+        self.count += 1
+        if self.count > self.cache.max_files:
+            # Too big to be cached
+            self.abort()
+            return False
+
+        self.chunk.append(json.dumps(entry))
+        if len(self.chunk) >= self.cache.CHUNK_SIZE:
+            self._flush()
+
+        return not self.aborted
+
+    def commit(self):
+        """
+        Replace the cached listing with this one, now complete
+        """
+
+        if self.aborted:
+            return
+
+        self._flush()
+        if self.aborted:
+            return
+
+        try:
+            pipe = self.cache.redis.pipeline()
+            if self.count:
+                pipe.rename(self.tmp_key, self.key)
+                pipe.expire(self.key, self.ttl)
+            else:
+                # Empty Redis lists don't exist
+                pipe.delete(self.key)
+            pipe.set(self.cache._meta_key(self.key), json.dumps({'time': time.time(), 'count': self.count}), ex=self.ttl)
+            pipe.zadd(self.cache.LRU_KEY, {self.key: time.time()})
+            pipe.sadd(self.path_key, self.key)
+            pipe.expire(self.path_key, self.ttl)
+            pipe.execute()
+
+            self.cache.evict()
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not write to listing cache: %s" % err)
+            self.abort()
+
+    def abort(self):
+        """
+        Drop the listing written so far
+        """
+
+        self.aborted = True
+        self.chunk = []
+        try:
+            self.cache.redis.delete(self.tmp_key)
+        except redis.exceptions.RedisError:
+            # Expires with its ttl
+            pass
+
+    def _flush(self):
+
+        if not self.chunk:
+            return
+
+        try:
+            pipe = self.cache.redis.pipeline()
+            pipe.rpush(self.tmp_key, *self.chunk)
+            # Left behind if the listing is never completed
+            pipe.expire(self.tmp_key, self.ttl)
+            pipe.execute()
+            self.chunk = []
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not write to listing cache: %s" % err)
+            self.abort()
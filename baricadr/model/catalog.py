@@ -0,0 +1,442 @@
+import datetime
+import json
+import os
+import time
+from collections import defaultdict
+
+from baricadr.db_models import RemoteCatalog, RemoteCatalogDir, RemoteCatalogEntry
+from baricadr.extensions import db
+from baricadr.model.freeze_planner import parse_mtime_ns
+
+from flask import current_app
+
+from sqlalchemy.exc import IntegrityError
+
+
+class Catalog():
+    """
+    Snapshot of the remote files of a repository, stored in the database
+
+    An indexing (or refresh) claims the catalog with a conditional update of its indexing_started marker, renewed with
+    each batch: concurrent schedulers or workers never index (or refresh) the same catalog at the same time.
+    """
+
+    # Directories modified less than this number of seconds before being listed are listed again on next refresh
+    # (modification times may have a coarse resolution, and clocks of the remote may not be in sync)
+    MTIME_RESOLUTION = 60
+
+    # An indexing whose marker was not renewed for this long (in seconds) is considered dead (e.g. its worker crashed)
+    INDEXING_TIMEOUT = 900
+
+    def __init__(self, repo, interval=24, refresh_interval=0):
+
+        self.repo = repo
+        self.interval = interval  # In hours
+        self.refresh_interval = refresh_interval  # In minutes
+
+    def state(self):
+
+        return RemoteCatalog.query.filter_by(repo=self.repo.local_path).one_or_none()
+
+    def generation(self):
+        """
+        Get the generation of the catalog which can be queried, None if it was never indexed
+        """
+
+        state = self.state()
+        if state is None or not state.generation:
+            return None
+
+        return state.generation
+
+    def is_fresh(self):
+        """
+        Check if the catalog was indexed recently enough (within the indexing interval)
+        """
+
+        state = self.state()
+        if state is None or not state.generation or state.indexed is None:
+            return False
+
+        return datetime.datetime.utcnow() - state.indexed < datetime.timedelta(hours=self.interval)
+
+    def index(self, batch_size=5000):
+        """
+        Snapshot the whole remote tree into a new generation of the catalog, then drop the previous one
+
+        :rtype: int
+        :return: number of indexed files
+        """
+
+        # The marker is renewed with each batch, the claim time is the snapshot time
+        started = self._claim()
+        state = self.state()
+        if started is None:
+            raise RuntimeError("Catalog of repository %s is already being indexed (last progress at %s)" % (self.repo.local_path, state.indexing_started))
+
+        marker = started
+        generation = state.generation + 1
+        # Left behind by a dead indexing
+        self._drop_generations(RemoteCatalogEntry.generation >= generation, RemoteCatalogDir.generation >= generation)
+        db.session.commit()
+
+        num = 0
+        try:
+            # The root has no ModTime: it is always listed again on refresh
+            batch = []
+            dirs = [self._to_dir_row(generation, '', None)]
+            for entry in self.repo.backend.iter_raw_list(self.repo, self.repo.local_path, max_depth=0, refresh=True):
+                if entry['IsDir']:
+                    dirs.append(self._to_dir_row(generation, entry['Path'], entry.get('ModTime')))
+                else:
+                    batch.append(self._to_row(generation, entry['Path'], entry))
+
+                if len(batch) + len(dirs) >= batch_size:
+                    db.session.bulk_insert_mappings(RemoteCatalogEntry, batch)
+                    db.session.bulk_insert_mappings(RemoteCatalogDir, dirs)
+                    marker = self._renew(marker)
+                    num += len(batch)
+                    batch = []
+                    dirs = []
+
+            db.session.bulk_insert_mappings(RemoteCatalogEntry, batch)
+            db.session.bulk_insert_mappings(RemoteCatalogDir, dirs)
+            num += len(batch)
+
+            # Switch to the new generation (if still holding the claim), then cleanup the old one
+            if not self._release(marker, {RemoteCatalog.generation: generation, RemoteCatalog.indexed: started, RemoteCatalog.refreshed: started}):
+                raise RuntimeError("Catalog of repository %s was claimed by another indexing (stale for more than %s seconds)" % (self.repo.local_path, self.INDEXING_TIMEOUT))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Otherwise, the generation is being written by the new claimant
+            if self._release(marker):
+                self._drop_generations(RemoteCatalogEntry.generation == generation, RemoteCatalogDir.generation == generation)
+            db.session.commit()
+            raise
+
+        self._drop_generations(RemoteCatalogEntry.generation != generation, RemoteCatalogDir.generation != generation)
+        db.session.commit()
+
+        current_app.logger.info("Indexed %s remote files in the catalog of repository %s (generation %s)" % (num, self.repo.local_path, generation))
+
+        return num
+
+    def refresh(self, batch_size=5000):
+        """
+        Update the catalog with the remote changes since the last indexing or refresh, listing only the modified directories
+
+        With backends where the modification time of directories changes when entries are added, removed or renamed in
+        them (sftp, sftp_native, local), each known directory is only stat'ed, and listed again if its modification time
+        changed. S3 prefixes have no modification time: each one is listed again (without recursion). Only the changes
+        (new, modified or removed files in the listed directories) are written to the catalog.
+
+        The root is always listed again. Files rewritten in place (without changing the modification time of their
+        directory) are only updated at the next full indexing.
+
+        :rtype: int
+        :return: number of new or updated files
+        """
+
+        state = self.state()
+        if state is None or not state.generation:
+            raise RuntimeError("Catalog of repository %s was never indexed" % self.repo.local_path)
+
+        started = self._claim()
+        if started is None:
+            current_app.logger.info("Catalog of repository %s is being indexed, skipping refresh" % self.repo.local_path)
+            return 0
+
+        marker = started
+        generation = self.state().generation
+        dir_mtimes = self.repo.backend.DIR_MTIMES
+
+        # Directories are far less numerous than files, load them all
+        known = {}
+        children = defaultdict(list)
+        for dir_path, mod_time in RemoteCatalogDir.query.filter_by(repo=self.repo.local_path, generation=generation).with_entities(RemoteCatalogDir.path, RemoteCatalogDir.mod_time):
+            known[dir_path] = mod_time
+            if dir_path:
+                children[os.path.dirname(dir_path)].append(dir_path)
+
+        num = 0
+        removed = 0
+        listed = 0
+        pending = 0
+        try:
+            # Directories to check, with their ModTime if it was just seen in the listing of their parent
+            to_check = [('', None)]
+            while to_check:
+                rel_dir, mod_time = to_check.pop()
+
+                if dir_mtimes and rel_dir and mod_time is None:
+                    stat = self.repo.backend.remote_stat(rel_dir)
+                    if stat is None or not stat['IsDir']:
+                        removed += self._remove_tree(generation, rel_dir)
+                        continue
+                    mod_time = stat.get('ModTime')
+
+                if dir_mtimes and mod_time is not None and known.get(rel_dir) == mod_time:
+                    to_check.extend((child, None) for child in children[rel_dir])
+                    continue
+
+                dir_num, dir_removed, subdirs = self._list_dir(generation, rel_dir, mod_time)
+                num += dir_num
+                removed += dir_removed
+                listed += 1
+                pending += dir_num + dir_removed + 1
+
+                for removed_dir in set(children[rel_dir]) - set(subdirs):
+                    removed += self._remove_tree(generation, removed_dir)
+
+                to_check.extend(subdirs.items())
+
+                if pending >= batch_size or datetime.datetime.utcnow() - marker > datetime.timedelta(seconds=self.INDEXING_TIMEOUT / 3):
+                    marker = self._renew(marker)
+                    pending = 0
+
+            if not self._release(marker, {RemoteCatalog.refreshed: started}):
+                raise RuntimeError("Catalog of repository %s was claimed by an indexing (stale for more than %s seconds)" % (self.repo.local_path, self.INDEXING_TIMEOUT))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._release(marker)
+            db.session.commit()
+            raise
+
+        current_app.logger.info("Refreshed the catalog of repository %s: listed %s directories, %s new or updated files, %s removed files" % (self.repo.local_path, listed, num, removed))
+
+        return num
+
+    def _claim(self):
+        """
+        Mark the catalog as being indexed (or refreshed), unless another indexing or refresh is running (committed)
+
+        :rtype: datetime.datetime
+        :return: the time of the claim (the marker to renew), or None if the catalog is already claimed
+        """
+
+        if self.state() is None:
+            try:
+                db.session.add(RemoteCatalog(repo=self.repo.local_path, generation=0))
+                db.session.commit()
+            except IntegrityError:
+                # Created at the same time by someone else
+                db.session.rollback()
+
+        now = datetime.datetime.utcnow()
+        claimed = RemoteCatalog.query.filter(
+            RemoteCatalog.repo == self.repo.local_path,
+            db.or_(RemoteCatalog.indexing_started.is_(None), RemoteCatalog.indexing_started < now - datetime.timedelta(seconds=self.INDEXING_TIMEOUT))
+        ).update({RemoteCatalog.indexing_started: now}, synchronize_session=False)
+        db.session.commit()
+
+        return now if claimed else None
+
+    def _renew(self, marker):
+        """
+        Renew the claim on the catalog, committing the pending changes with it
+
+        :type marker: datetime.datetime
+        :param marker: value of the marker set by the last claim or renewal
+
+        :rtype: datetime.datetime
+        :return: the new marker
+        """
+
+        new_marker = datetime.datetime.utcnow()
+        renewed = RemoteCatalog.query.filter_by(repo=self.repo.local_path, indexing_started=marker).update({RemoteCatalog.indexing_started: new_marker}, synchronize_session=False)
+        if not renewed:
+            # Stale for too long: someone else claimed it, drop the pending changes
+            db.session.rollback()
+            raise RuntimeError("Catalog of repository %s was claimed by another indexing (stale for more than %s seconds)" % (self.repo.local_path, self.INDEXING_TIMEOUT))
+        db.session.commit()
+
+        return new_marker
+
+    def _release(self, marker, values=None):
+        """
+        Release the claim on the catalog if it is still held, updating other columns of its state with it (not committed)
+
+        :rtype: bool
+        :return: whether the claim was still held
+        """
+
+        updates = dict(values or {})
+        updates[RemoteCatalog.indexing_started] = None
+
+        return RemoteCatalog.query.filter_by(repo=self.repo.local_path, indexing_started=marker).update(updates, synchronize_session=False) > 0
+
+    def _list_dir(self, generation, rel_dir, mod_time):
+        """
+        List a remote directory (without recursion), writing the changes of its files to the catalog (not committed)
+
+        :type mod_time: str
+        :param mod_time: ModTime of the directory (None if unknown)
+
+        :rtype: tuple
+        :return: number of new or updated files, number of removed files, subdirectories (relative to the repo root) with their ModTime
+        """
+
+        files = {}
+        subdirs = {}
+        for entry in self.repo.backend.iter_raw_list(self.repo, os.path.join(self.repo.local_path, rel_dir), max_depth=1, refresh=True):
+            rel_path = os.path.join(rel_dir, entry['Path'])
+            if entry['IsDir']:
+                subdirs[rel_path] = entry.get('ModTime')
+            else:
+                row = self._to_row(generation, rel_path, entry)
+                files[row['path']] = row
+
+        query = RemoteCatalogEntry.query.filter_by(repo=self.repo.local_path, generation=generation, dir=rel_dir)
+        stale = []
+        for path, size, row_mod_time in query.with_entities(RemoteCatalogEntry.path, RemoteCatalogEntry.size, RemoteCatalogEntry.mod_time):
+            row = files.get(path)
+            if row is not None and row['size'] == size and row['mod_time'] == row_mod_time:
+                # Unchanged
+                del files[path]
+            else:
+                stale.append(path)
+
+        for i in range(0, len(stale), 5000):
+            query.filter(RemoteCatalogEntry.path.in_(stale[i:i + 5000])).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(RemoteCatalogEntry, list(files.values()))
+
+        dir_row = RemoteCatalogDir.query.filter_by(repo=self.repo.local_path, generation=generation, path=rel_dir).one_or_none()
+        mod_time = self._to_dir_row(generation, rel_dir, mod_time)['mod_time']
+        if dir_row is None:
+            db.session.add(RemoteCatalogDir(repo=self.repo.local_path, generation=generation, path=rel_dir, mod_time=mod_time))
+        else:
+            dir_row.mod_time = mod_time
+
+        # Modified files are removed, then inserted again
+        updated = len(set(stale) & files.keys())
+
+        return len(files), len(stale) - updated, subdirs
+
+    def _remove_tree(self, generation, rel_dir):
+        """
+        Remove a directory and all its content from the catalog (not committed)
+
+        :rtype: int
+        :return: number of removed files
+        """
+
+        RemoteCatalogDir.query.filter(
+            RemoteCatalogDir.repo == self.repo.local_path,
+            RemoteCatalogDir.generation == generation,
+            (RemoteCatalogDir.path == rel_dir) | ((RemoteCatalogDir.path >= rel_dir + '/') & (RemoteCatalogDir.path < rel_dir + '0'))
+        ).delete(synchronize_session=False)
+
+        return RemoteCatalogEntry.query.filter(
+            RemoteCatalogEntry.repo == self.repo.local_path,
+            RemoteCatalogEntry.generation == generation,
+            RemoteCatalogEntry.path >= rel_dir + '/',
+            RemoteCatalogEntry.path < rel_dir + '0'
+        ).delete(synchronize_session=False)
+
+    def _drop_generations(self, entry_filter, dir_filter):
+
+        RemoteCatalogEntry.query.filter(RemoteCatalogEntry.repo == self.repo.local_path, entry_filter).delete(synchronize_session=False)
+        RemoteCatalogDir.query.filter(RemoteCatalogDir.repo == self.repo.local_path, dir_filter).delete(synchronize_session=False)
+
+    def iter_remote_list(self, path, missing=False, max_depth=1, from_root=False, full=False):
+        """
+        Iterate over the files of a distant path, as seen in the catalog
+
+        Same parameters as Repo.remote_list()
+
+        :rtype: generator
+        :return: dicts with at least a 'Path' key (and the same informations as rclone lsjson if full is True), sorted by path (in code point order)
+        """
+
+        generation = self.generation()
+        if generation is None:
+            raise RuntimeError("Catalog of repository %s was never indexed" % self.repo.local_path)
+
+        rel_path = self.repo.relative_path(path).rstrip('/')
+
+        query = RemoteCatalogEntry.query.filter_by(repo=self.repo.local_path, generation=generation)
+
+        # Single file
+        single = query.filter(RemoteCatalogEntry.path == rel_path).one_or_none() if rel_path else None
+        if single is not None:
+            if missing and (os.path.exists(path) or self.repo.filter.is_excluded(rel_path)):
+                return
+            yield self._to_entry(single, rel_path if from_root else os.path.basename(rel_path), full)
+            return
+
+        prefix = os.path.join(rel_path, '') if rel_path else ''
+        if prefix:
+            # Everything starting with 'prefix/' ('0' comes right after '/')
+            query = query.filter(RemoteCatalogEntry.path >= prefix, RemoteCatalogEntry.path < prefix[:-1] + '0')
+
+        try:
+            max_depth = int(max_depth)
+        except ValueError:
+            max_depth = 1
+        if max_depth:
+            query = query.filter(RemoteCatalogEntry.depth < prefix.count('/') + max_depth)
+
+        local_files = None
+        if missing:
+            local_files = self.repo.local_file_set(path, max_depth)
+
+        for catalog_entry in query.order_by(RemoteCatalogEntry.path).yield_per(1000):
+            file_path = catalog_entry.path[len(prefix):]
+
+            if local_files is not None:
+                # Excluded files are never pulled: they are not missing (like Backend.iter_remote_list())
+                if file_path in local_files or self.repo.filter.is_excluded(os.path.join(prefix, file_path)):
+                    continue
+
+            yield self._to_entry(catalog_entry, catalog_entry.path if from_root else file_path, full)
+
+    def _to_row(self, generation, rel_path, entry):
+
+        if rel_path.endswith('.rclonelink'):
+            rel_path = rel_path[:-11]
+
+        return {
+            'repo': self.repo.local_path,
+            'generation': generation,
+            'path': rel_path,
+            'dir': os.path.dirname(rel_path),
+            'depth': rel_path.count('/'),
+            'size': entry.get('Size'),
+            'mod_time': entry.get('ModTime'),
+            'mime_type': entry.get('MimeType'),
+            'hashes': json.dumps(entry['Hashes']) if entry.get('Hashes') else None,
+        }
+
+    def _to_dir_row(self, generation, rel_path, mod_time):
+
+        # Listed again on next refresh: modified just before being listed (the modification time may not change after
+        # another modification), or no usable modification time
+        if mod_time is not None and (not self.repo.backend.DIR_MTIMES or time.time() - parse_mtime_ns(mod_time) / 10 ** 9 < self.MTIME_RESOLUTION):
+            mod_time = None
+
+        return {
+            'repo': self.repo.local_path,
+            'generation': generation,
+            'path': rel_path,
+            'mod_time': mod_time,
+        }
+
+    def _to_entry(self, catalog_entry, file_path, full):
+
+        if not full:
+            return {'Path': file_path}
+
+        entry = {
+            'Path': file_path,
+            'Name': os.path.basename(catalog_entry.path),
+            'Size': catalog_entry.size,
+            'MimeType': catalog_entry.mime_type,
+            'ModTime': catalog_entry.mod_time,
+            'IsDir': False,
+        }
+        if catalog_entry.hashes:
+            entry['Hashes'] = json.loads(catalog_entry.hashes)
+
+        return entry
@@ -0,0 +1,183 @@
+import json
+from datetime import datetime
+
+from baricadr.db_models import BaricadrTask
+from baricadr.extensions import db
+
+from celery.utils import uuid
+
+from flask import current_app
+
+
+class TaskDispatcher():
+    """
+    Send pull/freeze tasks to Celery, holding back the tasks which must wait for other tasks
+
+    Tasks are committed to the database before being sent, so workers always find them when they start.
+
+    A task waiting for other tasks is only recorded in the database (with the 'waiting' status), it is not sent to
+    Celery and does not hold a worker slot. Tasks publish their completion (finished, failed or removed) with
+    completed(), which sends the waiting tasks whose dependencies are all completed. send_ready() does the same for all
+    the waiting tasks, in case a completion was missed (e.g. a killed worker).
+    """
+
+    COMPLETED = ['finished', 'failed']
+
+    def submit(self, type, path, email=None, dry_run=False, evict=False, wait_for=None):
+        """
+        Submit a task, record it in the database and lock its path
+
+        :type type: str
+        :param type: 'pull' or 'freeze'
+
+        :type path: str
+        :param path: Absolute path to pull or freeze
+
+        :type email: list
+        :param email: Addresses to notify when the task is finished
+
+        :type wait_for: list
+        :param wait_for: Ids of the tasks which must be completed before this one starts
+
+        :rtype: str
+        :return: the task id
+        """
+
+        args = [path, email, [], dry_run]
+        kwargs = {'evict': True} if evict else {}
+
+        # The task is committed before being sent: it is always in the database when a worker starts it
+        task_id = uuid()
+        dbtask = BaricadrTask(path=path, type=type, task_id=task_id, args=json.dumps({'args': args, 'kwargs': kwargs}))
+        if wait_for:
+            dbtask.status = 'waiting'
+            dbtask.wait_for = json.dumps(wait_for)
+        db.session.add(dbtask)
+        current_app.path_locks.acquire(path, task_id)
+        db.session.commit()
+
+        if not wait_for:
+            self.send_task(type, args, kwargs, task_id)
+            return task_id
+
+        current_app.logger.debug("Task %s on '%s' is waiting for tasks %s" % (task_id, path, wait_for))
+
+        # The dependencies may have completed before the task was committed
+        if self.is_ready(dbtask):
+            self.send(dbtask)
+
+        return task_id
+
+    def submit_unless_touching(self, type, path, email=None, dry_run=False, evict=False):
+        """
+        Submit a task, unless a task already touches its path (or an upper directory), waiting for the tasks touching its subdirectories
+
+        Locks are checked and taken in the same transaction, under an advisory lock: concurrent requests on the same
+        path only create one task.
+
+        :rtype: tuple
+        :return: (the task id, or the id of the task already touching the path, whether a task was created)
+        """
+
+        current_app.path_locks.serialize()
+
+        touching_task_id = current_app.path_locks.touching(path)
+        if touching_task_id:
+            # Release the advisory lock
+            db.session.rollback()
+            return (touching_task_id, False)
+
+        wait_for = current_app.path_locks.locked_by_subdir(path)
+
+        return (self.submit(type, path, email=email, dry_run=dry_run, evict=evict, wait_for=wait_for), True)
+
+    def completed(self, task_id):
+        """
+        Send the tasks which were only waiting for a task which just completed (committed)
+
+        :rtype: int
+        :return: number of tasks sent
+        """
+
+        # Task ids are uuids, they can't be confused with other parts of the json
+        waiting = self._waiting().filter(BaricadrTask.wait_for.contains('"%s"' % task_id)).all()
+
+        return self._send_ready(waiting)
+
+    def send_ready(self):
+        """
+        Send all the waiting tasks whose dependencies are completed
+
+        :rtype: int
+        :return: number of tasks sent
+        """
+
+        return self._send_ready(self._waiting().all())
+
+    def is_ready(self, dbtask):
+        """
+        Check if the dependencies of a waiting task are all completed (or removed)
+        """
+
+        wait_for = json.loads(dbtask.wait_for) if dbtask.wait_for else []
+        if not wait_for:
+            return True
+
+        pending = BaricadrTask.query.filter(BaricadrTask.task_id.in_(wait_for), BaricadrTask.status.notin_(self.COMPLETED))
+
+        return pending.count() == 0
+
+    def send(self, dbtask):
+        """
+        Send a waiting task to Celery (unless someone else already did)
+
+        :rtype: bool
+        :return: whether the task was sent
+        """
+
+        task_id = dbtask.task_id
+        type = dbtask.type
+        path = dbtask.path
+        args = json.loads(dbtask.args)
+
+        # Claim the task: when several dependencies complete at the same time, only one of them sends it
+        claimed = BaricadrTask.query.filter_by(task_id=task_id, status='waiting').update({BaricadrTask.status: 'new'}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return False
+
+        self.send_task(type, args['args'], args['kwargs'], task_id)
+        current_app.logger.debug("Sent task %s on '%s', its dependencies are completed" % (task_id, path))
+
+        return True
+
+    def send_task(self, type, args, kwargs, task_id):
+        """
+        Send a task recorded in the database to Celery (failing it if it can't be sent)
+        """
+
+        try:
+            current_app.celery.send_task(type, args, kwargs, task_id=task_id)
+        except Exception as err:
+            # Never started: don't leave it in the database as a zombie holding its lock
+            dbtask = BaricadrTask.query.filter_by(task_id=task_id).one()
+            dbtask.status = 'failed'
+            dbtask.error = "Could not send the task to Celery: %s" % err
+            dbtask.finished = datetime.utcnow()
+            current_app.path_locks.release(task_id)
+            db.session.commit()
+            raise
+
+    def _waiting(self):
+
+        # Tasks waiting in a worker (submitted by older versions) have no args
+        return BaricadrTask.query.filter(BaricadrTask.status == 'waiting', BaricadrTask.args.isnot(None))
+
+    def _send_ready(self, waiting):
+
+        num = 0
+        for dbtask in waiting:
+            if self.is_ready(dbtask) and self.send(dbtask):
+                num += 1
+
+        return num
@@ -0,0 +1,219 @@
+import re
+import tempfile
+
+
+class PathFilter():
+    """
+    Exclude (and include) patterns of a repository, compiled once in a single regular expression
+
+    Patterns follow the rclone filtering syntax: '*' matches anything but '/', '**' matches anything, '?' matches any
+    character but '/', '[...]' is a character class and '{a,b}' a list of alternatives. Patterns starting with '/'
+    match paths from the repository root, others match the end of paths. 'dir/' is a shortcut for 'dir/**'.
+
+    A file is kept if it matches no exclude pattern, and (when include patterns are given) matches an include pattern.
+    A directory is pruned (not walked at all) if an exclude pattern matches everything in it ('dir/**').
+    """
+
+    def __init__(self, exclude=None, include=None):
+        """
+        :type exclude: str or list
+        :param exclude: Exclude patterns (comma separated if a string)
+
+        :type include: str or list
+        :param include: Include patterns (comma separated if a string)
+        """
+
+        self.exclude = _split_patterns(exclude)
+        self.include = _split_patterns(include)
+
+        # Raises re.error for malformed patterns
+        self._exclude_re = _compile(self.exclude)
+        self._include_re = _compile(self.include)
+        self._prune_re = _compile([pattern[:-3] for pattern in self.exclude if pattern.endswith('/**') and pattern[:-3].strip('/')])
+
+    def __bool__(self):
+
+        return bool(self.exclude or self.include)
+
+    def is_excluded(self, rel_path):
+        """
+        Check if a file is filtered out
+
+        :type rel_path: str
+        :param rel_path: Path of the file, relative to the repo root
+        """
+
+        if self._exclude_re is not None and self._exclude_re.match(rel_path):
+            return True
+
+        if self._include_re is not None and not self._include_re.match(rel_path):
+            return True
+
+        return False
+
+    def is_pruned(self, rel_dir):
+        """
+        Check if everything in a directory is filtered out
+
+        :type rel_dir: str
+        :param rel_dir: Path of the directory, relative to the repo root
+        """
+
+        return self._prune_re is not None and self._prune_re.match(rel_dir) is not None
+
+    def rclone_rules(self, rel_root=''):
+        """
+        Get the rules for rclone (--filter-from format) giving the same result, for a transfer rooted at rel_root
+
+        rclone matches patterns starting with '/' from the root of the transfer: they are rebased on it.
+
+        :type rel_root: str
+        :param rel_root: Root of the transfer, relative to the repo root
+
+        :rtype: list
+        :return: rules, one per line of a filter file
+        """
+
+        root_parts = [part for part in rel_root.split('/') if part]
+
+        rules = []
+        for prefix, patterns in (('-', self.exclude), ('+', self.include)):
+            for pattern in patterns:
+                rules.extend("%s %s" % (prefix, rebased) for rebased in _rebase(pattern, root_parts))
+
+        if self.include:
+            rules.append('- **')
+
+        return rules
+
+    def rclone_filter_file(self, rel_root=''):
+        """
+        Write the rclone rules in a temporary file, for --filter-from
+
+        :rtype: tempfile.NamedTemporaryFile
+        :return: the filter file (removed when closed)
+        """
+
+        filter_file = tempfile.NamedTemporaryFile('w+t')
+        filter_file.write("\n".join(self.rclone_rules(rel_root)) + "\n")
+        filter_file.flush()
+
+        return filter_file
+
+
+def _split_patterns(patterns):
+
+    if not patterns:
+        return []
+
+    if isinstance(patterns, str):
+        # Commas between braces separate alternatives, not patterns
+        patterns = re.split(r',(?![^{]*\})', patterns)
+
+    split = []
+    for pattern in patterns:
+        pattern = str(pattern).strip()
+        if not pattern:
+            continue
+        if pattern.endswith('/') and pattern.strip('/'):
+            pattern += '**'
+        split.append(pattern)
+
+    return split
+
+
+def _compile(patterns):
+
+    if not patterns:
+        return None
+
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith('/'):
+            regexes.append(_glob_to_regex(pattern[1:]))
+        else:
+            # Match the end of the path, on a component boundary
+            regexes.append('(?:.*/)?' + _glob_to_regex(pattern))
+
+    return re.compile('(?:%s)\\Z' % '|'.join(regexes), re.DOTALL)
+
+
+def _glob_to_regex(glob):
+    """
+    Translate a rclone glob into a regular expression
+    """
+
+    regex = ''
+    i = 0
+    while i < len(glob):
+        char = glob[i]
+        if char == '*':
+            if glob[i:i + 2] == '**':
+                regex += '.*'
+                i += 2
+                continue
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '\\' and i + 1 < len(glob):
+            i += 1
+            regex += re.escape(glob[i])
+        elif char == '[':
+            end = glob.find(']', i + 2)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                char_class = glob[i + 1:end]
+                if char_class.startswith('!'):
+                    char_class = '^' + char_class[1:]
+                regex += '[%s]' % char_class.replace('\\', '\\\\')
+                i = end
+        elif char == '{':
+            end = glob.find('}', i)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                regex += '(?:%s)' % '|'.join(_glob_to_regex(alternative) for alternative in glob[i + 1:end].split(','))
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return regex
+
+
+def _rebase(pattern, root_parts):
+    """
+    Rebase a pattern matching from the repo root on a subdirectory
+
+    :rtype: list
+    :return: patterns matching (from the subdirectory) the same paths in the subdirectory (none if the pattern can't match there)
+    """
+
+    if not pattern.startswith('/') or not root_parts:
+        return [pattern]
+
+    parts = pattern[1:].split('/')
+    for i, root_part in enumerate(root_parts):
+        if i >= len(parts):
+            return []
+
+        if parts[i] == '**':
+            # Matches any number of directories, including the remaining components of the root
+            rebased = ['/' + '/'.join(parts[i:])]
+            if parts[i + 1:]:
+                rebased.append('/' + '/'.join(parts[i + 1:]))
+            return rebased
+
+        if '**' in parts[i]:
+            # Approximation, rare
+            return ['/' + '/'.join(parts[i:])]
+
+        if not re.match(_glob_to_regex(parts[i]) + '\\Z', root_part, re.DOTALL):
+            return []
+
+    rest = parts[len(root_parts):]
+    if not rest:
+        return []
+
+    return ['/' + '/'.join(rest)]
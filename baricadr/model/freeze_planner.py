@@ -0,0 +1,367 @@
+import datetime
+import heapq
+import json
+import os
+import re
+import stat
+import tempfile
+import time
+from itertools import islice
+
+from baricadr.model.walker import TreeWalker
+
+import dateutil.parser
+
+import numpy
+
+RCLONE_TIME_RE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,9}))?(Z|[+-]\d\d:\d\d)$')
+
+
+class FreezePlanner():
+    """
+    Find the local files which can be freezed, by merge-joining the local tree with the remote listing
+
+    Both sides are walked in path order: the plan is linear in the number of local and remote files, and neither side
+    is loaded in memory (unsorted remote listings are sorted on disk, by chunks).
+    """
+
+    # Number of remote entries sorted in memory at once when the remote listing is not sorted
+    SORT_CHUNK_SIZE = 100000
+
+    # Number of candidate files evaluated at once
+    EVAL_BATCH_SIZE = 100000
+
+    # Tolerated delay (in seconds) between the local and remote modification times of a file
+    # Might need to be fine-tuned. Tests shows 0.22s
+    MTIME_TOLERANCE = 10
+
+    def __init__(self, repo, inventory=None):
+
+        self.repo = repo
+        # Read local files from this LocalInventory (up to date for the planned path) instead of walking the local tree
+        self.inventory = inventory
+
+    def plan(self, path, remote_entries, remote_sorted=False):
+        """
+        Match the local files in a path with their remote copy
+
+        :type path: str
+        :param path: Local path (file or directory) to freeze
+
+        :type remote_entries: iterable
+        :param remote_entries: dicts with 'Path' (relative to repo root) and 'ModTime' keys
+
+        :type remote_sorted: bool
+        :param remote_sorted: Whether remote_entries are already sorted by path (like in the catalog)
+
+        :rtype: generator
+        :return: tuples (local file path, remote ModTime, os.DirEntry-like object) for each local file which exists on the remote
+        """
+
+        remote = ((entry['Path'], entry['ModTime']) for entry in remote_entries)
+        if not remote_sorted:
+            remote = sort_on_disk(remote, self.SORT_CHUNK_SIZE)
+
+        local = self.iter_local_files(path)
+
+        remote_item = next(remote, None)
+        for rel_path, local_path, entry in local:
+            while remote_item is not None and remote_item[0] < rel_path:
+                remote_item = next(remote, None)
+
+            if remote_item is None:
+                return
+
+            if remote_item[0] == rel_path:
+                yield (local_path, remote_item[1], entry)
+
+    def evaluate(self, candidates, freeze_age, force=False):
+        """
+        Select the files to freeze among candidates, evaluating them by batches
+
+        :type candidates: iterable
+        :param candidates: tuples (local file path, remote ModTime, os.DirEntry-like object), as given by plan()
+
+        :type freeze_age: int
+        :param freeze_age: Minimum number of days since last access
+
+        :type force: bool
+        :param force: Whether to ignore atime
+
+        :rtype: tuple
+        :return: (local paths of the files to freeze, total size freed)
+        """
+
+        atime_cutoff = None if force else self.atime_cutoff(freeze_age)
+
+        freezables = []
+        freed_size = 0
+        for batch in self.iter_batches(candidates):
+            mask, atimes, sizes = self.evaluate_batch(batch, atime_cutoff)
+            freezables.extend(batch[i][0] for i in numpy.flatnonzero(mask))
+            freed_size += int(sizes[mask].sum())
+
+        return (freezables, freed_size)
+
+    def evict(self, candidates, min_age, to_free):
+        """
+        Select the least recently accessed files among candidates, until enough space is freed
+
+        :type candidates: iterable
+        :param candidates: tuples (local file path, remote ModTime, os.DirEntry-like object), as given by plan()
+
+        :type min_age: int
+        :param min_age: Never select files accessed less than this number of days ago
+
+        :type to_free: int
+        :param to_free: Number of bytes to free
+
+        :rtype: tuple
+        :return: (local paths of the files to freeze, from the least recently accessed, total size freed)
+        """
+
+        atime_cutoff = self.atime_cutoff(min_age)
+
+        paths = []
+        all_atimes = []
+        all_sizes = []
+        for batch in self.iter_batches(candidates):
+            mask, atimes, sizes = self.evaluate_batch(batch, atime_cutoff)
+            paths.extend(batch[i][0] for i in numpy.flatnonzero(mask))
+            all_atimes.append(atimes[mask])
+            all_sizes.append(sizes[mask])
+
+        if not paths:
+            return ([], 0)
+
+        atimes = numpy.concatenate(all_atimes)
+        sizes = numpy.concatenate(all_sizes)
+
+        # Oldest first, until the cumulated size reaches to_free
+        order = numpy.argsort(atimes, kind='stable')
+        freed = numpy.cumsum(sizes[order])
+        num = min(int(numpy.searchsorted(freed, to_free)) + 1, len(order))
+
+        return ([paths[i] for i in order[:num]], int(freed[num - 1]))
+
+    def atime_cutoff(self, days):
+        """
+        Get the time (epoch, in nanoseconds) before which files were last accessed more than a number of days ago
+
+        This is the local midnight of the day this number of days ago.
+        """
+
+        cutoff_date = datetime.date.today() - datetime.timedelta(days=days)
+
+        return int(time.mktime(cutoff_date.timetuple())) * 10 ** 9
+
+    def iter_batches(self, candidates):
+
+        candidates = iter(candidates)
+        while True:
+            batch = list(islice(candidates, self.EVAL_BATCH_SIZE))
+            if not batch:
+                break
+            yield batch
+
+    def evaluate_batch(self, batch, atime_cutoff=None):
+        """
+        Evaluate the freeze rules on a batch of candidates, as vector operations on their (nanosecond) timestamps
+
+        :type batch: list
+        :param batch: tuples (local file path, remote ModTime, os.DirEntry-like object)
+
+        :type atime_cutoff: int
+        :param atime_cutoff: Files accessed after this time (epoch, in nanoseconds) are not freezed (None to ignore atime)
+
+        :rtype: tuple
+        :return: (boolean mask of the files to freeze, array of atimes, array of sizes freed by each file)
+        """
+
+        valid = []
+        remote_mtimes = []
+        local_mtimes = []
+        atimes = []
+        sizes = []
+        for local_path, mod_time, entry in batch:
+            remote_mtime = parse_mtime_ns(mod_time) if mod_time else None
+            try:
+                # Cached by the scanner: a single lstat per file for the whole freeze
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                st = None
+
+            if remote_mtime is None or st is None:
+                valid.append(False)
+                remote_mtimes.append(0)
+                local_mtimes.append(0)
+                atimes.append(0)
+                sizes.append(0)
+                continue
+
+            valid.append(True)
+            remote_mtimes.append(remote_mtime)
+            local_mtimes.append(st.st_mtime_ns)
+            atimes.append(st.st_atime_ns)
+            # Freezing a symlink does not free anything
+            sizes.append(0 if stat.S_ISLNK(st.st_mode) else st.st_size)
+
+        remote_mtimes = numpy.array(remote_mtimes, dtype=numpy.int64)
+        local_mtimes = numpy.array(local_mtimes, dtype=numpy.int64)
+        atimes = numpy.array(atimes, dtype=numpy.int64)
+        sizes = numpy.array(sizes, dtype=numpy.int64)
+
+        # On mounts with relatime/noatime, the access tracker knows better
+        if atime_cutoff is not None:
+            tracked = self.repo.tracked_access_times([candidate[0] for candidate in batch])
+            if tracked:
+                tracked_atimes = numpy.array([tracked.get(candidate[0], 0) for candidate in batch], dtype=numpy.int64)
+                atimes = numpy.maximum(atimes, tracked_atimes)
+
+        # Not modified locally since pulled
+        mask = numpy.array(valid, dtype=bool) & (local_mtimes - remote_mtimes <= self.MTIME_TOLERANCE * 10 ** 9)
+
+        if atime_cutoff is not None:
+            mask &= atimes < atime_cutoff
+
+        return (mask, atimes, sizes)
+
+    def iter_local_files(self, path):
+        """
+        Scan the local files in a path, in the order of their path relative to repo root
+
+        Directories are listed, and files lstat'ed, in parallel by a TreeWalker: each file is only lstat'ed once for
+        the whole freeze. Symlinks to directories are not followed (they are seen as files, like rclone --links does).
+        With an inventory, files are read from it, and only stat'ed when evaluated.
+
+        :rtype: generator
+        :return: tuples (path relative to repo root, local path, os.DirEntry-like object)
+        """
+
+        if self.inventory is not None:
+            for rel_path in self.inventory.iter_files(path):
+                local_path = os.path.join(self.repo.local_path, rel_path)
+                yield (rel_path, local_path, PathEntry(local_path))
+            return
+
+        rel_root = self.repo.relative_path(path).rstrip('/')
+
+        try:
+            root_lstat = os.lstat(path)
+        except OSError:
+            return
+
+        # Like inside the tree, a symlink (even to a directory) is a file
+        if stat.S_ISREG(root_lstat.st_mode) or stat.S_ISLNK(root_lstat.st_mode):
+            yield (rel_root, path, PathEntry(path, root_lstat))
+            return
+
+        if not stat.S_ISDIR(root_lstat.st_mode):
+            return
+
+        def prune(sub_path):
+            # Excluded directories are not walked at all
+            return self.repo.filter.is_pruned(os.path.join(rel_root, sub_path) if rel_root else sub_path)
+
+        walker = TreeWalker(self.repo.walk_threads, prune=prune)
+        for sub_path, lstat in walker.walk(path, visit=_lstat, ordered=True):
+            local_path = os.path.join(path, sub_path)
+            yield (os.path.join(rel_root, sub_path) if rel_root else sub_path, local_path, PathEntry(local_path, lstat))
+
+
+class PathEntry():
+    """
+    Minimal os.DirEntry-like object for a path, caching its stat results
+    """
+
+    def __init__(self, path, lstat=None):
+
+        self.path = path
+        self.name = os.path.basename(path.rstrip('/'))
+        self._stat = {}
+        if lstat is not None:
+            self._stat[False] = lstat
+
+    def stat(self, follow_symlinks=True):
+
+        if follow_symlinks not in self._stat:
+            self._stat[follow_symlinks] = os.stat(self.path, follow_symlinks=follow_symlinks)
+
+        return self._stat[follow_symlinks]
+
+    def is_symlink(self):
+
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+
+def sort_on_disk(items, chunk_size):
+    """
+    Sort (path, value) tuples by path, keeping at most chunk_size tuples in memory
+
+    :rtype: generator
+    :return: the sorted tuples
+    """
+
+    chunk = []
+    chunk_files = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                chunk_files.append(_write_chunk(sorted(chunk, key=_path_key)))
+                chunk = []
+
+        chunk.sort(key=_path_key)
+        if not chunk_files:
+            yield from chunk
+            return
+
+        chunk_files.append(_write_chunk(chunk))
+        chunk = []
+
+        yield from heapq.merge(*[_read_chunk(chunk_file) for chunk_file in chunk_files], key=_path_key)
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
+def parse_mtime_ns(mod_time):
+    """
+    Convert a rclone ModTime (ISO 8601, up to nanoseconds) into an epoch in nanoseconds
+    """
+
+    # Much faster than dateutil for the usual rclone format (e.g. 2020-07-28T14:41:57.123456789+02:00)
+    match = RCLONE_TIME_RE.match(mod_time)
+    if match is None:
+        return int(dateutil.parser.isoparse(mod_time).timestamp() * 10 ** 9)
+
+    tz = '+00:00' if match.group(3) == 'Z' else match.group(3)
+    seconds = int(datetime.datetime.fromisoformat(match.group(1) + tz).timestamp())
+
+    return seconds * 10 ** 9 + int((match.group(2) or '').ljust(9, '0'))
+
+
+def _lstat(dir_fd, dir_entry):
+
+    return dir_entry.stat(follow_symlinks=False)
+
+
+def _path_key(item):
+
+    return item[0]
+
+
+def _write_chunk(chunk):
+
+    chunk_file = tempfile.TemporaryFile(mode='w+')
+    for item in chunk:
+        chunk_file.write(json.dumps(item) + '\n')
+    chunk_file.seek(0)
+
+    return chunk_file
+
+
+def _read_chunk(chunk_file):
+
+    for line in chunk_file:
+        yield tuple(json.loads(line))
@@ -0,0 +1,253 @@
+import os
+import time
+from collections import defaultdict
+
+from baricadr.db_models import LocalInventoryDir, LocalInventoryEntry
+from baricadr.extensions import db
+from baricadr.model.locks import advisory_lock
+
+from flask import current_app
+
+
+class LocalInventory():
+    """
+    Snapshot of the local files of a repository, stored in the database and rescanned incrementally
+
+    A directory is only listed again if its modification time changed since the last scan (i.e. if files were added,
+    removed or renamed in it). Metadata of files (size, mtime, atime) may be outdated: read them from the filesystem when
+    accuracy matters.
+
+    Changes are serialized per repository with an advisory lock held by each transaction: concurrent rescans (or pulls
+    and freezes) may do redundant work, but never insert the same rows twice.
+    """
+
+    # Directories modified less than this number of seconds before being listed are listed again on next scan
+    # (modification times may have a coarse resolution, e.g. on NFS)
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, repo, interval=60):
+
+        self.repo = repo
+        self.interval = interval  # In minutes
+
+    def is_scanned(self):
+        """
+        Check if the whole repository was scanned at least once
+        """
+
+        return LocalInventoryDir.query.filter_by(repo=self.repo.local_path, path='').first() is not None
+
+    def rescan(self, path=None, batch_size=5000):
+        """
+        Update the inventory of a path (the whole repository by default), listing only the modified directories
+
+        :rtype: int
+        :return: number of listed directories
+        """
+
+        rel_root = self.repo.relative_path(path).strip('/') if path else ''
+        if rel_root and not os.path.isdir(path):
+            # A single file
+            rel_root = os.path.dirname(rel_root)
+
+        # Directories are far less numerous than files, load them all
+        known = {}
+        children = defaultdict(list)
+        for dir_path, mtime in self._dir_query(rel_root).with_entities(LocalInventoryDir.path, LocalInventoryDir.mtime):
+            known[dir_path] = mtime
+            if dir_path:
+                children[os.path.dirname(dir_path)].append(dir_path)
+
+        listed = 0
+        pending = 0
+        to_scan = [rel_root]
+        while to_scan:
+            rel_dir = to_scan.pop()
+            full_dir = os.path.join(self.repo.local_path, rel_dir)
+
+            try:
+                st = os.stat(full_dir)
+            except FileNotFoundError:
+                self._remove_tree(rel_dir)
+                continue
+
+            if known.get(rel_dir) == st.st_mtime_ns:
+                to_scan.extend(children[rel_dir])
+                continue
+
+            subdirs = self._list_dir(rel_dir, full_dir, st)
+            listed += 1
+            pending += 1
+
+            for removed in set(children[rel_dir]) - set(subdirs):
+                self._remove_tree(removed)
+
+            to_scan.extend(subdirs)
+
+            if pending >= batch_size:
+                db.session.commit()
+                pending = 0
+
+        db.session.commit()
+
+        current_app.logger.info("Listed %s modified directories in the local inventory of repository %s" % (listed, self.repo.local_path))
+
+        return listed
+
+    def iter_files(self, path, max_depth=0):
+        """
+        Iterate over the files of a local path, as seen in the inventory
+
+        :type max_depth: int
+        :param max_depth: Restrict to a max depth. Set to 0 for all files.
+
+        :rtype: generator
+        :return: paths relative to the repo root, sorted (in code point order)
+        """
+
+        rel_path = self.repo.relative_path(path).strip('/')
+
+        query = LocalInventoryEntry.query.filter_by(repo=self.repo.local_path)
+
+        if rel_path:
+            single = query.filter(LocalInventoryEntry.path == rel_path).with_entities(LocalInventoryEntry.path).one_or_none()
+            if single is not None:
+                yield single[0]
+                return
+
+        prefix = os.path.join(rel_path, '') if rel_path else ''
+        if prefix:
+            # Everything starting with 'prefix/' ('0' comes right after '/')
+            query = query.filter(LocalInventoryEntry.path >= prefix, LocalInventoryEntry.path < prefix[:-1] + '0')
+
+        if max_depth:
+            query = query.filter(LocalInventoryEntry.depth < prefix.count('/') + max_depth)
+
+        for entry in query.with_entities(LocalInventoryEntry.path).order_by(LocalInventoryEntry.path).yield_per(5000):
+            yield entry[0]
+
+    def file_set(self, path, max_depth):
+        """
+        Get the set of local files in a path (relative to this path), like Repo.local_file_set()
+        """
+
+        rel_path = self.repo.relative_path(path).strip('/')
+        prefix_len = len(rel_path) + 1 if rel_path else 0
+
+        return set(file_path[prefix_len:] for file_path in self.iter_files(path, max_depth))
+
+    def add_files(self, paths):
+        """
+        Add (or update) local files in the inventory, e.g. after a pull
+        """
+
+        self._lock()
+
+        rows = {}
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            rel_path = self.repo.relative_path(path)
+            rows[rel_path] = self._to_row(rel_path, st)
+
+        rel_paths = list(rows.keys())
+        for i in range(0, len(rel_paths), 5000):
+            chunk = rel_paths[i:i + 5000]
+            LocalInventoryEntry.query.filter(LocalInventoryEntry.repo == self.repo.local_path, LocalInventoryEntry.path.in_(chunk)).delete(synchronize_session=False)
+            db.session.bulk_insert_mappings(LocalInventoryEntry, [rows[rel_path] for rel_path in chunk])
+        db.session.commit()
+
+    def remove_files(self, paths):
+        """
+        Remove local files from the inventory, e.g. after a freeze
+        """
+
+        self._lock()
+
+        rel_paths = [self.repo.relative_path(path) for path in paths]
+        for i in range(0, len(rel_paths), 5000):
+            LocalInventoryEntry.query.filter(LocalInventoryEntry.repo == self.repo.local_path, LocalInventoryEntry.path.in_(rel_paths[i:i + 5000])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _list_dir(self, rel_dir, full_dir, st):
+        """
+        List a directory, replacing its files in the inventory
+
+        :rtype: list
+        :return: subdirectories (relative to the repo root)
+        """
+
+        rows = []
+        subdirs = []
+        with os.scandir(full_dir) as it:
+            for dir_entry in it:
+                rel_path = os.path.join(rel_dir, dir_entry.name)
+                try:
+                    # Symlinks to directories are not followed, they are seen as files (like TreeWalker)
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        # Excluded directories are not scanned at all
+                        if not self.repo.filter.is_pruned(rel_path):
+                            subdirs.append(rel_path)
+                        continue
+                    rows.append(self._to_row(rel_path, dir_entry.stat(follow_symlinks=False)))
+                except FileNotFoundError:
+                    continue
+
+        self._lock()
+        LocalInventoryEntry.query.filter_by(repo=self.repo.local_path, dir=rel_dir).delete(synchronize_session=False)
+        if rows:
+            db.session.bulk_insert_mappings(LocalInventoryEntry, rows)
+
+        # Modified just before being listed: the modification time may not change after another modification
+        mtime = st.st_mtime_ns
+        if time.time() - st.st_mtime < self.MTIME_RESOLUTION:
+            mtime = -1
+
+        dir_row = LocalInventoryDir.query.filter_by(repo=self.repo.local_path, path=rel_dir).one_or_none()
+        if dir_row is None:
+            db.session.add(LocalInventoryDir(repo=self.repo.local_path, path=rel_dir, mtime=mtime))
+        else:
+            dir_row.mtime = mtime
+
+        return subdirs
+
+    def _remove_tree(self, rel_dir):
+
+        self._lock()
+        self._dir_query(rel_dir).delete(synchronize_session=False)
+
+        query = LocalInventoryEntry.query.filter_by(repo=self.repo.local_path)
+        if rel_dir:
+            query = query.filter(LocalInventoryEntry.path >= rel_dir + '/', LocalInventoryEntry.path < rel_dir + '0')
+        query.delete(synchronize_session=False)
+
+    def _lock(self):
+
+        # Reentrant: taken again by each change of a transaction
+        advisory_lock('baricadr:local-inventory:%s' % self.repo.local_path)
+
+    def _dir_query(self, rel_dir):
+        """
+        Query a directory and all its subdirectories
+        """
+
+        query = LocalInventoryDir.query.filter_by(repo=self.repo.local_path)
+        if rel_dir:
+            query = query.filter((LocalInventoryDir.path == rel_dir) | ((LocalInventoryDir.path >= rel_dir + '/') & (LocalInventoryDir.path < rel_dir + '0')))
+
+        return query
+
+    def _to_row(self, rel_path, st):
+
+        return {
+            'repo': self.repo.local_path,
+            'path': rel_path,
+            'dir': os.path.dirname(rel_path),
+            'depth': rel_path.count('/'),
+            'inode': st.st_ino,
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'atime': st.st_atime_ns,
+        }
@@ -0,0 +1,195 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+from baricadr.db_models import BaricadrTask
+from baricadr.extensions import db
+
+from flask import current_app
+
+import redis
+
+
+class TaskLeases():
+    """
+    Leases of the running pull/freeze tasks, renewed by their worker with their path locks
+
+    When a worker dies (e.g. killed by the OOM killer), the leases of its tasks expire after timeout seconds. The
+    reaper then requeues the pulls (copying files again is harmless), fails the freezes, and releases their locks.
+
+    Queued tasks ('new') have no lease: when no live worker received them queued_timeout seconds after they were sent
+    (e.g. their message was lost with a broker restart), they are sent again. Workers only start a task once.
+    """
+
+    RUNNING = ['started', 'pulling', 'freezing', 'waiting']
+
+    def __init__(self, timeout=60, max_requeues=3, queued_timeout=3600):
+        """
+        :type timeout: int
+        :param timeout: Number of seconds after which the lease of a running task expires if not renewed
+
+        :type max_requeues: int
+        :param max_requeues: Number of times a pull is requeued before being failed
+
+        :type queued_timeout: int
+        :param queued_timeout: Number of seconds after which a task sent to Celery, but not received by a live worker, is sent again
+        """
+
+        self.timeout = timeout
+        self.max_requeues = max_requeues
+        self.queued_timeout = queued_timeout
+
+    def expires(self):
+        """
+        Get the expiration date of a lease taken (or renewed) now
+        """
+
+        return datetime.utcnow() + timedelta(seconds=self.timeout)
+
+    def queued_expires(self):
+        """
+        Get the date after which a task sent (again) to Celery now is sent again if no live worker received it
+        """
+
+        return datetime.utcnow() + timedelta(seconds=self.queued_timeout)
+
+    def renew(self, task_id):
+        """
+        Renew the lease and the path locks of a running task (not committed)
+        """
+
+        BaricadrTask.query.filter_by(task_id=task_id).update({BaricadrTask.lease_expires: self.expires()}, synchronize_session=False)
+        current_app.path_locks.renew([task_id])
+
+    def keep_alive(self, app, task_id):
+        """
+        Renew the lease and the path locks of a running task in a background thread
+
+        :rtype: threading.Event
+        :return: set it to stop renewing the lease
+        """
+
+        stop = threading.Event()
+
+        def run():
+            with app.app_context():
+                while True:
+                    try:
+                        self.renew(task_id)
+                        db.session.commit()
+                    except Exception as err:
+                        app.logger.error("Could not renew the lease of task %s: %s" % (task_id, err))
+                        db.session.rollback()
+                    if stop.wait(self.timeout / 3):
+                        break
+                db.session.remove()
+
+        threading.Thread(target=run, daemon=True, name='lease_keep_alive').start()
+
+        return stop
+
+    def expired(self):
+        """
+        Find the running tasks whose lease expired (or which never had one, started by older versions), and the tasks
+        queued for too long
+
+        :rtype: list
+        :return: the tasks
+        """
+
+        now = datetime.utcnow()
+        running = db.and_(
+            BaricadrTask.status.in_(self.RUNNING),
+            db.or_(BaricadrTask.lease_expires < now, BaricadrTask.lease_expires.is_(None))
+        )
+        # lease_expires of a requeued task is the date it is sent again, other queued tasks were sent when created
+        queued = db.and_(
+            BaricadrTask.status == 'new',
+            db.or_(BaricadrTask.lease_expires < now, db.and_(BaricadrTask.lease_expires.is_(None), BaricadrTask.created < now - timedelta(seconds=self.queued_timeout)))
+        )
+        expired = BaricadrTask.query.filter(db.or_(running, queued))
+
+        # Waiting tasks with args were not sent to Celery yet (see TaskDispatcher)
+        return [dbtask for dbtask in expired if not (dbtask.status == 'waiting' and dbtask.args is not None)]
+
+    def reap(self):
+        """
+        Requeue or fail the running tasks whose lease expired, and release their locks. Send again the tasks queued for too long.
+
+        :rtype: tuple
+        :return: (number of requeued tasks, number of failed tasks)
+        """
+
+        expired = self.expired()
+        if not expired:
+            return (0, 0)
+
+        # A task still received by a live worker only lost its database connection for a while
+        try:
+            alive = current_app.workers.alive_tasks(dbtask.task_id for dbtask in expired)
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not read the worker registry, relying on leases only: %s" % err)
+            alive = set()
+
+        # Plain values: the tasks are expired from the session by each commit
+        expired = [(dbtask.task_id, dbtask.type, dbtask.path, dbtask.status, dbtask.lease_expires, dbtask.args, dbtask.requeues) for dbtask in expired]
+
+        requeued = 0
+        failed = 0
+        for task_id, type, path, status, lease_expires, args, requeues in expired:
+            if task_id in alive:
+                continue
+
+            args = json.loads(args) if args else None
+            # A queued task never started: sending it again is always harmless, and does not count as a requeue
+            queued = status == 'new'
+            requeue = args is not None and (queued or (type == 'pull' and requeues < self.max_requeues))
+
+            # Claim the task: concurrent reapers (one per web process) only handle it once
+            claim = BaricadrTask.query.filter_by(task_id=task_id, status=status, lease_expires=lease_expires)
+            if requeue and queued:
+                # Still locked, by the lock renewed for queued tasks
+                claimed = claim.update({BaricadrTask.lease_expires: self.queued_expires()}, synchronize_session=False)
+            elif requeue:
+                claimed = claim.update({
+                    BaricadrTask.status: 'new',
+                    BaricadrTask.lease_expires: self.queued_expires(),
+                    BaricadrTask.requeues: BaricadrTask.requeues + 1,
+                }, synchronize_session=False)
+            else:
+                claimed = claim.update({
+                    BaricadrTask.status: 'failed',
+                    BaricadrTask.error: "The worker running this task stopped responding",
+                    BaricadrTask.finished: datetime.utcnow(),
+                }, synchronize_session=False)
+
+            if not claimed:
+                db.session.rollback()
+                continue
+
+            if not (requeue and queued):
+                current_app.path_locks.release(task_id)
+            if requeue and not queued:
+                # Locked again like a newly submitted task
+                current_app.path_locks.acquire(path, task_id)
+            db.session.commit()
+
+            if requeue:
+                if queued:
+                    current_app.logger.warning("Task %s %s on path '%s' was not received by any worker, sending it again" % (task_id, type, path))
+                else:
+                    current_app.logger.warning("Task %s %s on path '%s' lost its worker, requeuing it" % (task_id, type, path))
+                try:
+                    current_app.task_dispatcher.send_task(type, args['args'], args['kwargs'], task_id)
+                except Exception as err:
+                    # Failed by send_task
+                    current_app.logger.error("Could not requeue task %s: %s" % (task_id, err))
+                    failed += 1
+                    continue
+                requeued += 1
+            else:
+                current_app.logger.warning("Task %s %s on path '%s' lost its worker, failing it" % (task_id, type, path))
+                current_app.task_dispatcher.completed(task_id)
+                failed += 1
+
+        return (requeued, failed)
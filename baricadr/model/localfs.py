@@ -0,0 +1,105 @@
+import errno
+import fcntl
+import os
+
+# ioctl(dest_fd, FICLONE, src_fd) shares all the blocks of src with dest (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Errors meaning that a copy method is not supported between two files (other filesystem, old kernel, ...)
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADF, errno.ETXTBSY)
+
+# Size of the chunks copied by each system call (to report progress regularly)
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Size of the buffer for buffered copies
+BUFFER_SIZE = 1024 * 1024
+
+
+def copy_fd(src_fd, dst_fd, size, progress=None):
+    """
+    Copy the content of a file to another one, avoiding copies to userspace when possible
+
+    Tries a reflink first, then copy_file_range (server-side copy on NFS 4.2, no copy at all on some
+    filesystems), then sendfile, and falls back to a buffered copy.
+
+    :type size: int
+    :param size: Size of the source file
+
+    :type progress: callable
+    :param progress: Called with each number of copied bytes
+
+    :rtype: str
+    :return: the copy method which was used
+    """
+
+    if _reflink(src_fd, dst_fd):
+        if progress:
+            progress(size)
+        return 'reflink'
+
+    for method, func in (('copy_file_range', getattr(os, 'copy_file_range', None)), ('sendfile', _sendfile)):
+        if func is None:
+            continue
+
+        try:
+            copied = _copy_loop(func, src_fd, dst_fd, 0, progress)
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_ERRORS:
+                raise
+            continue
+
+        if copied >= size:
+            return method
+
+        # Some filesystems (e.g. procfs-like or FUSE mounts) report 0 bytes copied: finish with a buffered copy
+        _buffered_copy(src_fd, dst_fd, copied, progress)
+        return method
+
+    _buffered_copy(src_fd, dst_fd, 0, progress)
+    return 'buffered'
+
+
+def _reflink(src_fd, dst_fd):
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as err:
+        if err.errno not in UNSUPPORTED_ERRORS and err.errno != errno.EPERM:
+            raise
+        return False
+
+    return True
+
+
+def _sendfile(src_fd, dst_fd, count, offset):
+
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _copy_loop(func, src_fd, dst_fd, offset, progress):
+
+    copied = 0
+    while True:
+        if func is _sendfile:
+            num = func(src_fd, dst_fd, CHUNK_SIZE, offset + copied)
+        else:
+            num = func(src_fd, dst_fd, CHUNK_SIZE, offset + copied, offset + copied)
+        if num == 0:
+            break
+        copied += num
+        if progress:
+            progress(num)
+
+    return copied
+
+
+def _buffered_copy(src_fd, dst_fd, offset, progress):
+
+    while True:
+        chunk = os.pread(src_fd, BUFFER_SIZE, offset)
+        if not chunk:
+            break
+        os.pwrite(dst_fd, chunk, offset)
+        offset += len(chunk)
+        if progress:
+            progress(len(chunk))
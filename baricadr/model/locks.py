@@ -0,0 +1,137 @@
+import os
+from datetime import datetime, timedelta
+
+from baricadr.db_models import BaricadrTask, PathLock
+from baricadr.extensions import db
+
+
+class PathLocks():
+    """
+    Locks on the paths touched by pull/freeze tasks, stored in the database
+
+    A path is touched by the tasks locking it or one of its ancestors (found with an indexed IN query on its ancestors,
+    O(depth)), and is waiting for the tasks locking one of its descendants (found with an indexed range query on the
+    path prefix). A lock expires when its task stops renewing it with its lease (e.g. when its worker was killed). Locks
+    of the tasks which did not start yet are renewed by the reaper of the web app, and expire after queued_timeout if
+    it stops renewing them.
+
+    Locks are checked and taken under a Postgres advisory lock (see serialize()), so concurrent requests on the same path
+    never both create a task.
+    """
+
+    # Statuses of the tasks which did not start yet
+    QUEUED = ['new', 'waiting']
+
+    def __init__(self, timeout=60, queued_timeout=86400):
+        """
+        :type timeout: int
+        :param timeout: Number of seconds after which the lock of a running task expires if not renewed
+
+        :type queued_timeout: int
+        :param queued_timeout: Number of seconds after which the lock of a task which did not start yet expires if not renewed
+        """
+
+        self.timeout = timeout
+        self.queued_timeout = queued_timeout
+
+    def touching(self, path):
+        """
+        Find a task locking a path or one of its ancestors
+
+        :rtype: str
+        :return: the task id, or None
+        """
+
+        lock = self._live().filter(PathLock.path.in_(_ancestors(path))).order_by(PathLock.id).first()
+
+        return lock.task_id if lock is not None else None
+
+    def locked_by_subdir(self, path):
+        """
+        Find the tasks locking a descendant of a path
+
+        :rtype: list
+        :return: the task ids
+        """
+
+        prefix = os.path.join(path, '')
+        # Everything starting with 'prefix/' ('0' comes right after '/')
+        locks = self._live().filter(PathLock.path >= prefix, PathLock.path < prefix[:-1] + '0').order_by(PathLock.id)
+
+        return [lock.task_id for lock in locks]
+
+    def acquire(self, path, task_id):
+        """
+        Lock a path for a task which was just submitted (added to the session, not committed)
+        """
+
+        self.serialize()
+
+        now = datetime.utcnow()
+
+        # Nobody needs the expired locks anymore
+        PathLock.query.filter(PathLock.expires < now).delete(synchronize_session=False)
+
+        db.session.add(PathLock(path=os.path.abspath(path), task_id=task_id, expires=now + timedelta(seconds=self.queued_timeout)))
+
+    def renew(self, task_ids):
+        """
+        Renew the locks of running tasks (not committed)
+        """
+
+        if not task_ids:
+            return
+
+        expires = datetime.utcnow() + timedelta(seconds=self.timeout)
+        PathLock.query.filter(PathLock.task_id.in_(task_ids)).update({PathLock.expires: expires}, synchronize_session=False)
+
+    def renew_queued(self):
+        """
+        Renew the locks of the tasks which did not start yet, queued in Celery or waiting for other tasks (not committed)
+
+        Queued tasks lost by Celery are failed or requeued by the reaper (see TaskLeases), their locks released.
+        """
+
+        expires = datetime.utcnow() + timedelta(seconds=self.queued_timeout)
+        queued = db.session.query(BaricadrTask.task_id).filter(BaricadrTask.status.in_(self.QUEUED))
+        PathLock.query.filter(PathLock.task_id.in_(queued)).update({PathLock.expires: expires}, synchronize_session=False)
+
+    def serialize(self):
+        """
+        Wait for the other transactions checking or taking locks, until the end of the current transaction
+        """
+
+        advisory_lock('baricadr:path-locks')
+
+    def release(self, task_id):
+        """
+        Release the locks of a task (not committed)
+        """
+
+        PathLock.query.filter_by(task_id=task_id).delete(synchronize_session=False)
+
+    def _live(self):
+
+        return PathLock.query.filter(PathLock.expires >= datetime.utcnow())
+
+
+def _ancestors(path):
+    """
+    Get a path and all its ancestors
+    """
+
+    path = os.path.abspath(path)
+    ancestors = [path]
+    while path != os.path.dirname(path):
+        path = os.path.dirname(path)
+        ancestors.append(path)
+
+    return ancestors
+
+
+def advisory_lock(name):
+    """
+    Take a Postgres advisory lock, held until the end of the current transaction (other transactions taking it wait)
+    """
+
+    db.session.execute(db.text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {'name': name})
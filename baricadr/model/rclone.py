@@ -0,0 +1,173 @@
+import atexit
+import hashlib
+import os
+import secrets
+import shlex
+import socket
+import tempfile
+import threading
+import time
+from subprocess import DEVNULL, Popen
+
+from flask import current_app
+
+import requests
+
+
+class RcloneDaemon():
+    """
+    A long-lived 'rclone rcd' process, driven through its local RC HTTP API
+    """
+
+    def __init__(self, config_content, options=""):
+
+        # The config file must live as long as the daemon
+        self.config_file = tempfile.NamedTemporaryFile('w+t')
+        self.config_file.write(config_content)
+        self.config_file.flush()
+
+        self.options = options
+        self.process = None
+        self.owner_pid = None
+        self.url = None
+        # Credentials of the RC API, generated for each daemon: other local users can reach the port
+        self.auth = None
+        self.session = None
+        self.session_pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Launch the rclone daemon on a free local port, and wait for it to answer
+        """
+
+        port = self._free_port()
+        cmd = ['rclone', 'rcd', '--rc-addr', '127.0.0.1:%s' % port, '--links', '--config', self.config_file.name]
+        cmd += shlex.split(self.options)
+
+        # Given in the environment, not on the command line where any local user could read them
+        self.auth = ('baricadr', secrets.token_urlsafe(32))
+        env = dict(os.environ, RCLONE_RC_USER=self.auth[0], RCLONE_RC_PASS=self.auth[1])
+
+        current_app.logger.info("Starting rclone daemon on port %s" % port)
+        self.process = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, env=env)
+        self.owner_pid = os.getpid()
+        self.url = 'http://127.0.0.1:%s/' % port
+
+        for i in range(50):
+            if self.process.poll() is not None:
+                break
+            try:
+                self._post('rc/noop', {})
+                return
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.2)
+
+        self.stop()
+        raise RuntimeError("Could not start rclone daemon (rclone rcd exited or did not answer on port %s)" % port)
+
+    def stop(self):
+        """
+        Terminate the daemon, if it was started by the current process
+        """
+
+        # No logging here, this is also called at exit, outside of the app context
+        if self.process is not None and self.owner_pid == os.getpid() and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+    def call(self, command, params=None):
+        """
+        Run a command on the daemon, (re)starting it if it is not reachable
+
+        :type command: str
+        :param command: RC command name (e.g. 'operations/list')
+
+        :type params: dict
+        :param params: parameters of the command
+
+        :rtype: tuple
+        :return: a tuple (http status code, decoded json answer)
+        """
+
+        if params is None:
+            params = {}
+
+        with self.lock:
+            if self.url is None:
+                self.start()
+            url = self.url
+
+        try:
+            return self._post(command, params)
+        except requests.exceptions.ConnectionError:
+            # The daemon died (or was started by a now gone parent process), start a new one
+            current_app.logger.warning("Rclone daemon on %s is not reachable, restarting it" % url)
+            with self.lock:
+                if self.url == url:
+                    self.start()
+            return self._post(command, params)
+
+    def _post(self, command, params):
+
+        # Sessions can't be shared with forked processes (celery/uwsgi workers)
+        if self.session is None or self.session_pid != os.getpid():
+            self.session = requests.Session()
+            self.session_pid = os.getpid()
+
+        res = self.session.post(self.url + command, json=params, auth=self.auth)
+        try:
+            return (res.status_code, res.json())
+        except ValueError:
+            return (res.status_code, {'error': res.text})
+
+    def _free_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+
+class RcloneDaemonPool():
+    """
+    Keep one rclone daemon per remote, shared by all the repos using this remote
+    """
+
+    def __init__(self):
+
+        self.daemons = {}
+        self.lock = threading.Lock()
+
+        atexit.register(self.stop_all)
+
+    def get(self, key, config_content, options_factory=None):
+        """
+        Get the daemon for a remote, creating it if needed
+
+        :type key: str
+        :param key: a string identifying the remote (including credentials)
+
+        :type config_content: str
+        :param config_content: content of the rclone config file to give to the daemon
+
+        :type options_factory: callable
+        :param options_factory: called when creating the daemon, returns a string of options for 'rclone rcd'
+
+        :rtype: RcloneDaemon
+        :return: the daemon for the remote
+        """
+
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        with self.lock:
+            if key not in self.daemons:
+                options = options_factory() if options_factory else ""
+                self.daemons[key] = RcloneDaemon(config_content, options)
+
+            return self.daemons[key]
+
+    def stop_all(self):
+
+        with self.lock:
+            for daemon in self.daemons.values():
+                daemon.stop()
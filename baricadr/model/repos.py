@@ -1,23 +1,27 @@
-import datetime
-import fnmatch
+import concurrent.futures
 import os
+import re
 import tempfile
 import time
 
-from baricadr.db_models import BaricadrTask
-from baricadr.utils import get_celery_tasks
-
-import dateutil.parser
+from baricadr.model.access_tracker import get_access_times
+from baricadr.model.catalog import Catalog
+from baricadr.model.filters import PathFilter
+from baricadr.model.freeze_planner import FreezePlanner, sort_on_disk
+from baricadr.model.inventory import LocalInventory
+from baricadr.model.walker import TreeWalker
 
 from flask import current_app
 
-from tzlocal import get_localzone
-
 import yaml
 
 
 class Repo():
 
+    # Number of pulled files above which they are fixed (atime, owner) in parallel
+    FIXUP_PARALLEL_MIN = 1000
+    FIXUP_WORKERS = 8
+
     def __init__(self, local_path, conf):
 
         if 'backend' not in conf:
@@ -32,6 +36,13 @@ class Repo():
         self.exclude = None
         if 'exclude' in conf:
             self.exclude = conf['exclude']
+        self.include = None
+        if 'include' in conf:
+            self.include = conf['include']
+        try:
+            self.filter = PathFilter(self.exclude, self.include)
+        except re.error as err:
+            raise ValueError("Malformed repository definition, invalid exclude or include pattern (%s) in '%s'" % (err, conf))
         self.conf = conf
 
         # Owner conf
@@ -59,6 +70,82 @@ class Repo():
 
             self.chown_gid = conf['chown_gid']
 
+        # Number of directories listed in parallel when walking local trees
+        self.walk_threads = 8
+        if 'walk_threads' in conf:
+            try:
+                conf['walk_threads'] = int(conf['walk_threads'])
+            except ValueError:
+                raise ValueError("Malformed repository definition, walk_threads must be an integer in '%s'" % conf)
+
+            if conf['walk_threads'] < 1 or conf['walk_threads'] > 256:
+                raise ValueError("Malformed repository definition, walk_threads must be an integer >0 and <=256 in '%s'" % conf)
+
+            self.walk_threads = conf['walk_threads']
+
+        # Remote listing cache
+        self.list_cache_ttl = 0
+        if 'list_cache_ttl' in conf:
+            try:
+                conf['list_cache_ttl'] = int(conf['list_cache_ttl'])
+            except ValueError:
+                raise ValueError("Malformed repository definition, list_cache_ttl must be an integer in seconds in '%s'" % conf)
+
+            if conf['list_cache_ttl'] < 0:
+                raise ValueError("Malformed repository definition, list_cache_ttl must be a positive integer in seconds in '%s'" % conf)
+
+            self.list_cache_ttl = conf['list_cache_ttl']
+
+        # Transfer tuning
+        self.transfer = {}
+        if 'transfer' in conf:
+            self.transfer = self._check_transfer_conf(conf)
+            conf['transfer'] = self.transfer
+
+        # Remote catalog
+        self.catalog = None
+        if 'catalog' in conf and conf['catalog'] is True:
+            catalog_interval = 24
+            if 'catalog_interval' in conf:
+                try:
+                    conf['catalog_interval'] = int(conf['catalog_interval'])
+                except ValueError:
+                    raise ValueError("Malformed repository definition, catalog_interval must be an integer in hours in '%s'" % conf)
+
+                if conf['catalog_interval'] < 1 or conf['catalog_interval'] > 10000:
+                    raise ValueError("Malformed repository definition, catalog_interval must be an integer in hours >0 and <10000 in '%s'" % conf)
+
+                catalog_interval = conf['catalog_interval']
+
+            catalog_refresh_interval = 0
+            if 'catalog_refresh_interval' in conf:
+                try:
+                    conf['catalog_refresh_interval'] = int(conf['catalog_refresh_interval'])
+                except ValueError:
+                    raise ValueError("Malformed repository definition, catalog_refresh_interval must be an integer in minutes in '%s'" % conf)
+
+                if conf['catalog_refresh_interval'] < 0:
+                    raise ValueError("Malformed repository definition, catalog_refresh_interval must be a positive integer in minutes in '%s'" % conf)
+
+                catalog_refresh_interval = conf['catalog_refresh_interval']
+            self.catalog = Catalog(self, catalog_interval, catalog_refresh_interval)
+
+        # Local inventory
+        self.inventory = None
+        if 'local_inventory' in conf and conf['local_inventory'] is True:
+            local_inventory_interval = 60
+            if 'local_inventory_interval' in conf:
+                try:
+                    conf['local_inventory_interval'] = int(conf['local_inventory_interval'])
+                except ValueError:
+                    raise ValueError("Malformed repository definition, local_inventory_interval must be an integer in minutes in '%s'" % conf)
+
+                if conf['local_inventory_interval'] < 1 or conf['local_inventory_interval'] > 100000:
+                    raise ValueError("Malformed repository definition, local_inventory_interval must be an integer in minutes >0 and <100000 in '%s'" % conf)
+
+                local_inventory_interval = conf['local_inventory_interval']
+            self.inventory = LocalInventory(self, local_inventory_interval)
+
         # Default behaviour should be non-freeze
         self.freezable = False
         if 'freezable' in conf and conf['freezable'] is True:
@@ -67,9 +154,16 @@ class Repo():
             if 'disable_atime_test' in conf and conf['disable_atime_test'] is True:
                 self.disable_atime_test = True
 
+            # Access times recorded with inotify by the workers
+            self.access_tracking = False
+            if 'access_tracking' in conf and conf['access_tracking'] is True:
+                self.access_tracking = True
+
             # Skip if not freezable
             if not perms['freezable']:
-                if self.disable_atime_test:
+                if self.access_tracking:
+                    current_app.logger.info("The local path '%s' does not support atime, using access times recorded by the access tracker." % local_path)
+                elif self.disable_atime_test:
                     current_app.logger.warning("The local path '%s' does not support atime, marking as freezable anyway because disable_atime_test is set." % local_path)
                 else:
                     raise ValueError("Malformed repository definition for local path '%s', this path does not support atime" % local_path)
@@ -102,14 +196,117 @@ class Repo():
                         raise ValueError("Malformed repository definition, auto_freeze_interval must be an integer in days >1 and <10000 in '%s'" % conf)
 
                 self.auto_freeze_interval = conf['auto_freeze_interval']
+
+            # Disk usage watermarks
+            self.high_watermark = None
+            self.low_watermark = None
+            if 'high_watermark' in conf or 'low_watermark' in conf:
+                if 'high_watermark' not in conf or 'low_watermark' not in conf:
+                    raise ValueError("Malformed repository definition, high_watermark and low_watermark must be set together in '%s'" % conf)
+
+                self.high_watermark = self._parse_watermark(conf, 'high_watermark')
+                self.low_watermark = self._parse_watermark(conf, 'low_watermark')
+
+                if self.high_watermark[0] == self.low_watermark[0] and self.low_watermark[1] >= self.high_watermark[1]:
+                    raise ValueError("Malformed repository definition, low_watermark must be lower than high_watermark in '%s'" % conf)
+
+                self.watermark_min_age = 2
+                if 'watermark_min_age' in conf:
+                    try:
+                        conf['watermark_min_age'] = int(conf['watermark_min_age'])
+                    except ValueError:
+                        raise ValueError("Malformed repository definition, watermark_min_age must be an integer in days in '%s'" % conf)
+
+                    if conf['watermark_min_age'] < 0 or conf['watermark_min_age'] > 10000:
+                        raise ValueError("Malformed repository definition, watermark_min_age must be an integer in days >=0 and <10000 in '%s'" % conf)
+
+                    self.watermark_min_age = conf['watermark_min_age']
+
+                self.watermark_interval = 10
+                if 'watermark_interval' in conf:
+                    try:
+                        conf['watermark_interval'] = int(conf['watermark_interval'])
+                    except ValueError:
+                        raise ValueError("Malformed repository definition, watermark_interval must be an integer in minutes in '%s'" % conf)
+
+                    if conf['watermark_interval'] < 1 or conf['watermark_interval'] > 10000:
+                        raise ValueError("Malformed repository definition, watermark_interval must be an integer in minutes >0 and <10000 in '%s'" % conf)
+
+                    self.watermark_interval = conf['watermark_interval']
         self.backend = current_app.backends.get_by_name(conf['backend'], conf)
 
+    def _parse_watermark(self, conf, key):
+        """
+        Parse a disk usage watermark: a percentage of the filesystem size (e.g. 90%), or a number of bytes (e.g. 500G)
+
+        :rtype: tuple
+        :return: ('percent', percentage) or ('bytes', number of bytes)
+        """
+
+        value = str(conf[key]).strip()
+        if value.endswith('%'):
+            try:
+                percent = float(value[:-1])
+            except ValueError:
+                raise ValueError("Malformed repository definition, %s must be a percentage (e.g. 90%%) or a size (e.g. 500G) in '%s'" % (key, conf))
+
+            if percent <= 0 or percent > 100:
+                raise ValueError("Malformed repository definition, %s must be a percentage >0 and <=100 in '%s'" % (key, conf))
+
+            return ('percent', percent)
+
+        match = re.match(r'^([0-9]+(\.[0-9]+)?)([kMGTP]?)$', value)
+        if match is None:
+            raise ValueError("Malformed repository definition, %s must be a percentage (e.g. 90%%) or a size (e.g. 500G) in '%s'" % (key, conf))
+
+        units = {'': 1, 'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+        return ('bytes', int(float(match.group(1)) * units[match.group(3)]))
+
+    def _check_transfer_conf(self, conf):
+
+        transfer = conf['transfer']
+        if not isinstance(transfer, dict):
+            raise ValueError("Malformed repository definition, transfer must be a dictionary in '%s'" % conf)
+
+        checked = {}
+        for key, value in transfer.items():
+            if key in ('transfers', 'checkers', 'multi_thread_streams', 'sftp_concurrency', 's3_upload_concurrency'):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError("Malformed repository definition, transfer option %s must be an integer in '%s'" % (key, conf))
+
+                if value < 0 or (value == 0 and key != 'multi_thread_streams'):
+                    raise ValueError("Malformed repository definition, transfer option %s must be a positive integer in '%s'" % (key, conf))
+            elif key in ('multi_thread_cutoff', 'buffer_size'):
+                value = str(value)
+                if not re.match(r'^[0-9]+(\.[0-9]+)?[bkmgtp]?$', value, re.IGNORECASE):
+                    raise ValueError("Malformed repository definition, transfer option %s must be a size (e.g. 250M) in '%s'" % (key, conf))
+            elif key == 'bwlimit':
+                # A bandwidth, or a timetable
+                value = str(value)
+                if not re.match(r'^[0-9a-z.:, -]+$', value, re.IGNORECASE):
+                    raise ValueError("Malformed repository definition, transfer option %s must be a rclone bandwidth limit (e.g. 10M) in '%s'" % (key, conf))
+            elif key == 'fast_list':
+                if not isinstance(value, bool):
+                    raise ValueError("Malformed repository definition, transfer option %s must be True or False in '%s'" % (key, conf))
+            else:
+                raise ValueError("Malformed repository definition, unknown transfer option %s in '%s'" % (key, conf))
+
+            if (key.startswith('sftp_') and conf['backend'] not in ('sftp', 'sftp_native')) or (key.startswith('s3_') and conf['backend'] not in ('s3', 's3_native')):
+                raise ValueError("Malformed repository definition, transfer option %s is not supported by backend %s in '%s'" % (key, conf['backend'], conf))
+
+            checked[key] = value
+
+        return checked
+
     def is_in_repo(self, path):
         path = os.path.join(path, "")
 
         return path.startswith(os.path.join(self.local_path, ""))
 
-    def pull(self, path, dry_run=False):
+    def pull(self, path, dry_run=False, progress=None):
         """
         Pull files from remote repository
 
@@ -118,48 +315,82 @@ class Repo():
 
         :type dry_run: bool
         :param dry_run: Do not pull anything, just print what would be done in normal mode.
+
+        :type progress: callable
+        :param progress: Called regularly with the progress of the transfer (a dict)
         """
-        res = self.backend.pull(self, path, dry_run=dry_run)
+        res = self.backend.pull(self, path, dry_run=dry_run, progress=progress)
 
         if not dry_run:
-            # Touch all pulled files to set atime to now (but not mtime)
-            self.touch_atime(path)
+            # The remote was listed afresh by the pull: cached listings of the path and its ancestors may be stale
+            self.backend.invalidate_cached(self, path)
+
+        if not dry_run and res[0]:
+            if os.path.isdir(path):
+                pulled = [os.path.join(path, name) for name in res[0]]
+            else:
+                pulled = [path]
+
+            # Set atime to now (but not mtime), and owner, of the pulled files only
+            self.fix_pulled_files(path, pulled)
 
-            # Set owner of pulled files
-            self.set_owner(path)
+            if self.inventory is not None:
+                self.inventory.add_files(pulled)
 
         return res
 
-    def touch_atime(self, path):
-        # Touch all pulled files to set atime to now (but not mtime)
-        current_app.logger.info("Setting atime to path '%s'" % path)
-        if os.path.isfile(path):
-            os.utime(path, (time.time(), os.lstat(path).st_mtime), follow_symlinks=False)
-        else:
-            for root, subdirs, files in os.walk(path):
-                for name in files:
-                    candidate = os.path.join(root, name)
-                    os.utime(candidate, (time.time(), os.lstat(candidate).st_mtime), follow_symlinks=False)
+    def fix_pulled_files(self, path, pulled):
+        """
+        Touch pulled files to set their atime to now (but not mtime), and change their owner (and the owner of the directories created for them)
+
+        :type path: str
+        :param path: Pulled path
+
+        :type pulled: list
+        :param pulled: Local paths of the files which were copied
+        """
 
-    def set_owner(self, path):
+        current_app.logger.info("Setting atime and owner of %s files pulled in path '%s'" % (len(pulled), path))
+
+        # Tuples (path, is a pulled file)
+        to_fix = [(file_path, True) for file_path in pulled]
         if self.chown_uid is not None or self.chown_gid is not None:
-            current_app.logger.info("Changing owner of path '%s'" % path)
-            if os.path.isfile(path):
-                os.chown(path, self.chown_uid if self.chown_uid is not None else -1,
-                         self.chown_gid if self.chown_gid is not None else -1, follow_symlinks=False)
-            else:
-                for root, subdirs, files in os.walk(path):
-                    for name in subdirs:
-                        candidate = os.path.join(root, name)
-                        os.chown(candidate, self.chown_uid if self.chown_uid is not None else -1,
-                                 self.chown_gid if self.chown_gid is not None else -1, follow_symlinks=False)
-                    for name in files:
-                        candidate = os.path.join(root, name)
-                        os.chown(candidate, self.chown_uid if self.chown_uid is not None else -1,
-                                 self.chown_gid if self.chown_gid is not None else -1, follow_symlinks=False)
+            # Parent directories, up to the pulled path (excluded)
+            parents = set()
+            for file_path in pulled:
+                parent = os.path.dirname(file_path)
+                while parent.startswith(path.rstrip('/') + '/') and parent not in parents:
+                    parents.add(parent)
+                    parent = os.path.dirname(parent)
+            to_fix.extend((parent, False) for parent in parents)
+
+        now = time.time_ns()
+        if len(to_fix) < self.FIXUP_PARALLEL_MIN:
+            for file_path, is_file in to_fix:
+                self._fix_pulled_file(file_path, is_file, now)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.FIXUP_WORKERS) as executor:
+                # Consume the results to raise errors
+                list(executor.map(lambda item: self._fix_pulled_file(item[0], item[1], now), to_fix))
+
+    def _fix_pulled_file(self, file_path, is_file, atime):
+
+        try:
+            st = os.lstat(file_path)
+        except FileNotFoundError:
+            # Removed meanwhile
+            return
+
+        if is_file:
+            os.utime(file_path, ns=(atime, st.st_mtime_ns), follow_symlinks=False)
+
+        uid = self.chown_uid if self.chown_uid is not None and st.st_uid != self.chown_uid else -1
+        gid = self.chown_gid if self.chown_gid is not None and st.st_gid != self.chown_gid else -1
+        if uid != -1 or gid != -1:
+            os.chown(file_path, uid, gid, follow_symlinks=False)
 
     def remote_is_single(self, path):
-        return self.backend.remote_path_number(self, path) == 1
+        return self.backend.remote_path_number(self, path, limit=2) == 1
 
     def relative_path(self, path):
         return path[len(self.local_path) + 1:]
@@ -184,8 +415,35 @@ class Repo():
         :return: list of files
         """
 
+        if self.use_catalog():
+            return list(self.catalog.iter_remote_list(path, missing, max_depth, from_root, full))
+
         return self.backend.remote_list(self, path, missing, max_depth, from_root, full)
 
+    def iter_remote_list(self, path, missing=False, max_depth=1, from_root=False, full=False, refresh=False):
+        """
+        Iterate over files from remote repository, without loading the whole listing in memory
+
+        Same parameters as remote_list()
+
+        :type refresh: bool
+        :param refresh: Do not use the catalog nor the cached listing (but update the cache)
+
+        :rtype: generator
+        :return: files, one at a time (sorted by path if missing is True)
+        """
+
+        if not refresh and self.use_catalog():
+            # Already sorted by path
+            return self.catalog.iter_remote_list(path, missing, max_depth, from_root, full)
+
+        files = self.backend.iter_remote_list(self, path, missing, max_depth, from_root, full, refresh)
+        if missing:
+            # Sorted like remote_list(), on disk by chunks to keep the memory usage bounded
+            return (entry for file_path, entry in sort_on_disk(((entry['Path'], entry) for entry in files), FreezePlanner.SORT_CHUNK_SIZE))
+
+        return files
+
     def remote_tree(self, path, max_depth=1):
         """
         List files from remote repository, with missing files tagged with a '*'
@@ -200,8 +458,100 @@ class Repo():
         :return: list of files
         """
 
+        if self.use_catalog():
+            remote_list = []
+            for entry in self.catalog.iter_remote_list(path, max_depth=max_depth):
+                remote_list.append({'Path': entry['Path'], 'missing': not os.path.exists(os.path.join(path, entry['Path']))})
+            return remote_list
+
         return self.backend.remote_tree(self, path, max_depth)
 
+    def disk_usage(self):
+        """
+        Get the usage of the filesystem hosting the repository
+
+        :rtype: tuple
+        :return: (used bytes, total bytes)
+        """
+
+        st = os.statvfs(self.local_path)
+        total = st.f_blocks * st.f_frsize
+
+        return ((st.f_blocks - st.f_bfree) * st.f_frsize, total)
+
+    def watermark_bytes(self, watermark, total):
+        """
+        Convert a watermark into a number of used bytes
+        """
+
+        if watermark[0] == 'percent':
+            return int(total * watermark[1] / 100)
+
+        return watermark[1]
+
+    def above_high_watermark(self):
+        """
+        Check if the filesystem hosting the repository is used above the high watermark
+        """
+
+        if not self.freezable or self.high_watermark is None:
+            return False
+
+        used, total = self.disk_usage()
+
+        return used >= self.watermark_bytes(self.high_watermark, total)
+
+    def tracked_access_times(self, paths):
+        """
+        Get the last access times recorded by the access tracker for some local files
+
+        :type paths: list
+        :param paths: Local paths of files
+
+        :rtype: dict
+        :return: local path => last access time (epoch, in nanoseconds), for files with a recorded access
+        """
+
+        if not self.freezable or not self.access_tracking:
+            return {}
+
+        rel_paths = {self.relative_path(path): path for path in paths}
+        times = get_access_times(self.local_path, list(rel_paths.keys()))
+
+        return {rel_paths[rel_path]: accessed for rel_path, accessed in times.items()}
+
+    def use_inventory(self):
+        """
+        Check if local files should be read from the local inventory (if enabled and scanned at least once)
+        """
+
+        return self.inventory is not None and self.inventory.is_scanned()
+
+    def local_file_set(self, path, max_depth):
+        """
+        Get the set of local files in a path (relative to this path), from the local inventory if possible
+        """
+
+        if self.use_inventory():
+            return self.inventory.file_set(path, max_depth)
+
+        if not os.path.isdir(path):
+            return set()
+
+        rel_root = self.relative_path(path).strip('/')
+
+        def prune(sub_path):
+            return self.filter.is_pruned(os.path.join(rel_root, sub_path) if rel_root else sub_path)
+
+        return set(rel_path for rel_path, _ in TreeWalker(self.walk_threads, max_depth, prune).walk(path))
+
+    def use_catalog(self):
+        """
+        Check if listings should be answered from the remote catalog (if enabled and indexed at least once)
+        """
+
+        return self.catalog is not None and self.catalog.generation() is not None
+
     def freeze(self, path, force=False, dry_run=False):
         """
         Remove files from local repository
@@ -224,27 +574,59 @@ class Repo():
         if not (force or self.freezable):
             return ([], 0)
 
-        remote_list = self.remote_list(path, max_depth=0, from_root=True, full=True)
+        planner, candidates, found, from_catalog = self._plan_freeze(path)
+        freezables, freezed_size = planner.evaluate(candidates, self.freeze_age if self.freezable else None, force)
 
-        if len(remote_list) == 0:
+        if not found[0]:
             # SFTP backend throws a RuntimeError when calling remote_list(), make sure we do the same for other backends
             raise RuntimeError("File/directory not found on remote repository: %s" % (path))
 
-        freezables = self._get_freezable(path, remote_list, force)
+        if from_catalog:
+            freezables, freezed_size = self._confirm_on_remote(freezables, freezed_size)
 
         current_app.logger.info("Freezable files: %s" % freezables)
 
-        freezed_size = 0
-        for tofreeze in freezables:
-            if not os.path.islink(tofreeze):
-                freezed_size += os.path.getsize(tofreeze)
+        self._freeze_files(freezables, dry_run)
 
-        for to_freeze in freezables:
-            if dry_run:
-                current_app.logger.info("Would freeze '%s' (dry-run mode)" % (to_freeze))
-            else:
-                current_app.logger.info("Freezing '%s'" % (to_freeze))
-                self._do_freeze(to_freeze)
+        return (freezables, freezed_size)
+
+    def evict(self, dry_run=False):
+        """
+        Freeze the least recently accessed files of the repository, until the disk usage falls below the low watermark
+
+        Files accessed less than watermark_min_age days ago are never freezed.
+
+        :type dry_run: bool
+        :param dry_run: Do not remove anything, just print what would be done in normal mode.
+
+        :rtype: list
+        :return: list of freezed files
+        """
+
+        if not self.freezable or self.high_watermark is None:
+            return ([], 0)
+
+        used, total = self.disk_usage()
+        to_free = used - self.watermark_bytes(self.low_watermark, total)
+
+        current_app.logger.info("Asked to evict files from '%s': %s bytes used, %s bytes to free" % (self.local_path, used, to_free))
+
+        if to_free <= 0:
+            return ([], 0)
+
+        planner, candidates, found, from_catalog = self._plan_freeze(self.local_path)
+        freezables, freezed_size = planner.evict(candidates, self.watermark_min_age, to_free)
+
+        if not found[0]:
+            raise RuntimeError("File/directory not found on remote repository: %s" % (self.local_path))
+
+        if from_catalog:
+            freezables, freezed_size = self._confirm_on_remote(freezables, freezed_size)
+
+        if freezed_size < to_free:
+            current_app.logger.warning("Could only find %s bytes to free in '%s' (needed %s bytes)" % (freezed_size, self.local_path, to_free))
+
+        self._freeze_files(freezables, dry_run)
 
         return (freezables, freezed_size)
 
@@ -273,84 +655,117 @@ class Repo():
 
         return perms
 
-    def _get_freezable(self, path, remote_list, force=False):
-        freezables = []
+    def _plan_freeze(self, path):
+        """
+        Find the local files which are also on the remote, in a path
 
-        excludes = []
-        if self.exclude:
-            excludes = self.exclude.split(',')
+        :rtype: tuple
+        :return: (FreezePlanner, generator of candidates not excluded (as given by FreezePlanner.plan()), a list whose first item tells if the remote path was found, once candidates are consumed, whether the remote files come from the catalog)
+        """
 
-        if os.path.exists(path) and os.path.isfile(path):
-            for ex in excludes:
-                if fnmatch.fnmatch(path, ex.strip()):
-                    current_app.logger.info("Found excluded path: %s with expression %s" % (path, ex.strip()))
-                    return
-            if self._can_freeze(path, remote_list, force):
-                freezables.append(path)
+        from_catalog = self.catalog is not None and self.catalog.is_fresh()
+        if from_catalog:
+            # The catalog is sorted by path
+            # Files backed up after the last indexing are not in the catalog, they will just not be freezed
+            remote_entries = self.catalog.iter_remote_list(path, max_depth=0, from_root=True, full=True)
+            remote_sorted = True
         else:
-            for root, subdirs, files in os.walk(path):
-                for name in files:
-                    candidate = os.path.join(root, name)
-                    current_app.logger.info("Evaluating freezable for path: %s " % (candidate))
-                    excluded = False
-                    for ex in excludes:
-                        if fnmatch.fnmatch(candidate, ex.strip()):
-                            current_app.logger.info("Found excluded path: %s with expression %s" % (candidate, ex.strip()))
-                            excluded = True
-                            break
-                    if not excluded and self._can_freeze(candidate, remote_list, force):
-                        freezables.append(candidate)
+            # Never trust the cache before deleting files (but refresh it)
+            remote_entries = self.iter_remote_list(path, max_depth=0, from_root=True, full=True, refresh=True)
+            remote_sorted = False
 
-        return freezables
+        found = [False]
 
-    def _can_freeze(self, file_to_check, remote_list, force):
-        """
-        Check if a file should be freezed or not
+        def check_found(entries):
+            for entry in entries:
+                found[0] = True
+                yield entry
 
-        :type file_to_check: str
-        :param file_to_check: Path of a file to check
+        def not_excluded(candidates):
+            for candidate in candidates:
+                if self.filter.is_excluded(self.relative_path(candidate[0])):
+                    current_app.logger.info("Found excluded path: %s" % (candidate[0]))
+                else:
+                    yield candidate
 
-        :type remote_list: list
-        :param remote_list: List of dicts containing informations about remote files (path, mtime)
+        inventory = None
+        if self.inventory is not None:
+            # Only list the directories modified since the last scan
+            self.inventory.rescan(path)
+            inventory = self.inventory
 
-        :type force: bool
-        :param force: Whether to ignore atime
+        planner = FreezePlanner(self, inventory)
+
+        return (planner, not_excluded(planner.plan(path, check_found(remote_entries), remote_sorted)), found, from_catalog)
 
-        :rtype: bool
-        :return: True if the file should be freezed
+    def _confirm_on_remote(self, freezables, freezed_size):
         """
+        Check that files selected from the catalog are still on the remote (they may have been removed since the last indexing)
 
-        relative_path = self.relative_path(file_to_check)
-        # Check if in remote list
-        remote_file = next((item for item in remote_list if item["Path"] == relative_path), None)
+        Each directory containing files to freeze is listed once on the remote (without its subdirectories).
 
-        if not remote_file:
-            return False
+        :rtype: tuple
+        :return: (the files still on the remote, total size freed)
+        """
 
-        # Check if modified since pulled
-        tz = get_localzone()
+        by_dir = {}
+        for to_freeze in freezables:
+            by_dir.setdefault(os.path.dirname(to_freeze), []).append(to_freeze)
 
-        last_modif_remote = dateutil.parser.isoparse(remote_file['ModTime'])
-        last_modif_local = datetime.datetime.fromtimestamp(os.lstat(file_to_check).st_mtime, tz=tz)
+        on_remote = set()
+        for local_dir, files in by_dir.items():
+            try:
+                names = self._remote_file_names(local_dir)
+            except Exception as err:
+                # Removed from the remote, or any listing error: never freeze files which may not be backed up
+                current_app.logger.warning("Could not list '%s' on the remote repository, not freezing its files: %s" % (local_dir, err))
+                continue
+            on_remote.update(to_freeze for to_freeze in files if os.path.basename(to_freeze) in names)
+
+        confirmed = []
+        for to_freeze in freezables:
+            if to_freeze in on_remote:
+                confirmed.append(to_freeze)
+                continue
 
-        current_app.logger.info("Checking if we should freeze '%s': local modification on '%s' , remote modification on '%s' => Delta is %s seconds" % (file_to_check, last_modif_local, last_modif_remote, (last_modif_local - last_modif_remote).total_seconds()))
+            current_app.logger.warning("File '%s' is in the catalog but not on the remote repository anymore, not freezing it" % (to_freeze))
+            try:
+                freezed_size -= os.path.getsize(to_freeze)
+            except OSError:
+                pass
 
-        # Assuming 10s delay? Maybe more? -> Might need to be fine-tuned. Tests shows 0.22s
-        if (last_modif_local - last_modif_remote).total_seconds() > 10:
-            return False
+        return (confirmed, freezed_size)
 
-        # Skip check if force
-        if force:
-            current_app.logger.info("Checking if we should freeze '%s' => force is set to True, freezing" % (file_to_check))
-            return True
+    def _remote_file_names(self, local_dir):
+        """
+        List the names of the files of a directory on the remote (never from the cache)
 
-        last_access = datetime.datetime.fromtimestamp(os.lstat(file_to_check).st_atime).date()
-        now = datetime.date.today()
-        delta = now - last_access
-        delta = delta.days
-        current_app.logger.info("Checking if we should freeze '%s' (freeze_age=%s): last accessed on %s (%s days ago) =>  %s" % (file_to_check, self.freeze_age, last_access, delta, (force or (delta > self.freeze_age))))
+        :rtype: set
+        :return: names of the files (symlinks backed up as .rclonelink files are named like the local symlinks)
+        """
+
+        names = set()
+        for entry in self.backend.iter_raw_list(self, local_dir, max_depth=1, refresh=True):
+            if entry['IsDir'] or '/' in entry['Path']:
+                continue
+            name = entry['Path']
+            if name.endswith('.rclonelink'):
+                name = name[:-11]
+            names.add(name)
+
+        return names
+
+    def _freeze_files(self, freezables, dry_run=False):
+
+        for to_freeze in freezables:
+            if dry_run:
+                current_app.logger.info("Would freeze '%s' (dry-run mode)" % (to_freeze))
+            else:
+                current_app.logger.info("Freezing '%s'" % (to_freeze))
+                self._do_freeze(to_freeze)
 
-        return delta > self.freeze_age
+        if self.inventory is not None and not dry_run:
+            self.inventory.remove_files(freezables)
 
     def _do_freeze(self, file_to_freeze):
         """
@@ -438,19 +853,7 @@ class Repos():
         Return False otherwise.
         """
 
-        cel_tasks = get_celery_tasks(current_app.celery)
-
-        running_tasks = BaricadrTask.query.all()
-        for rt in running_tasks:
-            if rt.finished is None and path.startswith(rt.path):
-                if rt.task_id in cel_tasks['active_tasks'] \
-                   or rt.task_id in cel_tasks['reserved_tasks'] \
-                   or rt.task_id in cel_tasks['scheduled_tasks']:
-
-                    # check if locked by a zombie task
-                    return rt.task_id
-
-        return False
+        return current_app.path_locks.touching(path) or False
 
     def is_locked_by_subdir(self, path):
         """
@@ -458,17 +861,4 @@ class Repos():
         Return an empty list otherwise.
         """
 
-        cel_tasks = get_celery_tasks(current_app.celery)
-
-        running_tasks = BaricadrTask.query.all()
-        locking = []
-        for rt in running_tasks:
-            if rt.finished is None and rt.path.startswith(path) and path != rt.path:
-                if rt.task_id in cel_tasks['active_tasks'] \
-                   or rt.task_id in cel_tasks['reserved_tasks'] \
-                   or rt.task_id in cel_tasks['scheduled_tasks']:
-
-                    # check if locked by a zombie task
-                    locking.append(rt.task_id)
-
-        return locking
+        return current_app.path_locks.locked_by_subdir(path)
@@ -0,0 +1,174 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+class S3ClientPool():
+    """
+    Boto3 clients, shared by all the repos using the same endpoint (and credentials), each one with its own HTTP connection pool
+    """
+
+    def __init__(self, max_connections=64):
+
+        self.max_connections = max_connections
+        self.clients = {}
+        self.clients_pid = None
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, access_key_id, secret_access_key, region=None):
+        """
+        Get the client for an endpoint, creating it if needed
+
+        :rtype: botocore.client.S3
+        :return: a (thread-safe) S3 client
+        """
+
+        key = (endpoint, access_key_id, secret_access_key, region)
+
+        with self.lock:
+            # Connections can't be shared with forked processes (celery/uwsgi workers)
+            if self.clients_pid != os.getpid():
+                self.clients = {}
+                self.clients_pid = os.getpid()
+
+            if key not in self.clients:
+                config = botocore.config.Config(
+                    max_pool_connections=self.max_connections,
+                    # Like rclone does for all providers but AWS
+                    s3={'addressing_style': 'path'},
+                    retries={'max_attempts': 5, 'mode': 'standard'},
+                )
+                self.clients[key] = boto3.session.Session().client(
+                    's3',
+                    endpoint_url=endpoint,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    region_name=region,
+                    config=config,
+                )
+
+            return self.clients[key]
+
+
+def iter_walk(client, bucket, prefix, max_depth=0, concurrency=8):
+    """
+    List a 'directory' of a bucket, listing its subdirectories in parallel
+
+    The first level is listed with a delimiter to split the work between subdirectories. When listing everything
+    (max_depth=0), each subdirectory is then listed without delimiter (in a single paginated listing).
+
+    :type prefix: str
+    :param prefix: Prefix of the keys to list (with a trailing '/', or empty)
+
+    :type max_depth: int
+    :param max_depth: Restrict to a max depth. Set to 0 for all files.
+
+    :rtype: generator
+    :return: tuples (key relative to prefix, object dict from ListObjectsV2, or None for directories)
+    """
+
+    results = queue.Queue(maxsize=64)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [0]
+    executor = ThreadPoolExecutor(concurrency)
+
+    def submit(sub_prefix, depth):
+        with lock:
+            pending[0] += 1
+        executor.submit(list_prefix, sub_prefix, depth)
+
+    def list_prefix(sub_prefix, depth):
+        try:
+            flat = not max_depth and depth > 1
+            kwargs = {'Bucket': bucket, 'Prefix': sub_prefix}
+            if not flat:
+                kwargs['Delimiter'] = '/'
+
+            # Directories implied by the keys of a flat listing
+            seen_dirs = set([sub_prefix[len(prefix):].rstrip('/')])
+
+            for page in client.get_paginator('list_objects_v2').paginate(**kwargs):
+                if stop.is_set():
+                    return
+
+                batch = []
+                for common_prefix in page.get('CommonPrefixes', []):
+                    batch.append((common_prefix['Prefix'][len(prefix):].rstrip('/'), None))
+                    if not max_depth or depth < max_depth:
+                        submit(common_prefix['Prefix'], depth + 1)
+
+                for obj in page.get('Contents', []):
+                    rel_key = obj['Key'][len(prefix):]
+                    if not rel_key or rel_key.endswith('/'):
+                        # Directory markers
+                        continue
+
+                    if flat:
+                        parent = os.path.dirname(rel_key)
+                        new_dirs = []
+                        while parent not in seen_dirs:
+                            seen_dirs.add(parent)
+                            new_dirs.append((parent, None))
+                            parent = os.path.dirname(parent)
+                        batch.extend(reversed(new_dirs))
+
+                    batch.append((rel_key, obj))
+
+                results.put(batch)
+        except Exception as err:
+            results.put(err)
+        finally:
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                results.put(None)
+
+    submit(prefix, 1)
+
+    try:
+        while True:
+            batch = results.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        # The consumer may stop iterating before the end of the listing
+        stop.set()
+        while True:
+            with lock:
+                if pending[0] == 0:
+                    break
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown(wait=False)
+
+
+def parse_size(size, default=0):
+    """
+    Parse a size with a rclone-like suffix (b, k, M, G, T, P, defaulting to k) into a number of bytes
+    """
+
+    if size is None:
+        return default
+
+    size = str(size)
+    units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4, 'p': 1024 ** 5}
+    unit = size[-1].lower()
+    if unit in units:
+        return int(float(size[:-1]) * units[unit])
+
+    return int(float(size) * 1024)
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import queue
+import stat
+import threading
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+class SftpPool():
+    """
+    Authenticated SFTP sessions, kept open and shared by all the repos using the same remote
+
+    All the network operations run in an asyncio loop, in a background thread.
+    """
+
+    # Number of readdir/stat requests sent at the same time when listing
+    LIST_CONCURRENCY = 32
+
+    # Number of entries sent at once from the asyncio loop to the consumer of a listing
+    LIST_BATCH_SIZE = 1000
+
+    def __init__(self, channels=4):
+
+        self.channels = channels
+        self.loop = None
+        self.loop_pid = None
+        self.sessions = {}
+        self.session_locks = {}
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        """
+        Run a coroutine in the loop of the pool, and wait for its result
+        """
+
+        return self.submit(coro).result()
+
+    def submit(self, coro):
+        """
+        Run a coroutine in the loop of the pool, without waiting for it
+
+        :rtype: concurrent.futures.Future
+        :return: the future result of the coroutine
+        """
+
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+
+    async def get_clients(self, host, port, user, password):
+        """
+        Get the SFTP clients (channels) opened on a remote, connecting if needed
+
+        :rtype: list
+        :return: asyncssh.SFTPClient objects, all on the same SSH connection
+        """
+
+        key = (host, port, user, password)
+        if key not in self.session_locks:
+            self.session_locks[key] = asyncio.Lock()
+
+        async with self.session_locks[key]:
+            if key in self.sessions:
+                return self.sessions[key][1]
+
+            # Like rclone sftp backend, we don't check host keys
+            conn = await asyncssh.connect(host, port=port, username=user, password=password, known_hosts=None)
+            clients = [await conn.start_sftp_client() for i in range(self.channels)]
+            self.sessions[key] = (conn, clients)
+
+            return clients
+
+    async def forget(self, host, port, user, password):
+        """
+        Close the sessions of a remote (e.g. after a disconnection), they will be opened again on next use
+        """
+
+        session = self.sessions.pop((host, port, user, password), None)
+        if session:
+            session[0].close()
+
+    def iter_walk(self, clients, root, max_depth=0, logger=None):
+        """
+        List a remote directory, pipelining readdir requests on all the channels
+
+        :type max_depth: int
+        :param max_depth: Restrict to a max depth. Set to 0 for all files.
+
+        :type logger: logging.Logger
+        :param logger: to report the skipped entries (no app context in the loop thread)
+
+        :rtype: generator
+        :return: tuples (path relative to root, asyncssh.SFTPAttrs)
+        """
+
+        batches = queue.Queue(maxsize=16)
+        loop = self._get_loop()
+
+        async def put(batch):
+            # Blocking put in an executor, to stop listing when the consumer is too slow
+            await loop.run_in_executor(None, batches.put, batch)
+
+        async def walk():
+            try:
+                await self._walk(clients, root, max_depth, put, logger)
+            finally:
+                await put(None)
+
+        future = self.submit(walk())
+
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                yield from batch
+            # Raise the listing errors, if any
+            future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+                # Unblock the producer
+                while not future.done():
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+
+    async def _walk(self, clients, root, max_depth, put, logger):
+
+        semaphore = asyncio.Semaphore(self.LIST_CONCURRENCY)
+
+        async def list_dir(rel_dir, depth):
+            client = clients[depth % len(clients)]
+            async with semaphore:
+                names = await client.readdir(os.path.join(root, rel_dir))
+
+            batch = []
+            subdirs = []
+            for name in names:
+                if name.filename in ('.', '..'):
+                    continue
+
+                rel_path = os.path.join(rel_dir, name.filename)
+                attrs = name.attrs
+                if attrs.permissions is not None and stat.S_ISLNK(attrs.permissions):
+                    # Follow symlinks, like rclone does
+                    try:
+                        async with semaphore:
+                            attrs = await client.stat(os.path.join(root, rel_path))
+                    except asyncssh.SFTPNoSuchFile:
+                        # Broken symlink, or removed while listing
+                        if logger:
+                            logger.warning("Skipping broken symlink %s on remote repository" % os.path.join(root, rel_path))
+                        continue
+
+                is_dir = attrs.permissions is not None and stat.S_ISDIR(attrs.permissions)
+                if is_dir and (not max_depth or depth < max_depth):
+                    subdirs.append(rel_path)
+
+                batch.append((rel_path, attrs))
+                if len(batch) >= self.LIST_BATCH_SIZE:
+                    await put(batch)
+                    batch = []
+
+            if batch:
+                await put(batch)
+
+            await asyncio.gather(*[list_dir(subdir, depth + 1) for subdir in subdirs])
+
+        await list_dir('', 1)
+
+    def _get_loop(self):
+
+        # The loop thread does not survive a fork (celery/uwsgi workers), start a new one in each process
+        with self.lock:
+            if self.loop is None or self.loop_pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                self.loop_pid = os.getpid()
+                self.sessions = {}
+                self.session_locks = {}
+                thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                thread.start()
+
+            return self.loop
@@ -0,0 +1,340 @@
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+from itertools import islice
+
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+
+
+class TreeWalker():
+    """
+    Walk local trees relative to directory file descriptors, listing directories with a pool of threads
+
+    Each directory is opened relative to its parent, and files are visited relative to their directory (dir_fd): paths
+    are never resolved again from the root. On high-latency filesystems (NFS...), walks scale with the number of
+    threads. Symlinks to directories are not followed (they are visited like files).
+    """
+
+    # Number of subdirectories of a directory listed in advance by ordered walks
+    PREFETCH_DIRS = 32
+
+    def __init__(self, threads=8, max_depth=0, prune=None):
+        """
+        :type threads: int
+        :param threads: Number of directories listed in parallel
+
+        :type max_depth: int
+        :param max_depth: Restrict to a max depth. Set to 0 for all files.
+
+        :type prune: callable
+        :param prune: Called with the path of each directory (relative to the walked path), the directory is not walked if it returns True
+        """
+
+        self.threads = threads
+        self.max_depth = max_depth
+        self.prune = prune
+
+    def walk(self, path, visit=None, ordered=False):
+        """
+        Walk the files in a directory tree
+
+        :type path: str
+        :param path: Local directory to walk
+
+        :type visit: callable
+        :param visit: Called in the walker threads as visit(dir_fd, os.DirEntry) for each file, while dir_fd is open (use
+                      it as dir_fd argument of os.stat, os.utime, os.chown, os.unlink...). Files for which it raises
+                      FileNotFoundError are skipped.
+
+        :type ordered: bool
+        :param ordered: Yield files in the order of their path (directories are sorted as 'name/', like full paths)
+
+        :rtype: generator
+        :return: tuples (path relative to the walked path, return value of visit (None without visit))
+        """
+
+        state = _WalkState(self.threads)
+        try:
+            if ordered:
+                yield from self._walk_ordered(state, path, visit)
+            else:
+                yield from self._walk_unordered(state, path, visit)
+        finally:
+            state.close()
+
+    def _walk_ordered(self, state, path, visit):
+
+        # Stack of iterators over the sorted items of the directories being walked
+        to_walk = [iter([('', True, state.pool.submit(self._list_dir, state, None, path, '', 1, visit))])]
+        while to_walk:
+            item = next(to_walk[-1], None)
+            if item is None:
+                to_walk.pop()
+                continue
+
+            rel_path, is_dir, value = item
+            if not is_dir:
+                yield (rel_path, value)
+                continue
+
+            ref, files, subdirs = value.result()
+            to_walk.append(self._iter_listed(state, ref, rel_path, files, subdirs, visit))
+
+    def _iter_listed(self, state, ref, rel_path, files, subdirs, visit):
+        """
+        Iterate over the sorted items of a listed directory, listing its subdirectories a few at a time ahead of the consumer
+
+        Each listed subdirectory keeps its file descriptor open until it is walked: only PREFETCH_DIRS of them are listed
+        in advance, whatever the number of siblings.
+
+        :rtype: generator
+        :return: tuples (path relative to the walked path, is a directory, visit result for files or future listing for directories)
+        """
+
+        try:
+            items = [(name, os.path.join(rel_path, name), False, file_value) for name, file_value in files]
+            items.extend((name + '/', os.path.join(rel_path, name), True, name) for name in subdirs)
+            items.sort(key=_sort_key)
+
+            to_list = iter([name for key, item_path, item_is_dir, name in items if item_is_dir])
+            listing = collections.deque()
+
+            def list_ahead():
+                names = list(islice(to_list, self.PREFETCH_DIRS - len(listing)))
+                futures = {}
+                # The pool is LIFO: submit in reverse order to list the first subdirectory first
+                for name in reversed(names):
+                    state.acquire(ref)
+                    futures[name] = state.pool.submit(self._list_dir, state, ref, name, os.path.join(rel_path, name), ref.depth + 1, visit)
+                listing.extend(futures[name] for name in names)
+
+            list_ahead()
+            for key, item_path, item_is_dir, value in items:
+                if not item_is_dir:
+                    yield (item_path, False, value)
+                    continue
+
+                future = listing.popleft()
+                list_ahead()
+                yield (item_path, True, future)
+        finally:
+            state.release(ref)
+
+    def _walk_unordered(self, state, path, visit):
+
+        results = queue.Queue()
+        pending = [1]
+        lock = threading.Lock()
+
+        def list_dir(parent, name, rel_dir, depth):
+            try:
+                ref, files, subdirs = self._list_dir(state, parent, name, rel_dir, depth, visit)
+                try:
+                    for subdir in subdirs:
+                        state.acquire(ref)
+                        with lock:
+                            pending[0] += 1
+                        state.pool.submit(list_dir, ref, subdir, os.path.join(rel_dir, subdir), depth + 1)
+                finally:
+                    state.release(ref)
+                results.put([(os.path.join(rel_dir, file_name), value) for file_name, value in files])
+            except BaseException as err:
+                results.put(err)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        results.put(None)
+
+        state.pool.submit(list_dir, None, path, '', 1)
+
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            if isinstance(result, BaseException):
+                raise result
+            yield from result
+
+    def _list_dir(self, state, parent, name, rel_dir, depth, visit):
+        """
+        Open a directory relative to its parent, list it and visit its files
+
+        :rtype: tuple
+        :return: (reference to the directory file descriptor, list of (name, visit result) for files, list of subdirectory names)
+        """
+
+        try:
+            if parent is None:
+                fd = os.open(name, DIR_FLAGS)
+            else:
+                # Never follow a symlink which replaced a directory meanwhile
+                fd = os.open(name, DIR_FLAGS | os.O_NOFOLLOW, dir_fd=parent.fd)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed meanwhile
+            return (state.register(None, depth), [], [])
+        finally:
+            if parent is not None:
+                state.release(parent)
+
+        ref = state.register(fd, depth)
+        try:
+            files, subdirs = self._scan_dir(fd, rel_dir, depth, visit)
+        except BaseException:
+            state.release(ref)
+            raise
+
+        return (ref, files, subdirs)
+
+    def _scan_dir(self, fd, rel_dir, depth, visit):
+
+        files = []
+        subdirs = []
+        with os.scandir(fd) as it:
+            for dir_entry in it:
+                try:
+                    is_dir = dir_entry.is_dir(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+
+                if is_dir:
+                    if self.max_depth and depth >= self.max_depth:
+                        continue
+                    if self.prune is not None and self.prune(os.path.join(rel_dir, dir_entry.name)):
+                        continue
+                    subdirs.append(dir_entry.name)
+                    continue
+
+                value = None
+                if visit is not None:
+                    try:
+                        value = visit(fd, dir_entry)
+                    except FileNotFoundError:
+                        continue
+                files.append((dir_entry.name, value))
+
+        return (files, subdirs)
+
+
+class _FdRef():
+    """
+    An open directory file descriptor, closed when not needed anymore (by its own listing, nor to open its subdirectories)
+    """
+
+    def __init__(self, fd, depth):
+
+        self.fd = fd
+        self.depth = depth
+        self.refs = 1
+
+
+class _WalkState():
+    """
+    Thread pool and open file descriptors of a walk
+    """
+
+    def __init__(self, threads):
+
+        self.pool = _LifoPool(threads)
+        self.lock = threading.Lock()
+        self.open_refs = set()
+
+    def register(self, fd, depth):
+
+        ref = _FdRef(fd, depth)
+        if fd is not None:
+            with self.lock:
+                self.open_refs.add(ref)
+
+        return ref
+
+    def acquire(self, ref):
+
+        with self.lock:
+            ref.refs += 1
+
+    def release(self, ref):
+
+        with self.lock:
+            ref.refs -= 1
+            # Already closed by close() if the walk was interrupted
+            if ref.refs > 0 or ref.fd is None or ref not in self.open_refs:
+                return
+            self.open_refs.discard(ref)
+
+        os.close(ref.fd)
+
+    def close(self):
+        """
+        Stop the pool, and close the file descriptors left open by an interrupted walk
+        """
+
+        self.pool.shutdown()
+
+        with self.lock:
+            open_refs = self.open_refs
+            self.open_refs = set()
+
+        for ref in open_refs:
+            os.close(ref.fd)
+
+
+class _LifoPool():
+    """
+    Minimal thread pool running the most recently submitted task first
+
+    Walks are depth-first: only the directories along the paths being walked need to be kept open.
+    """
+
+    def __init__(self, threads):
+
+        self.tasks = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.workers = [threading.Thread(target=self._run, daemon=True, name='tree_walker') for i in range(threads)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, func, *args):
+
+        future = concurrent.futures.Future()
+        with self.cond:
+            self.tasks.append((future, func, args))
+            self.cond.notify()
+
+        return future
+
+    def shutdown(self):
+
+        with self.cond:
+            self.closed = True
+            self.tasks = []
+            self.cond.notify_all()
+
+        for worker in self.workers:
+            worker.join()
+
+    def _run(self):
+
+        while True:
+            with self.cond:
+                while not self.tasks and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                future, func, args = self.tasks.pop()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(func(*args))
+            except BaseException as err:
+                future.set_exception(err)
+
+
+def _sort_key(item):
+
+    return item[0]
@@ -0,0 +1,137 @@
+import threading
+import time
+
+from flask import current_app
+
+import redis
+
+
+class WorkerRegistry():
+    """
+    Registry of the live Celery workers and of their tasks, kept in Redis by heartbeats of the workers
+
+    Each worker publishes every few seconds the ids of the tasks it received (running or reserved), with keys expiring
+    after a few missed heartbeats. The web app checks the availability of workers, and whether a task is alive, with a
+    few Redis reads instead of inspect broadcasts waiting for every worker to answer.
+    """
+
+    WORKERS_KEY = 'baricadr:workers'
+
+    def __init__(self, redis_url, interval=5):
+        """
+        :type redis_url: str
+        :param redis_url: Url of the Redis database
+
+        :type interval: int
+        :param interval: Delay (in seconds) between heartbeats. Workers and tasks are considered dead after 3 missed heartbeats.
+        """
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.interval = interval
+        self.ttl = 3 * interval
+
+        self.hostname = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def _task_key(self, task_id):
+
+        return 'baricadr:worker-task:%s' % task_id
+
+    def available(self):
+        """
+        Check if at least one worker is alive
+
+        :rtype: bool
+        """
+
+        try:
+            return self.redis.zcount(self.WORKERS_KEY, time.time() - self.ttl, '+inf') > 0
+        except redis.exceptions.RedisError as err:
+            current_app.logger.warning("Could not read the worker registry: %s" % err)
+            return False
+
+    def alive_tasks(self, task_ids):
+        """
+        Find the tasks received by a live worker (raises redis.exceptions.RedisError if the registry can't be read)
+
+        :type task_ids: list
+        :param task_ids: Ids of the tasks to check
+
+        :rtype: set
+        :return: ids of the tasks which are alive
+        """
+
+        task_ids = list(task_ids)
+        if not task_ids:
+            return set()
+
+        pipe = self.redis.pipeline()
+        for task_id in task_ids:
+            pipe.exists(self._task_key(task_id))
+
+        return set(task_id for task_id, exists in zip(task_ids, pipe.execute()) if exists)
+
+    def heartbeat(self, task_ids):
+        """
+        Publish that this worker is alive, with the tasks it received
+        """
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.WORKERS_KEY, {self.hostname: time.time()})
+        # Forget the workers which stopped long ago
+        pipe.zremrangebyscore(self.WORKERS_KEY, '-inf', time.time() - 10 * self.ttl)
+        for task_id in task_ids:
+            pipe.set(self._task_key(task_id), self.hostname, ex=self.ttl)
+        pipe.execute()
+
+    def add_task(self, task_id):
+        """
+        Publish a task as soon as this worker receives it, without waiting for the next heartbeat
+        """
+
+        try:
+            self.redis.set(self._task_key(task_id), self.hostname, ex=self.ttl)
+        except redis.exceptions.RedisError:
+            # Published with the next heartbeat
+            pass
+
+    def start(self, app, hostname, get_task_ids):
+        """
+        Publish heartbeats in a background thread, in the main process of a worker
+
+        :type hostname: str
+        :param hostname: Name of the worker
+
+        :type get_task_ids: callable
+        :param get_task_ids: Returns the ids of the tasks received by the worker
+        """
+
+        self.hostname = hostname
+        self.thread = threading.Thread(target=self.run, args=(app, get_task_ids), daemon=True, name='worker_heartbeat')
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the heartbeats, and unregister the worker
+        """
+
+        self.stopping.set()
+        if self.thread is None:
+            return
+
+        self.thread.join()
+
+        try:
+            self.redis.zrem(self.WORKERS_KEY, self.hostname)
+        except redis.exceptions.RedisError:
+            pass
+
+    def run(self, app, get_task_ids):
+
+        while not self.stopping.is_set():
+            try:
+                self.heartbeat(get_task_ids())
+            except Exception as err:
+                app.logger.warning("Could not publish the heartbeat of worker %s: %s" % (self.hostname, err))
+            self.stopping.wait(self.interval)
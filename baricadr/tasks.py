@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import time
@@ -6,9 +7,11 @@ from datetime import datetime, timedelta
 from baricadr.app import create_app, create_celery
 from baricadr.db_models import BaricadrTask
 from baricadr.extensions import db, mail
-from baricadr.utils import celery_task_is_in_queue, get_celery_tasks, human_readable_size
+from baricadr.model.access_tracker import AccessTracker
+from baricadr.utils import human_readable_size
 
-from celery.signals import task_postrun, task_revoked
+from celery.signals import task_postrun, task_received, task_revoked, worker_ready, worker_shutdown
+from celery.worker import state as worker_state
 
 from flask_mail import Message
 
@@ -42,30 +45,43 @@ Cheers
 
     dbtask.status = 'failed'
     dbtask.finished = datetime.utcnow()
+    app.path_locks.release(task_id)
     db.session.commit()
 
+    app.task_dispatcher.completed(task_id)
 
-def run_repo_action(self, type, path, task_id, email=None, wait_for=[], dry_run=False, sleep=0):
 
-    # Wait a bit in case the tasks begin just before it is recorded in the db
-    time.sleep(2)
-    dbtask = BaricadrTask.query.filter_by(task_id=task_id).one()
-    dbtask.status = 'waiting' if wait_for else 'started'
-    dbtask.started = datetime.utcnow()
+def run_repo_action(self, type, path, task_id, email=None, dry_run=False, sleep=0, evict=False):
+
+    # Tasks are committed to the db before being sent. Claim the task: a task sent again by the reaper only runs once
+    claimed = BaricadrTask.query.filter_by(task_id=task_id, status='new').update({
+        BaricadrTask.status: 'started',
+        BaricadrTask.started: datetime.utcnow(),
+        BaricadrTask.lease_expires: app.task_leases.expires(),
+    }, synchronize_session=False)
     db.session.commit()
+    if not claimed:
+        app.logger.warning("Task %s was already started (or removed), not running it again" % task_id)
+        return
+
+    dbtask = BaricadrTask.query.filter_by(task_id=task_id).one()
+
+    # Keep the lease of the task and the lock on the path while running (they expire if this worker dies)
+    stop_keep_alive = app.task_leases.keep_alive(app, task_id)
+    try:
+        return _run_repo_action(self, dbtask, type, path, task_id, email, dry_run, sleep, evict)
+    finally:
+        stop_keep_alive.set()
+
+
+def _run_repo_action(self, dbtask, type, path, task_id, email, dry_run, sleep, evict):
 
     vocab = {'pull': 'pulling', 'freeze': 'freezing'}
     vocabed = {'pull': 'pulled', 'freeze': 'freezed'}
 
     # For internal testing, cannot be set by api
-    time.sleep(sleep)
-
-    if wait_for:
-        app.logger.debug("Waiting for tasks %s before %s '%s'" % (wait_for, vocab[type], path))
-        for wait_id in wait_for:
-            while celery_task_is_in_queue(app.celery, wait_id):
-                time.sleep(10)
-        dbtask.started = datetime.utcnow()
+    if sleep:
+        time.sleep(sleep)
 
     dbtask.status = vocab[type]
     db.session.commit()
@@ -87,9 +103,16 @@ def run_repo_action(self, type, path, task_id, email=None, wait_for=[], dry_run=
     )
     app.logger.addHandler(task_file_handler)
 
+    def report_progress(progress):
+        self.update_state(state='PROGRESS', meta=progress)
+        dbtask.progress = json.dumps(progress)
+        db.session.commit()
+
     modified = None
     if type == "pull":
-        modified = repo.pull(asked_path, dry_run=dry_run)
+        modified = repo.pull(asked_path, dry_run=dry_run, progress=report_progress)
+    elif evict:
+        modified = repo.evict(dry_run=dry_run)
     else:
         modified = repo.freeze(asked_path, dry_run=dry_run)
 
@@ -98,8 +121,11 @@ def run_repo_action(self, type, path, task_id, email=None, wait_for=[], dry_run=
     dbtask.status = 'finished'
 
     dbtask.finished = datetime.utcnow()
+    app.path_locks.release(task_id)
     db.session.commit()
 
+    app.task_dispatcher.completed(task_id)
+
     if email:
         say_dry_run = " (DRY RUN)" if dry_run else ""
         verb_dry_run = "would be" if dry_run else "were"
@@ -121,41 +147,83 @@ def run_repo_action(self, type, path, task_id, email=None, wait_for=[], dry_run=
         mail.send(msg)
 
 
+# wait_for is not used anymore: tasks are only sent to Celery once the tasks they wait for are completed
 @celery.task(bind=True, name="pull", on_failure=on_failure)
 def pull(self, path, email=None, wait_for=[], dry_run=False, sleep=0):
-    run_repo_action(self, 'pull', path, pull.request.id, email=email, wait_for=wait_for, dry_run=dry_run, sleep=sleep)
+    run_repo_action(self, 'pull', path, pull.request.id, email=email, dry_run=dry_run, sleep=sleep)
 
 
 @celery.task(bind=True, name="freeze", on_failure=on_failure)
-def freeze(self, path, email=None, wait_for=[], dry_run=False, sleep=0):
-    run_repo_action(self, 'freeze', path, freeze.request.id, email=email, wait_for=wait_for, dry_run=dry_run, sleep=sleep)
+def freeze(self, path, email=None, wait_for=[], dry_run=False, sleep=0, evict=False):
+    run_repo_action(self, 'freeze', path, freeze.request.id, email=email, dry_run=dry_run, sleep=sleep, evict=evict)
 
 
 @celery.task(bind=True, name="cleanup_zombie_tasks")
 def cleanup_zombie_tasks(self):
     """
-    Look at the list of tasks in the database and check if they are running or in queue.
-    If for some reason a task is in the db but not running/in queue, it means that it is finished or that it got interrupted.
+    Requeue or fail the running tasks whose lease expired (their worker died), and send the waiting tasks which are ready
+    The web app already does it every REAPER_INTERVAL seconds, this is for the /zombie endpoint.
     """
 
-    cel_tasks = get_celery_tasks(app.celery)
+    self.update_state(state='PROGRESS')
+
+    requeued, failed = app.task_leases.reap()
+    app.logger.debug("%s zombie tasks requeued, %s failed" % (requeued, failed))
+
+    # Send the tasks which were waiting for the zombies, and the ones whose dependencies completion was missed
+    sent = app.task_dispatcher.send_ready()
+    app.logger.debug("%s waiting tasks sent" % sent)
+
+
+@celery.task(bind=True, name="index_catalog")
+def index_catalog(self, repo_path):
+    """
+        Snapshot the remote files of a repository into its catalog
+    """
+
+    repo = app.repos.get_repo(repo_path)
+    if repo.catalog is None:
+        app.logger.warning("Asked to index the catalog of repo '%s', but it has no catalog" % repo_path)
+        return
 
     self.update_state(state='PROGRESS')
 
-    num = 0
-    # Filter tasks not yet finished/failed
-    running_tasks = BaricadrTask.query.filter(BaricadrTask.status.notin_(["failed", "finished"]))
-    for rt in running_tasks:
-        if rt.task_id not in cel_tasks['active_tasks'] \
-           and rt.task_id not in cel_tasks['reserved_tasks'] \
-           and rt.task_id not in cel_tasks['scheduled_tasks']:
-
-            app.logger.debug("Found zombie state for task '%s' %s on path '%s'" % (rt.task_id, rt.type, rt.path))
-            rt.status = 'failed'
-            rt.finished = datetime.utcnow()
-            num += 1
-        db.session.commit()
-    app.logger.debug("%s zombie tasks killed (%s remaining)" % (num, running_tasks.count() - num))
+    num = repo.catalog.index()
+    app.logger.debug("Indexed %s files in the catalog of repo '%s'" % (num, repo_path))
+
+
+@celery.task(bind=True, name="refresh_catalog")
+def refresh_catalog(self, repo_path):
+    """
+        Merge the recently modified remote files of a repository into its catalog
+    """
+
+    repo = app.repos.get_repo(repo_path)
+    if repo.catalog is None or not repo.use_catalog():
+        app.logger.warning("Asked to refresh the catalog of repo '%s', but it has no (indexed) catalog" % repo_path)
+        return
+
+    self.update_state(state='PROGRESS')
+
+    num = repo.catalog.refresh()
+    app.logger.debug("Refreshed %s files in the catalog of repo '%s'" % (num, repo_path))
+
+
+@celery.task(bind=True, name="rescan_inventory")
+def rescan_inventory(self, repo_path):
+    """
+        Update the local inventory of a repository, listing only the modified directories
+    """
+
+    repo = app.repos.get_repo(repo_path)
+    if repo.inventory is None:
+        app.logger.warning("Asked to rescan the local inventory of repo '%s', but it has no inventory" % repo_path)
+        return
+
+    self.update_state(state='PROGRESS')
+
+    num = repo.inventory.rescan()
+    app.logger.debug("Listed %s directories in the local inventory of repo '%s'" % (num, repo_path))
 
 
 @celery.task(bind=True, name="cleanup_tasks")
@@ -212,3 +280,37 @@ def close_session(*args, **kwargs):
     # context, this ensures tasks have a fresh session (e.g. session errors
     # won't propagate across tasks)
     db.session.remove()
+
+
+@worker_ready.connect
+def start_access_tracker(**kwargs):
+    # In the main worker process only, for repos with access_tracking
+    app.access_tracker = AccessTracker(app, app.config['ACCESS_TRACKER_FLUSH_INTERVAL'])
+    app.access_tracker.start()
+
+
+@worker_ready.connect
+def start_heartbeat(sender=None, **kwargs):
+    # In the main worker process, which knows all the tasks received by the worker
+    app.workers.start(app, sender.hostname, received_task_ids)
+
+
+def received_task_ids():
+    return [request.id for request in list(worker_state.reserved_requests) + list(worker_state.active_requests)]
+
+
+@task_received.connect
+def publish_received_task(request=None, **kwargs):
+    app.workers.add_task(request.id)
+
+
+@worker_shutdown.connect
+def stop_access_tracker(**kwargs):
+    # Save the last accesses
+    if getattr(app, 'access_tracker', None) is not None:
+        app.access_tracker.stop()
+
+
+@worker_shutdown.connect
+def stop_heartbeat(**kwargs):
+    app.workers.stop()
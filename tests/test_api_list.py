@@ -70,6 +70,23 @@ class TestApiList(BaricadrTestCase):
 
         assert remote_file_list == ["file2.txt"]
 
+    def test_list_missing_sorted(self, client):
+        """
+            Get missing files at all depths, sorted by path
+        """
+        if os.path.isfile(os.path.join(self.repo_root, "file.txt")):
+            os.unlink(os.path.join(self.repo_root, "file.txt"))
+
+        body = {"path": self.repo_root, "missing": "True", "max_depth": 0}
+        response = client.post("/list", json=body)
+
+        assert response.status_code == 200
+        remote_file_list = [file['Path'] for file in response.json]
+
+        assert "file.txt" in remote_file_list
+        assert "subdir/subfile.txt" in remote_file_list
+        assert remote_file_list == sorted(remote_file_list)
+
     def test_list_full(self, client):
         """
             Get files with full info
@@ -1,8 +1,15 @@
 import os
 import tempfile
+from datetime import timedelta
+
+from baricadr.db_models import RemoteCatalog, RemoteCatalogDir, RemoteCatalogEntry
+from baricadr.extensions import db
+from baricadr.model.rclone import RcloneDaemonPool
 
 import pytest
 
+import requests
+
 from . import BaricadrTestCase
 
 
@@ -213,6 +220,23 @@ class TestBackendSFTP(BaricadrTestCase):
             repo = app.repos.get_repo(single_file)
             assert repo.remote_is_single(single_file)
 
+    def test_remote_stat(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            assert not repo.backend.remote_stat('subdir/subfile.txt')['IsDir']
+            assert repo.backend.remote_stat('subdir/subfile.txt')['Name'] == 'subfile.txt'
+            assert repo.backend.remote_stat('subdir/')['IsDir']
+            assert repo.backend.remote_stat('')['IsDir']
+            assert repo.backend.remote_stat('subdir/non_existing_file.txt') is None
+
     def test_remote_list(self, app):
 
         with tempfile.TemporaryDirectory() as local_path:
@@ -258,6 +282,269 @@ class TestBackendSFTP(BaricadrTestCase):
                 'subsubdir/subsubfile.txt',
             ])
 
+    def test_iter_remote_list(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            remote_files = repo.iter_remote_list(target, max_depth=0, from_root=True)
+
+            # Stopping in the middle of the listing should not be a problem
+            assert next(remote_files)['Path'].startswith('subdir/')
+            remote_files.close()
+
+            assert set([file['Path'] for file in repo.iter_remote_list(target, max_depth=0, from_root=True)]) == set([
+                'subdir/subfile.txt',
+                'subdir/subsubdir2/poutrelle.xml',
+                'subdir/subsubdir2/subsubfile.txt',
+                'subdir/subsubdir2/subsubsubdir/subsubsubdir2/a file',
+                'subdir/subsubdir/poutrelle.tsv',
+                'subdir/subsubdir/poutrelle.xml',
+                'subdir/subsubdir/subsubfile.txt',
+            ])
+
+    def test_remote_list_single_from_root(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/subfile.txt'
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            assert [file['Path'] for file in repo.remote_list(target, from_root=True)] == ['subdir/subfile.txt']
+
+    def test_remote_list_cache(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['list_cache_ttl'] = 60
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            listing = repo.remote_list(target, max_depth=2)
+
+            cached = app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix + 'subdir/', 2, 60)
+            assert cached is not None
+            assert len([entry for entry in cached if not entry['IsDir']]) == len(listing)
+
+            # Served from the cache
+            assert repo.remote_list(target, max_depth=2) == listing
+
+    def test_remote_list_cache_chunks(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            repo_conf = dict(self.repo_conf)
+            repo_conf['list_cache_ttl'] = 60
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            # Written and read by chunks of 2 entries
+            app.listing_cache.CHUNK_SIZE = 2
+            try:
+                listing = repo.remote_list(local_path, max_depth=0)
+
+                cached = app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix, 0, 60)
+                assert cached is not None
+                assert sorted(entry['Path'] for entry in cached if not entry['IsDir']) == sorted(file['Path'] for file in listing)
+
+                # Too big to be cached
+                app.listing_cache.max_files = 3
+                repo.backend.invalidate_cached(repo, local_path)
+                repo.remote_list(local_path, max_depth=0)
+                assert app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix, 0, 60) is None
+            finally:
+                del app.listing_cache.CHUNK_SIZE
+                app.listing_cache.max_files = app.config['LISTING_CACHE_MAX_FILES']
+
+    def test_pull_invalidates_list_cache(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['list_cache_ttl'] = 60
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            repo.remote_list(local_path, max_depth=2)
+            repo.remote_list(target, max_depth=1)
+            assert app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix, 2, 60) is not None
+
+            repo.pull(target)
+
+            # Listings of the pulled path and of its ancestors are gone
+            assert app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix, 2, 60) is None
+            assert app.listing_cache.get(repo.backend.cache_id(), repo.backend.remote_prefix + 'subdir/', 1, 60) is None
+
+    def test_remote_list_catalog(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['catalog'] = True
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            assert not repo.use_catalog()
+            listing = repo.remote_list(target, max_depth=2)
+            full_listing = repo.remote_list(target, max_depth=0, from_root=True)
+            total = len(repo.remote_list(local_path, max_depth=0))
+
+            assert repo.catalog.index() == total
+            assert repo.use_catalog()
+            assert repo.catalog.is_fresh()
+
+            # Order is unreliable when listing the remote, compare sets
+            assert set([file['Path'] for file in repo.remote_list(target, max_depth=2)]) == set([file['Path'] for file in listing])
+            assert set([file['Path'] for file in repo.remote_list(target, max_depth=0, from_root=True)]) == set([file['Path'] for file in full_listing])
+            assert [file['Path'] for file in repo.remote_list(target + 'subfile.txt', from_root=True)] == ['subdir/subfile.txt']
+            assert repo.remote_list(local_path + '/subdir_nonexistent/') == []
+
+            os.makedirs(target)
+            with open(target + 'subfile.txt', 'w') as local_file:
+                local_file.write('foo')
+
+            assert {'Path': 'subfile.txt', 'missing': False} in repo.remote_tree(target)
+            assert 'subfile.txt' not in [file['Path'] for file in repo.remote_list(target, missing=True)]
+
+            # Indexing again replaces the previous snapshot
+            assert repo.catalog.index() == total
+            assert len(repo.remote_list(local_path, max_depth=0)) == total
+
+    def test_remote_list_catalog_missing_exclude(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['exclude'] = '*.xml'
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+            missing = repo.remote_list(local_path, max_depth=0, missing=True)
+
+            repo_conf['catalog'] = True
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+            repo.catalog.index()
+
+            # Excluded files are never pulled, they are not missing
+            assert [file['Path'] for file in repo.remote_list(local_path, max_depth=0, missing=True)] == [file['Path'] for file in missing]
+            assert not [file['Path'] for file in missing if file['Path'].endswith('.xml')]
+            assert repo.remote_list(local_path + '/subdir/subsubdir/poutrelle.xml', missing=True) == []
+
+    def test_remote_list_catalog_claim(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['catalog'] = True
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            total = repo.catalog.index()
+
+            # Claimed by another indexing
+            claim = repo.catalog._claim()
+            assert claim is not None
+            assert repo.catalog._claim() is None
+            with pytest.raises(RuntimeError):
+                repo.catalog.index()
+            assert repo.catalog.refresh() == 0
+
+            # The claim of a dead indexing expires
+            RemoteCatalog.query.filter_by(repo=repo.local_path).update({RemoteCatalog.indexing_started: claim - timedelta(seconds=repo.catalog.INDEXING_TIMEOUT + 1)}, synchronize_session=False)
+            db.session.commit()
+            assert repo.catalog.index() == total
+            assert RemoteCatalogEntry.query.filter_by(repo=repo.local_path).count() == total
+
+    def test_remote_list_catalog_refresh(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            repo_conf = dict(self.repo_conf)
+            repo_conf['catalog'] = True
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            repo.catalog.index()
+            generation = repo.catalog.generation()
+            listing = sorted(repo.remote_list(local_path, max_depth=0, full=True), key=lambda k: k['Path'])
+
+            # Nothing changed on the remote
+            assert repo.catalog.refresh() == 0
+            assert sorted(repo.remote_list(local_path, max_depth=0, full=True), key=lambda k: k['Path']) == listing
+
+            subdir = RemoteCatalogDir.query.filter_by(repo=repo.local_path, generation=generation, path='subdir')
+            subfile = RemoteCatalogEntry.query.filter_by(repo=repo.local_path, generation=generation, path='subdir/subfile.txt')
+            stale = repo.catalog._to_row(generation, 'subdir/stale.txt', {'Size': 3, 'ModTime': '2000-01-01T00:00:00Z'})
+
+            if repo.backend.DIR_MTIMES:
+                # Directories which were not modified are not listed again
+                db.session.bulk_insert_mappings(RemoteCatalogEntry, [stale])
+                db.session.commit()
+                assert repo.catalog.refresh() == 0
+                assert RemoteCatalogEntry.query.filter_by(repo=repo.local_path, path='subdir/stale.txt').count() == 1
+                RemoteCatalogEntry.query.filter_by(repo=repo.local_path, path='subdir/stale.txt').delete(synchronize_session=False)
+                db.session.commit()
+
+            # A file added in an existing directory (modified since it was listed)
+            subfile.delete(synchronize_session=False)
+            subdir.update({RemoteCatalogDir.mod_time: '2000-01-01T00:00:00Z'}, synchronize_session=False)
+            db.session.commit()
+            assert repo.catalog.refresh() == 1
+            assert sorted(repo.remote_list(local_path, max_depth=0, full=True), key=lambda k: k['Path']) == listing
+
+            # A file and a directory removed from an existing directory
+            db.session.bulk_insert_mappings(RemoteCatalogEntry, [stale, repo.catalog._to_row(generation, 'subdir/removed/file.txt', {'Size': 3, 'ModTime': '2000-01-01T00:00:00Z'})])
+            db.session.bulk_insert_mappings(RemoteCatalogDir, [repo.catalog._to_dir_row(generation, 'subdir/removed', None)])
+            subdir.update({RemoteCatalogDir.mod_time: '2000-01-01T00:00:00Z'}, synchronize_session=False)
+            db.session.commit()
+            assert len(repo.remote_list(local_path, max_depth=0)) == len(listing) + 2
+            assert repo.catalog.refresh() == 0
+            assert sorted(repo.remote_list(local_path, max_depth=0, full=True), key=lambda k: k['Path']) == listing
+            assert RemoteCatalogDir.query.filter_by(repo=repo.local_path, path='subdir/removed').count() == 0
+
 
 class TestBackendS3(TestBackendSFTP):
     """
@@ -272,3 +559,264 @@ class TestBackendS3(TestBackendSFTP):
         'access_key_id': 'admin',
         'secret_access_key': 'password'
     }
+
+
+class TestBackendSFTPNative(TestBackendSFTP):
+    """
+    Same tests, but with the native SFTP backend
+    """
+
+    repo_conf = {
+        'backend': 'sftp_native',
+        'url': 'sftp:test-repo/',
+        'user': 'foo',
+        'password': 'pass'
+    }
+
+    def test_session_reused(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            repo.remote_list(local_path)
+            sessions = dict(app.sftp_pool.sessions)
+            assert len(sessions) == 1
+
+            repo.remote_list(local_path + '/subdir/')
+            assert app.sftp_pool.sessions == sessions
+
+    def test_session_reconnect(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            listing = sorted(file['Path'] for file in repo.remote_list(local_path, max_depth=0))
+            conn, clients = list(app.sftp_pool.sessions.values())[0]
+
+            async def close_connection():
+                # Lost behind the back of the pool
+                conn.close()
+                await conn.wait_closed()
+
+            app.sftp_pool.run(close_connection())
+
+            assert sorted(file['Path'] for file in repo.remote_list(local_path, max_depth=0)) == listing
+            assert list(app.sftp_pool.sessions.values())[0][0] is not conn
+
+    def test_pull_reconnect(self, app, monkeypatch):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            listing = sorted(file['Path'] for file in repo.remote_list(target, max_depth=0))
+            conn, clients = list(app.sftp_pool.sessions.values())[0]
+            copy_file = repo.backend.copy_file
+
+            async def copy_file_lost(client, remote, entry, local_path, stats):
+                if not conn.is_closed():
+                    # Lost behind the back of the pool, in the middle of the transfers
+                    conn.close()
+                    await conn.wait_closed()
+                await copy_file(client, remote, entry, local_path, stats)
+
+            monkeypatch.setattr(repo.backend, 'copy_file', copy_file_lost)
+            repo.pull(target)
+
+            for file_path in listing:
+                assert os.path.exists(target + file_path)
+            assert list(app.sftp_pool.sessions.values())[0][0] is not conn
+
+    def test_remote_list_broken_symlink(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            listing = sorted(file['Path'] for file in repo.remote_list(local_path, max_depth=0))
+            conn, clients = list(app.sftp_pool.sessions.values())[0]
+            remote_link = repo.backend.remote_prefix + 'subdir/broken_symlink'
+
+            app.sftp_pool.run(clients[0].symlink('/nonexistent', remote_link))
+            try:
+                # Skipped
+                assert sorted(file['Path'] for file in repo.remote_list(local_path, max_depth=0)) == listing
+            finally:
+                app.sftp_pool.run(clients[0].remove(remote_link))
+
+
+class TestBackendS3Native(TestBackendSFTP):
+    """
+    Same tests, but with the native S3 backend
+    """
+
+    repo_conf = {
+        'backend': 's3_native',
+        'endpoint': 'http://minio:9000/',
+        'path': 'remote-test-repo/test-repo/',
+        'access_key_id': 'admin',
+        'secret_access_key': 'password'
+    }
+
+    def test_pull_ranged(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            target = local_path + '/subdir/'
+
+            repo_conf = dict(self.repo_conf)
+            # Download everything with tiny ranges
+            repo_conf['transfer'] = {
+                'multi_thread_cutoff': '1b',
+                'multi_thread_streams': 4,
+                'buffer_size': '4b',
+            }
+            conf = {
+                local_path: repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(target)
+
+            repo.pull(target)
+
+            with open(target + 'subsubdir/poutrelle.xml', 'r') as local_file, open('/baricadr/test-data/test-repo/subdir/subsubdir/poutrelle.xml', 'r') as orig_file:
+                assert local_file.read() == orig_file.read()
+
+    def test_remote_stat_dir_mtime(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+
+            conf = {
+                local_path: self.repo_conf
+            }
+
+            app.repos.read_conf_from_str(str(conf))
+            repo = app.repos.get_repo(local_path)
+
+            # Prefixes have no modification time, it must not change between listings
+            remote_stat = repo.backend.remote_stat('subdir/')
+            assert repo.backend.remote_stat('subdir/')['ModTime'] == remote_stat['ModTime']
+            listed = [entry for entry in repo.backend.iter_raw_list(repo, local_path, refresh=True) if entry['Path'] == 'subdir']
+            assert listed[0]['ModTime'] == remote_stat['ModTime']
+
+
+class TestBackendLocal(TestBackendSFTP):
+    """
+    Same tests, but with the remote mounted on the local filesystem
+    """
+
+    repo_conf = {
+        'backend': 'local',
+        'path': '/baricadr/test-data/test-repo/'
+    }
+
+    def test_get_relative_path(self, app):
+
+        with pytest.raises(ValueError):
+            app.backends.get_by_name("local", {'path': 'test-data/test-repo/'})
+
+    def test_remote_list_cache(self, app):
+        pytest.skip("Listings of local mounts are not cached")
+
+    def test_remote_list_cache_chunks(self, app):
+        pytest.skip("Listings of local mounts are not cached")
+
+    def test_pull_invalidates_list_cache(self, app):
+        pytest.skip("Listings of local mounts are not cached")
+
+
+class TestBackendSFTPDaemon(TestBackendSFTP):
+    """
+    Same tests, but going through the rclone daemons
+    """
+
+    @pytest.fixture
+    def app(self, app):
+        app.rclone_daemons = RcloneDaemonPool()
+
+        yield app
+
+        app.rclone_daemons.stop_all()
+        app.rclone_daemons = None
+
+    def test_daemon_shared(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            with tempfile.TemporaryDirectory() as local_path2:
+                conf = {
+                    local_path: self.repo_conf,
+                    local_path2: self.repo_conf
+                }
+
+                app.repos.read_conf_from_str(str(conf))
+
+                repo = app.repos.get_repo(local_path + '/file.txt')
+                repo2 = app.repos.get_repo(local_path2 + '/file.txt')
+                repo.pull(local_path + '/file.txt')
+                repo2.pull(local_path2 + '/file.txt')
+
+                assert os.path.isfile(local_path + '/file.txt')
+                assert os.path.isfile(local_path2 + '/file.txt')
+                assert repo.backend.get_daemon() is repo2.backend.get_daemon()
+                assert len(app.rclone_daemons.daemons) == 1
+
+    def test_daemon_list_recursive(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.repo_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            # Listed directory by directory by the daemon
+            listed = sorted((entry['Path'], entry['IsDir']) for entry in repo.backend.iter_raw_list(repo, local_path, max_depth=0, refresh=True))
+
+            daemons = app.rclone_daemons
+            app.rclone_daemons = None
+            try:
+                expected = sorted((entry['Path'], entry['IsDir']) for entry in repo.backend.iter_raw_list(repo, local_path, max_depth=0, refresh=True))
+            finally:
+                app.rclone_daemons = daemons
+
+            assert listed == expected
+            assert any('/' in path for path, is_dir in listed)
+
+    def test_daemon_auth(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.repo_conf}))
+
+            daemon = app.repos.get_repo(local_path + '/file.txt').backend.get_daemon()
+            assert daemon.call('rc/noop')[0] == 200
+
+            # Other local users can reach the port, but not use it
+            assert requests.post(daemon.url + 'rc/noop', json={}).status_code == 401
+
+
+class TestBackendS3Daemon(TestBackendSFTPDaemon):
+    """
+    Same tests, but with S3 and the rclone daemons
+    """
+
+    repo_conf = TestBackendS3.repo_conf
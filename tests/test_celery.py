@@ -3,6 +3,8 @@ import time
 from baricadr.db_models import BaricadrTask
 from baricadr.extensions import db
 
+from celery.utils import uuid
+
 from . import BaricadrTestCase
 
 
@@ -21,17 +23,76 @@ class TestCelery(BaricadrTestCase):
 
         path = '/some/wrong/path/test_repo/subdir'
 
-        task = app.celery.send_task('pull', (path, None, [None]))
-        task_id = task.task_id
+        # Save a reference to this task in db, before sending it
+        task_id = uuid()
         self.task_ids.append(task_id)
-        # Save a reference to this task in db
         pt = BaricadrTask(path=path, type="pull", task_id=task_id)
         db.session.add(pt)
         db.session.commit()
 
+        app.celery.send_task('pull', (path, None, [None]), task_id=task_id)
+
         time.sleep(10)
 
         res = client.get('/tasks/status/{}'.format(task_id))
 
         assert res.json['status'] == 'failed'
         assert res.json['error'] == "Could not find baricadr repository for path \"%s/\"" % path
+
+    def test_celery_task_waits_for_dependency(self, app, client):
+
+        path = '/some/wrong/path/test_repo/subdir'
+
+        # Fake running task locking a subdir
+        self.task_ids.append('id_pulling')
+        db.session.add(BaricadrTask(path=path + '/subsubdir', type="pull", task_id='id_pulling', status='pulling'))
+        db.session.commit()
+
+        task_id = app.task_dispatcher.submit('pull', path, wait_for=['id_pulling'])
+        self.task_ids.append(task_id)
+
+        # Not sent to Celery while its dependency runs
+        assert app.task_dispatcher.completed('id_other') == 0
+        assert app.task_dispatcher.send_ready() == 0
+        assert BaricadrTask.query.filter_by(task_id=task_id).one().status == 'waiting'
+
+        dependency = BaricadrTask.query.filter_by(task_id='id_pulling').one()
+        dependency.status = 'finished'
+        db.session.commit()
+
+        assert app.task_dispatcher.completed('id_pulling') == 1
+        # Only sent once
+        assert app.task_dispatcher.send_ready() == 0
+
+        time.sleep(10)
+
+        res = client.get('/tasks/status/{}'.format(task_id))
+
+        assert res.json['status'] == 'failed'
+        assert res.json['error'] == "Could not find baricadr repository for path \"%s/\"" % path
+        app.path_locks.release(task_id)
+        db.session.commit()
+
+    def test_celery_task_submitted(self, app, client):
+
+        path = '/some/wrong/path/test_repo/subdir'
+
+        task_id = app.task_dispatcher.submit('pull', path)
+        self.task_ids.append(task_id)
+
+        # Recorded before being sent
+        assert BaricadrTask.query.filter_by(task_id=task_id).one().status in ['new', 'started', 'failed']
+
+        time.sleep(5)
+
+        res = client.get('/tasks/status/{}'.format(task_id))
+
+        assert res.json['status'] == 'failed'
+        assert app.path_locks.touching(path) is None
+
+    def test_worker_registry(self, app):
+
+        # The test worker publishes its heartbeats
+        assert app.workers.available()
+
+        assert app.workers.alive_tasks(['id_unknown']) == set()
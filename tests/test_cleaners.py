@@ -1,3 +1,4 @@
+import json
 import time
 from datetime import datetime, timedelta
 
@@ -49,6 +50,65 @@ class TestCelery(BaricadrTestCase):
         for task in del_tasks:
             assert task.status == "failed"
 
+    def test_zombies_requeue(self, app):
+
+        path = '/some/wrong/path/test_repo/subdir'
+        expired_time = datetime.utcnow() - timedelta(seconds=60)
+
+        # A pull and a freeze whose worker died
+        pull_id = app.task_dispatcher.submit('pull', path)
+        freeze_id = app.task_dispatcher.submit('freeze', path + '2')
+        self.task_ids = [pull_id, freeze_id]
+        time.sleep(5)
+        for task in BaricadrTask.query.filter(BaricadrTask.task_id.in_(self.task_ids)):
+            task.status = 'pulling' if task.type == 'pull' else 'freezing'
+            task.lease_expires = expired_time
+        db.session.commit()
+
+        assert app.task_leases.reap() == (1, 1)
+
+        pull_task = BaricadrTask.query.filter_by(task_id=pull_id).one()
+        assert pull_task.requeues == 1
+        assert app.path_locks.touching(path) == pull_id
+
+        freeze_task = BaricadrTask.query.filter_by(task_id=freeze_id).one()
+        assert freeze_task.status == 'failed'
+        assert app.path_locks.touching(path + '2') is None
+
+        # The requeued pull runs again (and fails on this wrong path)
+        time.sleep(5)
+        db.session.expire_all()
+        assert BaricadrTask.query.filter_by(task_id=pull_id).one().status == 'failed'
+
+    def test_queued_reap(self, app):
+
+        path = '/some/wrong/path/test_repo/subdir'
+        expired_time = datetime.utcnow() - timedelta(seconds=app.task_leases.queued_timeout + 60)
+        args = json.dumps({'args': [path, None, [], False], 'kwargs': {}})
+
+        # Tasks whose message was lost before any worker received it
+        self.task_ids = ['id_queued_lost', 'id_queued_noargs', 'id_queued_recent']
+        db.session.add(BaricadrTask(path=path, type="freeze", task_id='id_queued_lost', created=expired_time, status='new', args=args))
+        db.session.add(BaricadrTask(path=path + '2', type="pull", task_id='id_queued_noargs', created=expired_time, status='new'))
+        db.session.add(BaricadrTask(path=path + '3', type="pull", task_id='id_queued_recent', status='new', args=args))
+        app.path_locks.acquire(path, 'id_queued_lost')
+        db.session.commit()
+
+        assert sorted(dbtask.task_id for dbtask in app.task_leases.expired()) == ['id_queued_lost', 'id_queued_noargs']
+
+        # Sent again (not counted as a requeue, still locked), the task without args can't be
+        assert app.task_leases.reap() == (1, 1)
+
+        lost_task = BaricadrTask.query.filter_by(task_id='id_queued_lost').one()
+        assert lost_task.requeues == 0
+        assert app.path_locks.touching(path) == 'id_queued_lost'
+        assert BaricadrTask.query.filter_by(task_id='id_queued_noargs').one().status == 'failed'
+
+        # The task sent again runs (and fails on this wrong path)
+        time.sleep(5)
+        db.session.expire_all()
+        assert BaricadrTask.query.filter_by(task_id='id_queued_lost').one().status == 'failed'
+
     def test_cleanup(self, app):
 
         self.task_ids = ['id_finished', 'id_failed']
@@ -1,5 +1,9 @@
 import os
 import tempfile
+from datetime import datetime, timedelta
+
+from baricadr.db_models import BaricadrTask, PathLock
+from baricadr.extensions import db
 
 import pytest
 
@@ -242,3 +246,279 @@ class TestRepos(BaricadrTestCase):
 
         with pytest.raises(ValueError):
             app.repos.do_read_conf(str(conf))
+
+    def test_list_cache_ttl_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'list_cache_ttl': 3600,
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.list_cache_ttl == 3600
+
+    def test_list_cache_ttl_conf_negative(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'list_cache_ttl': -1,
+            },
+        }
+
+        with pytest.raises(ValueError):
+            app.repos.do_read_conf(str(conf))
+
+    def test_watermark_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'freezable': True,
+                'high_watermark': '90%',
+                'low_watermark': '500G',
+                'watermark_min_age': 7,
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.high_watermark == ('percent', 90)
+        assert repo.low_watermark == ('bytes', 500 * 1024 ** 3)
+        assert repo.watermark_min_age == 7
+        assert repo.watermark_interval == 10
+
+    def test_watermark_conf_invalid(self, app):
+        base_conf = {
+            'backend': 'sftp',
+            'url': 'host:google',
+            'user': 'someone',
+            'password': 'xxxxx',
+            'freezable': True,
+        }
+
+        for watermarks in ({'high_watermark': '90%'}, {'high_watermark': '80%', 'low_watermark': '90%'}, {'high_watermark': '120%', 'low_watermark': '90%'}, {'high_watermark': 'xxx', 'low_watermark': '10G'}):
+            conf = {
+                '/foo/bar': dict(base_conf, **watermarks)
+            }
+
+            with pytest.raises(ValueError):
+                app.repos.do_read_conf(str(conf))
+
+    def test_local_inventory_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'local_inventory': True,
+                'local_inventory_interval': 30,
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.inventory is not None
+        assert repo.inventory.interval == 30
+
+    def test_walk_threads_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'walk_threads': 2,
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.walk_threads == 2
+
+        conf['/foo/bar']['walk_threads'] = 0
+        with pytest.raises(ValueError):
+            app.repos.do_read_conf(str(conf))
+
+    def test_filter_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'exclude': "*xml , scratch/, /top/**",
+                'include': "*.{txt,xml,tsv}",
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+
+        assert repo.filter.is_excluded('some/file.xml')
+        assert repo.filter.is_excluded('some/file.bam')
+        assert repo.filter.is_excluded('some/scratch/file.txt')
+        assert repo.filter.is_excluded('top/file.txt')
+        assert not repo.filter.is_excluded('some/top/file.txt')
+        assert not repo.filter.is_excluded('some/file.txt')
+
+        assert repo.filter.is_pruned('some/scratch')
+        assert repo.filter.is_pruned('top')
+        assert not repo.filter.is_pruned('some/top')
+
+        assert repo.filter.rclone_rules() == ['- *xml', '- scratch/**', '- /top/**', '+ *.{txt,xml,tsv}', '- **']
+        assert repo.filter.rclone_rules('top/sub') == ['- *xml', '- scratch/**', '- /**', '+ *.{txt,xml,tsv}', '- **']
+        assert repo.filter.rclone_rules('other') == ['- *xml', '- scratch/**', '+ *.{txt,xml,tsv}', '- **']
+
+        conf['/foo/bar']['exclude'] = "[z-a]"
+        with pytest.raises(ValueError):
+            app.repos.do_read_conf(str(conf))
+
+    def test_catalog_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'catalog': True,
+                'catalog_interval': 12,
+                'catalog_refresh_interval': 30,
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.catalog is not None
+        assert repo.catalog.interval == 12
+        assert repo.catalog.refresh_interval == 30
+
+    def test_catalog_conf_interval_invalid(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'catalog': True,
+                'catalog_interval': 0,
+            },
+        }
+
+        with pytest.raises(ValueError):
+            app.repos.do_read_conf(str(conf))
+
+    def test_transfer_conf(self, app):
+        conf = {
+            '/foo/bar': {
+                'backend': 'sftp',
+                'url': 'host:google',
+                'user': 'someone',
+                'password': 'xxxxx',
+                'transfer': {
+                    'transfers': 16,
+                    'checkers': '32',
+                    'multi_thread_cutoff': '250M',
+                    'bwlimit': '08:00,512k 19:00,off',
+                    'sftp_concurrency': 128,
+                    'fast_list': True,
+                },
+            },
+        }
+
+        repos = app.repos.do_read_conf(str(conf))
+        repo = repos['/foo/bar']
+        assert repo.transfer['checkers'] == 32
+        assert "--transfers '16'" in repo.backend.transfer_options()
+        assert "--fast-list" in repo.backend.transfer_options()
+        assert "concurrency = 128" in repo.backend.rclone_config()
+
+    def test_transfer_conf_invalid(self, app):
+        transfers = [
+            {'transfers': 0},
+            {'buffer_size': 'lots'},
+            {'fast_list': 'yes'},
+            {'s3_upload_concurrency': 4},
+            {'unknown_option': 1},
+        ]
+
+        for transfer in transfers:
+            conf = {
+                '/foo/bar': {
+                    'backend': 'sftp',
+                    'url': 'host:google',
+                    'user': 'someone',
+                    'password': 'xxxxx',
+                    'transfer': transfer,
+                },
+            }
+
+            with pytest.raises(ValueError):
+                app.repos.do_read_conf(str(conf))
+
+    def test_path_locks(self, app):
+
+        try:
+            app.path_locks.acquire('/foo/bar/subdir', 'task-subdir')
+            app.path_locks.acquire('/foo/bar2', 'task-other')
+            db.session.commit()
+
+            assert app.repos.is_already_touching('/foo/bar/subdir/file.txt') == 'task-subdir'
+            assert app.repos.is_already_touching('/foo/bar/subdir') == 'task-subdir'
+            assert not app.repos.is_already_touching('/foo/bar/subdir2')
+            assert not app.repos.is_already_touching('/foo/bar')
+
+            assert app.repos.is_locked_by_subdir('/foo/bar') == ['task-subdir']
+            assert app.repos.is_locked_by_subdir('/foo/bar/subdir') == []
+
+            # Expired locks are ignored
+            PathLock.query.filter_by(task_id='task-subdir').update({PathLock.expires: datetime.utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+            assert not app.repos.is_already_touching('/foo/bar/subdir/file.txt')
+
+            app.path_locks.renew(['task-subdir'])
+            db.session.commit()
+            assert app.repos.is_already_touching('/foo/bar/subdir/file.txt') == 'task-subdir'
+
+            app.path_locks.release('task-subdir')
+            db.session.commit()
+            assert app.repos.is_locked_by_subdir('/foo/bar') == []
+        finally:
+            PathLock.query.filter(PathLock.task_id.in_(['task-subdir', 'task-other'])).delete(synchronize_session=False)
+            db.session.commit()
+
+    def test_path_locks_queued(self, app):
+
+        try:
+            db.session.add(BaricadrTask(path='/foo/bar', type='pull', task_id='task-queued', status='new'))
+            db.session.add(BaricadrTask(path='/foo/bar2', type='pull', task_id='task-running', status='pulling'))
+            app.path_locks.acquire('/foo/bar', 'task-queued')
+            app.path_locks.acquire('/foo/bar2', 'task-running')
+            db.session.commit()
+
+            # Already touched by a task: no new task
+            assert app.task_dispatcher.submit_unless_touching('pull', '/foo/bar/subdir') == ('task-queued', False)
+            assert BaricadrTask.query.filter_by(path='/foo/bar/subdir').count() == 0
+
+            PathLock.query.filter(PathLock.task_id.in_(['task-queued', 'task-running'])).update({PathLock.expires: datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+            db.session.commit()
+
+            # Only the locks of the tasks which did not start are renewed by the reaper
+            app.path_locks.renew_queued()
+            db.session.commit()
+            assert app.repos.is_already_touching('/foo/bar') == 'task-queued'
+            assert not app.repos.is_already_touching('/foo/bar2')
+        finally:
+            PathLock.query.filter(PathLock.task_id.in_(['task-queued', 'task-running'])).delete(synchronize_session=False)
+            BaricadrTask.query.filter(BaricadrTask.task_id.in_(['task-queued', 'task-running'])).delete(synchronize_session=False)
+            db.session.commit()
@@ -1,9 +1,18 @@
 import os
 import shutil
-from datetime import datetime
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from baricadr.db_models import FileAccess, LocalInventoryDir, LocalInventoryEntry, RemoteCatalog, RemoteCatalogEntry
+from baricadr.extensions import db
+from baricadr.model.access_tracker import AccessTracker
+from baricadr.model.freeze_planner import FreezePlanner, PathEntry, parse_mtime_ns
 
 import pytest
 
+from sqlalchemy.exc import SQLAlchemyError
+
 from . import BaricadrTestCase
 
 
@@ -99,6 +108,164 @@ class TestReposFreeze(BaricadrTestCase):
         for not_exp_freezed in not_expected_freezed:
             assert os.path.exists(not_exp_freezed)
 
+    def test_freeze_sort_on_disk(self, app, monkeypatch):
+
+        # Sort the remote listing in very small chunks
+        monkeypatch.setattr(FreezePlanner, 'SORT_CHUNK_SIZE', 2)
+
+        conf = {
+            self.testing_repo: self.testing_conf
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+
+        freezed = repo.freeze(self.testing_repo)
+
+        expected_freezed = [
+            os.path.join(self.testing_repo, 'file.txt'),
+            os.path.join(self.testing_repo, 'file2.txt'),
+            os.path.join(self.testing_repo, 'subdir/subfile.txt'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir2/subsubfile.txt'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir2/poutrelle.xml'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir2/subsubsubdir/subsubsubdir2/a file'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir/subsubfile.txt'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir/poutrelle.xml'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir/poutrelle.tsv')
+        ]
+
+        # Files are planned in path order
+        assert freezed[0] == sorted(expected_freezed)
+
+    def test_evict(self, app, monkeypatch):
+
+        conf = {
+            self.testing_repo: dict(self.testing_conf, high_watermark='90%', low_watermark='80%', watermark_min_age=2)
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        # Oldest file first
+        self.set_old_atime(self.testing_repo)
+        self.set_old_atime(os.path.join(self.testing_repo, 'file2.txt'), recursive=False)
+        # Recently accessed, never evicted
+        self.set_old_atime(os.path.join(self.testing_repo, 'subdir/subfile.txt'), age=-1000 * 3600, recursive=False)
+
+        # 20 bytes over the low watermark
+        monkeypatch.setattr(repo, 'disk_usage', lambda: (820, 1000))
+
+        assert repo.above_high_watermark() is False
+
+        freezed = repo.evict()
+
+        assert freezed[0][0] == os.path.join(self.testing_repo, 'file2.txt')
+        assert freezed[1] >= 20
+        assert os.path.join(self.testing_repo, 'subdir/subfile.txt') not in freezed[0]
+
+        for exp_freezed in freezed[0]:
+            assert not os.path.exists(exp_freezed)
+
+        monkeypatch.setattr(repo, 'disk_usage', lambda: (950, 1000))
+        assert repo.above_high_watermark() is True
+
+    def test_freeze_access_tracking(self, app):
+
+        conf = {
+            self.testing_repo: dict(self.testing_conf, access_tracking=True)
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+
+        # Accessed recently according to the access tracker
+        db.session.add(FileAccess(repo=repo.local_path, path='file.txt', accessed=datetime.utcnow()))
+        db.session.commit()
+
+        try:
+            freezed = repo.freeze(self.testing_repo)
+        finally:
+            FileAccess.query.filter_by(repo=repo.local_path).delete()
+            db.session.commit()
+
+        assert os.path.join(self.testing_repo, 'file.txt') not in freezed[0]
+        assert os.path.join(self.testing_repo, 'file2.txt') in freezed[0]
+        assert os.path.exists(os.path.join(self.testing_repo, 'file.txt'))
+
+    def test_freeze_local_inventory(self, app):
+
+        conf = {
+            self.testing_repo: dict(self.testing_conf, local_inventory=True)
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+
+        try:
+            repo.inventory.rescan()
+            assert repo.inventory.is_scanned()
+            assert 'file.txt' in repo.inventory.file_set(self.testing_repo, 0)
+
+            freezed = repo.freeze(self.testing_repo)
+
+            assert os.path.join(self.testing_repo, 'file.txt') in freezed[0]
+            assert not os.path.exists(os.path.join(self.testing_repo, 'file.txt'))
+            assert 'file.txt' not in repo.inventory.file_set(self.testing_repo, 0)
+        finally:
+            LocalInventoryEntry.query.filter_by(repo=repo.local_path).delete()
+            LocalInventoryDir.query.filter_by(repo=repo.local_path).delete()
+            db.session.commit()
+
+    def test_freeze_catalog_confirmed(self, app, monkeypatch):
+
+        conf = {
+            self.testing_repo: dict(self.testing_conf, catalog=True)
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+
+        try:
+            repo.catalog.index()
+            assert repo.catalog.is_fresh()
+
+            # Removed from the remote since the catalog was indexed
+            iter_raw_list = repo.backend.iter_raw_list
+            listed = []
+
+            def remote_without_file(repo, path, max_depth=1, refresh=False):
+                listed.append(path)
+                return (entry for entry in iter_raw_list(repo, path, max_depth, refresh) if entry['Path'] != 'file.txt')
+
+            monkeypatch.setattr(repo.backend, 'iter_raw_list', remote_without_file)
+
+            freezed = repo.freeze(self.testing_repo)
+
+            # A single listing per directory of freezed files
+            assert len(listed) == len(set(listed))
+
+            assert os.path.join(self.testing_repo, 'file2.txt') in freezed[0]
+            assert not os.path.exists(os.path.join(self.testing_repo, 'file2.txt'))
+            assert os.path.join(self.testing_repo, 'file.txt') not in freezed[0]
+            assert os.path.exists(os.path.join(self.testing_repo, 'file.txt'))
+        finally:
+            RemoteCatalogEntry.query.filter_by(repo=repo.local_path).delete()
+            RemoteCatalog.query.filter_by(repo=repo.local_path).delete()
+            db.session.commit()
+
     def test_freeze_exclude(self, app):
 
         # First get a local repo
@@ -145,6 +312,42 @@ class TestReposFreeze(BaricadrTestCase):
         for nexp_freezed in not_expected_freezed:
             assert os.path.exists(nexp_freezed)
 
+    def test_freeze_exclude_dir_include(self, app, monkeypatch):
+
+        conf = {
+            self.testing_repo: dict(self.testing_conf, exclude="subsubdir2/", include="*.txt")
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+
+        # Excluded directories are not even walked
+        is_pruned = repo.filter.is_pruned
+        pruned = []
+
+        def spy_pruned(rel_dir):
+            res = is_pruned(rel_dir)
+            if res:
+                pruned.append(rel_dir)
+            return res
+
+        monkeypatch.setattr(repo.filter, 'is_pruned', spy_pruned)
+
+        freezed = repo.freeze(self.testing_repo)
+
+        assert sorted(freezed[0]) == sorted([
+            os.path.join(self.testing_repo, 'file.txt'),
+            os.path.join(self.testing_repo, 'file2.txt'),
+            os.path.join(self.testing_repo, 'subdir/subfile.txt'),
+            os.path.join(self.testing_repo, 'subdir/subsubdir/subsubfile.txt'),
+        ])
+        assert pruned == ['subdir/subsubdir2']
+        assert os.path.exists(os.path.join(self.testing_repo, 'subdir/subsubdir/poutrelle.tsv'))
+        assert os.path.exists(os.path.join(self.testing_repo, 'subdir/subsubdir2/subsubfile.txt'))
+
     def test_freeze_exclude_multiple(self, app):
 
         # First get a local repo
@@ -452,3 +655,227 @@ class TestReposFreezeS3(TestReposFreeze):
         'freeze_age': 3,
         'freezable': True
     }
+
+
+class TestFreezePlanner(BaricadrTestCase):
+
+    testing_conf = {
+        'backend': 'sftp',
+        'url': 'sftp:test-repo/',
+        'user': 'foo',
+        'password': 'pass',
+        'freeze_age': 3,
+        'freezable': True
+    }
+
+    def test_parse_mtime_ns(self):
+
+        epoch = int(datetime(2020, 7, 28, 12, 41, 57, tzinfo=timezone.utc).timestamp())
+
+        # Nanoseconds, with a timezone offset
+        assert parse_mtime_ns('2020-07-28T14:41:57.123456789+02:00') == epoch * 10 ** 9 + 123456789
+        assert parse_mtime_ns('2020-07-28T10:41:57.123456789-02:00') == epoch * 10 ** 9 + 123456789
+
+        # UTC
+        assert parse_mtime_ns('2020-07-28T12:41:57.123456789Z') == epoch * 10 ** 9 + 123456789
+        assert parse_mtime_ns('2020-07-28T12:41:57Z') == epoch * 10 ** 9
+
+        # Shorter fractions are right padded
+        assert parse_mtime_ns('2020-07-28T12:41:57.5Z') == epoch * 10 ** 9 + 500000000
+        assert parse_mtime_ns('2020-07-28T12:41:57.000001+00:00') == epoch * 10 ** 9 + 1000
+
+        # Other ISO 8601 formats
+        assert parse_mtime_ns('2020-07-28T12:41:57+0000') == epoch * 10 ** 9
+
+    def test_evaluate_batch(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+            planner = FreezePlanner(repo)
+
+            now = time.time()
+            old = now - 10 * 24 * 3600
+            batch = []
+            for name, atime, mtime_shift in (('cold', old, 0), ('accessed', now, 0), ('modified', old, 3600), ('in_tolerance', old, 5)):
+                file_path = os.path.join(local_path, name)
+                with open(file_path, 'w') as local_file:
+                    local_file.write(name)
+                os.utime(file_path, (atime, old + mtime_shift))
+                batch.append((file_path, self.mod_time(old), PathEntry(file_path)))
+
+            # Missing locally, or without remote modification time
+            batch.append((os.path.join(local_path, 'missing'), self.mod_time(old), PathEntry(os.path.join(local_path, 'missing'))))
+            batch.append((os.path.join(local_path, 'cold'), None, PathEntry(os.path.join(local_path, 'cold'))))
+
+            mask, atimes, sizes = planner.evaluate_batch(batch, planner.atime_cutoff(3))
+            assert mask.tolist() == [True, False, False, True, False, False]
+            assert sizes.tolist() == [4, 8, 8, 12, 0, 0]
+            assert atimes[1] > planner.atime_cutoff(3) > atimes[0]
+
+            # Ignoring atime
+            mask, atimes, sizes = planner.evaluate_batch(batch)
+            assert mask.tolist() == [True, True, False, True, False, False]
+
+    def test_iter_local_files_single_file(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            os.makedirs(os.path.join(local_path, 'subdir'))
+            file_path = os.path.join(local_path, 'subdir/file.txt')
+            with open(file_path, 'w') as local_file:
+                local_file.write('foo')
+
+            files = list(FreezePlanner(repo).iter_local_files(file_path))
+            assert [(rel_path, path) for rel_path, path, entry in files] == [('subdir/file.txt', file_path)]
+            assert files[0][2].stat(follow_symlinks=False).st_size == 3
+
+    def test_iter_local_files_symlink_root(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            os.makedirs(os.path.join(local_path, 'subdir'))
+            with open(os.path.join(local_path, 'subdir/file.txt'), 'w') as local_file:
+                local_file.write('foo')
+            link_path = os.path.join(local_path, 'link')
+            os.symlink('subdir', link_path)
+
+            # Not followed, like the symlinks inside a directory
+            files = list(FreezePlanner(repo).iter_local_files(link_path))
+            assert [(rel_path, path) for rel_path, path, entry in files] == [('link', link_path)]
+            assert files[0][2].is_symlink()
+
+            files = list(FreezePlanner(repo).iter_local_files(local_path))
+            assert sorted(rel_path for rel_path, path, entry in files) == ['link', 'subdir/file.txt']
+
+    def test_access_tracker_flush(self, app, monkeypatch):
+
+        repo_path = '/repos/test_access_tracker_tmp'
+        tracker = AccessTracker(app)
+        old = datetime(2020, 1, 1)
+        recent = datetime(2021, 1, 1)
+
+        try:
+            db.session.add(FileAccess(repo=repo_path, path='recent.txt', accessed=recent))
+            db.session.commit()
+
+            # The database can't be reached: accesses are kept for the next flush
+            def fail(*args, **kwargs):
+                raise SQLAlchemyError("Connection lost")
+            with monkeypatch.context() as m:
+                m.setattr(db.session, 'execute', fail)
+                tracker.pending = {(repo_path, 'recent.txt'): old, (repo_path, 'new.txt'): old}
+                tracker.flush()
+            assert tracker.pending == {(repo_path, 'recent.txt'): old, (repo_path, 'new.txt'): old}
+
+            # Upserted, never moving an access time backwards
+            tracker.flush()
+            assert tracker.pending == {}
+            times = dict(db.session.query(FileAccess.path, FileAccess.accessed).filter(FileAccess.repo == repo_path))
+            assert times == {'recent.txt': recent, 'new.txt': old}
+        finally:
+            FileAccess.query.filter_by(repo=repo_path).delete()
+            db.session.commit()
+
+    def mod_time(self, mtime):
+
+        return datetime.fromtimestamp(mtime, tz=timezone.utc).isoformat()
+
+
+class TestLocalInventory(BaricadrTestCase):
+
+    testing_conf = {
+        'backend': 'sftp',
+        'url': 'sftp:test-repo/',
+        'user': 'foo',
+        'password': 'pass',
+        'freezable': True,
+        'local_inventory': True
+    }
+
+    def make_tree(self, local_path, files):
+
+        for file_path in files:
+            os.makedirs(os.path.dirname(os.path.join(local_path, file_path)), exist_ok=True)
+            with open(os.path.join(local_path, file_path), 'w') as local_file:
+                local_file.write(file_path)
+
+        # Not modified "just now", directories would be listed again on each scan
+        old = time.time() - 3600
+        for root, subdirs, files in os.walk(local_path):
+            os.utime(root, (old, old))
+
+    def test_rescan_unchanged(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            self.make_tree(local_path, ['file.txt', 'subdir/subfile.txt', 'subdir/subsubdir/subsubfile.txt', 'other/otherfile.txt'])
+
+            try:
+                assert repo.inventory.rescan() == 4
+                # Nothing changed, nothing listed
+                assert repo.inventory.rescan() == 0
+
+                # Only the modified directory is listed again
+                with open(os.path.join(local_path, 'subdir/newfile.txt'), 'w') as local_file:
+                    local_file.write('new')
+                old = time.time() - 60
+                os.utime(os.path.join(local_path, 'subdir'), (old, old))
+
+                assert repo.inventory.rescan() == 1
+                assert 'subdir/newfile.txt' in list(repo.inventory.iter_files(local_path))
+            finally:
+                LocalInventoryEntry.query.filter_by(repo=repo.local_path).delete()
+                LocalInventoryDir.query.filter_by(repo=repo.local_path).delete()
+                db.session.commit()
+
+    def test_rescan_removed_tree(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            self.make_tree(local_path, ['file.txt', 'subdir/subfile.txt', 'subdir/subsubdir/subsubfile.txt', 'subdir2/file.txt'])
+
+            try:
+                repo.inventory.rescan()
+
+                shutil.rmtree(os.path.join(local_path, 'subdir'))
+                repo.inventory.rescan()
+
+                assert list(repo.inventory.iter_files(local_path)) == ['file.txt', 'subdir2/file.txt']
+                assert LocalInventoryDir.query.filter(LocalInventoryDir.repo == repo.local_path, LocalInventoryDir.path.like('subdir%')).count() == 1
+            finally:
+                LocalInventoryEntry.query.filter_by(repo=repo.local_path).delete()
+                LocalInventoryDir.query.filter_by(repo=repo.local_path).delete()
+                db.session.commit()
+
+    def test_iter_files_max_depth(self, app):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            app.repos.read_conf_from_str(str({local_path: self.testing_conf}))
+            repo = app.repos.get_repo(local_path)
+
+            self.make_tree(local_path, ['file.txt', 'subdir/subfile.txt', 'subdir/subsubdir/subsubfile.txt', 'subdir0/file.txt'])
+
+            try:
+                repo.inventory.rescan()
+
+                assert list(repo.inventory.iter_files(local_path)) == ['file.txt', 'subdir/subfile.txt', 'subdir/subsubdir/subsubfile.txt', 'subdir0/file.txt']
+                assert list(repo.inventory.iter_files(local_path, max_depth=1)) == ['file.txt']
+                assert list(repo.inventory.iter_files(local_path, max_depth=2)) == ['file.txt', 'subdir/subfile.txt', 'subdir0/file.txt']
+                # Not subdir0
+                assert list(repo.inventory.iter_files(local_path + '/subdir', max_depth=1)) == ['subdir/subfile.txt']
+                assert list(repo.inventory.iter_files(local_path + '/subdir/', max_depth=0)) == ['subdir/subfile.txt', 'subdir/subsubdir/subsubfile.txt']
+                # A single file
+                assert list(repo.inventory.iter_files(local_path + '/subdir/subfile.txt')) == ['subdir/subfile.txt']
+            finally:
+                LocalInventoryEntry.query.filter_by(repo=repo.local_path).delete()
+                LocalInventoryDir.query.filter_by(repo=repo.local_path).delete()
+                db.session.commit()
@@ -80,3 +80,128 @@ class TestReposPull(BaricadrTestCase):
             'subdir/subsubdir/poutrelle.xml'
         ])
         assert pull_res[1] == 126
+
+    def test_pull_sftp_progress(self, app):
+
+        conf = {
+            self.testing_repo: {
+                'backend': 'sftp',
+                'url': 'sftp:test-repo/',
+                'user': 'foo',
+                'password': 'pass',
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+        progress_reports = []
+        pull_res = repo.pull(self.testing_repo, progress=progress_reports.append)
+
+        assert len(pull_res[0]) == 9
+        # At least the final stats are reported
+        assert progress_reports
+        assert progress_reports[-1]['bytes'] == 126
+        assert progress_reports[-1]['files'] == 9
+
+    def test_pull_sftp_native_symlinks(self, app):
+
+        conf = {
+            self.testing_repo: {
+                'backend': 'sftp_native',
+                'url': 'sftp:test-repo-sftp/',
+                'user': 'foo',
+                'password': 'pass',
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+        pull_res = repo.pull(self.testing_repo)
+
+        assert 'subdir/subsubdir/relative_symlink.tsv' in pull_res[0]
+        assert os.path.islink(self.testing_repo + 'subdir/subsubdir/relative_symlink.tsv')
+        assert os.readlink(self.testing_repo + 'subdir/subsubdir/relative_symlink.tsv') == 'poutrelle.tsv'
+        assert os.path.islink(self.testing_repo + 'subdir/subsubdir/absolute_symlink.tsv')
+        assert os.readlink(self.testing_repo + 'subdir/subsubdir/absolute_symlink.tsv') == '/tmp/something.tsv'
+
+        # Modification times are kept
+        assert int(os.lstat(self.testing_repo + 'file.txt').st_mtime) == int(os.lstat('/baricadr/test-data/test-repo-sftp/file.txt').st_mtime)
+
+    def test_pull_local_symlinks(self, app):
+
+        conf = {
+            self.testing_repo: {
+                'backend': 'local',
+                'path': '/baricadr/test-data/test-repo-sftp/',
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+        pull_res = repo.pull(self.testing_repo)
+
+        assert 'subdir/subsubdir/relative_symlink.tsv' in pull_res[0]
+        assert os.path.islink(self.testing_repo + 'subdir/subsubdir/relative_symlink.tsv')
+        assert os.readlink(self.testing_repo + 'subdir/subsubdir/relative_symlink.tsv') == 'poutrelle.tsv'
+        assert os.path.islink(self.testing_repo + 'subdir/subsubdir/absolute_symlink.tsv')
+        assert os.readlink(self.testing_repo + 'subdir/subsubdir/absolute_symlink.tsv') == '/tmp/something.tsv'
+
+        # Modification times are kept
+        assert int(os.lstat(self.testing_repo + 'file.txt').st_mtime) == int(os.lstat('/baricadr/test-data/test-repo-sftp/file.txt').st_mtime)
+
+    def test_pull_fixes_copied_files_only(self, app):
+
+        conf = {
+            self.testing_repo: {
+                'backend': 'local',
+                'path': '/baricadr/test-data/test-repo/',
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+        repo.pull(self.testing_repo)
+
+        self.set_old_atime(self.testing_repo)
+        old_atime = os.lstat(self.testing_repo + 'file.txt').st_atime
+        os.remove(self.testing_repo + 'file2.txt')
+
+        pull_res = repo.pull(self.testing_repo)
+
+        assert pull_res[0] == ['file2.txt']
+        # Files which were already there are not touched
+        assert os.lstat(self.testing_repo + 'file.txt').st_atime == old_atime
+        assert os.lstat(self.testing_repo + 'file2.txt').st_atime > old_atime
+
+    def test_local_file_set(self, app):
+
+        shutil.copytree(self.template_repo, self.testing_repo)
+        os.symlink(self.testing_repo + 'subdir/subsubdir', self.testing_repo + 'subdir/link')
+
+        conf = {
+            self.testing_repo: {
+                'backend': 'local',
+                'path': '/baricadr/test-data/test-repo/',
+                'walk_threads': 2,
+            }
+        }
+
+        app.repos.read_conf_from_str(str(conf))
+
+        repo = app.repos.get_repo(self.testing_repo)
+
+        assert repo.local_file_set(self.testing_repo + 'subdir', 1) == set(['subfile.txt', 'link'])
+        assert repo.local_file_set(self.testing_repo + 'subdir', 0) == set([
+            'subfile.txt',
+            'link',
+            'subsubdir/poutrelle.tsv',
+            'subsubdir/poutrelle.xml',
+            'subsubdir/subsubfile.txt',
+            'subsubdir2/poutrelle.xml',
+            'subsubdir2/subsubfile.txt',
+            'subsubdir2/subsubsubdir/subsubsubdir2/a file',
+        ])
@@ -0,0 +1,62 @@
+import os
+import resource
+import tempfile
+
+from baricadr.model.walker import TreeWalker
+
+from . import BaricadrTestCase
+
+
+class TestTreeWalker(BaricadrTestCase):
+
+    def make_tree(self, root, dirs, files_per_dir=1):
+
+        for dir_path in dirs:
+            os.makedirs(os.path.join(root, dir_path))
+            for i in range(files_per_dir):
+                with open(os.path.join(root, dir_path, 'file%s.txt' % i), 'w') as local_file:
+                    local_file.write(dir_path)
+
+    def test_walk_ordered(self):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            self.make_tree(local_path, ['a', 'a/b', 'a0', 'a.d', 'c'])
+            with open(os.path.join(local_path, 'a.txt'), 'w') as local_file:
+                local_file.write('foo')
+
+            walked = [rel_path for rel_path, value in TreeWalker(4).walk(local_path, ordered=True)]
+
+            # Sorted like full paths ('/' comes before '.' and '0')
+            assert walked == sorted(walked)
+            assert walked == ['a.d/file0.txt', 'a.txt', 'a/b/file0.txt', 'a/file0.txt', 'a0/file0.txt', 'c/file0.txt']
+
+    def test_walk_ordered_many_siblings(self):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            dirs = ['dir%04d' % i for i in range(3000)]
+            self.make_tree(local_path, dirs)
+
+            # Way less file descriptors than sibling directories
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (max(512, len(os.listdir('/proc/self/fd')) + 256), hard))
+            try:
+                walked = [rel_path for rel_path, value in TreeWalker(8).walk(local_path, visit=lambda dir_fd, dir_entry: dir_entry.stat(follow_symlinks=False), ordered=True)]
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+            assert walked == [os.path.join(dir_path, 'file0.txt') for dir_path in dirs]
+
+    def test_walk_interrupted(self):
+
+        with tempfile.TemporaryDirectory() as local_path:
+            self.make_tree(local_path, ['dir%03d' % i for i in range(100)])
+
+            open_fds = len(os.listdir('/proc/self/fd'))
+
+            walk = TreeWalker(4).walk(local_path, ordered=True)
+            for i in range(10):
+                next(walk)
+            walk.close()
+
+            # All the directories are closed
+            assert len(os.listdir('/proc/self/fd')) == open_fds